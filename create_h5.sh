@@ -2,32 +2,36 @@
 input_dir=$1
 ## rotateをTrueにするかどうか boolで取得
 rotate=$2
+## 並列数 (省略時はCPUコア数)
+num_workers=${3:-$(nproc)}
 
 ## 引数確認 
-if [ $# -ne 2 ]; then
-    echo "Usage: $0 <input_dir> <rotate>"
+if [ $# -lt 2 ]; then
+    echo "Usage: $0 <input_dir> <rotate> [num_workers]"
     exit 1
 fi
-## hdf5を作成
+## hdf5を作成 (不要: convert_h5.py は .hdf5 が無ければ .raw を直接デコードする)
 # metavision_file_to_hdf5 -i ${input_dir} -r -p ".*\\.raw"
 
-## input_dir内のサブディレクトリを取得
-sub_dirs=$(find ${input_dir} -mindepth 1 -maxdepth 1 -type d)
-
-## loop
-for sub_dir in ${sub_dirs}; do
-    
-    ## h5を作成 
-    python3 python/convert_h5.py -b ${sub_dir} -W 640 -H 480 -r ${rotate}
-
-    ## 画像のrotate
-    # if [ ${rotate} = "True" ]; then
-    #     python3 python/rotate_img.py -b ${sub_dir}
-    # fi
+rotate_flag=""
+if [ "${rotate}" = "True" ]; then
+    rotate_flag="-r"
+fi
 
+## input_dir内の全サブディレクトリのh5を並列に作成 (events.h5が.hdf5より新しいものはスキップ)
+python3 python/convert_all_h5.py -i ${input_dir} -W 640 -H 480 -j ${num_workers} ${rotate_flag}
+if [ $? -ne 0 ]; then
+    echo "Conversion failed"
+    exit 1
+fi
 
-done
+## 画像のrotate
+# if [ ${rotate} = "True" ]; then
+#     for sub_dir in $(find ${input_dir} -mindepth 1 -maxdepth 1 -type d); do
+#         python3 python/rotate_img.py -b ${sub_dir}
+#     done
+# fi
 
 
 ## 完了を通知
-echo "Matching completed successfully!"
\ No newline at end of file
+echo "Matching completed successfully!"
@@ -4,6 +4,7 @@
 DATA_DIR="/home/apollo/Arata/gifu"  # データセットのディレクトリ
 DEST_DIR="/home/apollo/dataset/gifu_pre"  # 前処理後のデータ保存先
 NUM_PROCESSES=４  # 並列処理数
+PROFILE=${PROFILE:-0}  # 1: 処理段階ごとの時間を計測 (DEST_DIR/profiles に出力)
 
 # const_durationの設定値リスト
 DURATION_VALUES=(5 10 50 100)
@@ -25,36 +26,35 @@ fi
 # 時間計測開始
 TOTAL_START_TIME=$(date +%s)
 
-# ループで複数の const_duration 設定を適用
-for DURATION in "${DURATION_VALUES[@]}"; do
-    CONFIG_FILE="conf_preprocess/extraction/const_duration_${DURATION}.yaml"
-    
-    echo "Processing with ${CONFIG_FILE}..."
-    
-    START_TIME=$(date +%s)
-
-    # 実行コマンド
-    COMMAND=(
-        python python/preprocess_rvt.py "$DATA_DIR" "$DEST_DIR"
-        "conf_preprocess/representation/event_frame.yaml"
-        "$CONFIG_FILE"
-        "conf_preprocess/filter_gifu.yaml"
-        -ds "gifu" -np "$NUM_PROCESSES"
-    )
-
-    # 実行
-    if "${COMMAND[@]}"; then
-        echo "Preprocessing completed successfully for duration=${DURATION}!"
-    else
-        echo "Error: Preprocessing failed for duration=${DURATION}!"
-        exit 1
-    fi
-
-    END_TIME=$(date +%s)
-    ELAPSED_TIME=$((END_TIME - START_TIME))
-
-    echo "Execution Time for duration=${DURATION}: ${ELAPSED_TIME} seconds"
+# 全ての const_duration 設定を1回の実行で処理 (各シーケンスのイベントは1回だけ読み込まれる)
+EXTRA_CONFIG_FILES=()
+for DURATION in "${DURATION_VALUES[@]:1}"; do
+    EXTRA_CONFIG_FILES+=("conf_preprocess/extraction/const_duration_${DURATION}.yaml")
 done
+CONFIG_FILE="conf_preprocess/extraction/const_duration_${DURATION_VALUES[0]}.yaml"
+
+echo "Processing with ${CONFIG_FILE} ${EXTRA_CONFIG_FILES[*]}..."
+
+# 実行コマンド
+COMMAND=(
+    python python/preprocess_rvt.py "$DATA_DIR" "$DEST_DIR"
+    "conf_preprocess/representation/event_frame.yaml"
+    "$CONFIG_FILE"
+    "conf_preprocess/filter_gifu.yaml"
+    -ds "gifu" -np "$NUM_PROCESSES"
+    --extra_extraction_yaml_configs "${EXTRA_CONFIG_FILES[@]}"
+)
+if [ "$PROFILE" = "1" ]; then
+    COMMAND+=(--profile)
+fi
+
+# 実行
+if "${COMMAND[@]}"; then
+    echo "Preprocessing completed successfully for durations=${DURATION_VALUES[*]}!"
+else
+    echo "Error: Preprocessing failed for durations=${DURATION_VALUES[*]}!"
+    exit 1
+fi
 
 # 全体の時間計測終了
 TOTAL_END_TIME=$(date +%s)
@@ -0,0 +1,92 @@
+import argparse
+import itertools
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from convert_h5 import DEFAULT_H5_CHUNK_SIZE, DEFAULT_SLAB_SIZE, EventStreamWriter
+
+
+def load_sample(events_h5, num_events, offset):
+    """events.h5 から連続した num_events 個のイベントを読み込む (offset が負なら中央から)。"""
+    with h5py.File(events_h5, "r") as f:
+        ev = f["events"]
+        total = ev["t"].shape[0]
+        num_events = min(num_events, total)
+        if offset < 0:
+            offset = (total - num_events) // 2
+        sl = slice(offset, offset + num_events)
+        return {name: ev[name][sl] for name in ("x", "y", "t", "p")}
+
+
+def benchmark_setting(sample, tmp_dir, chunk_size, slab_size, **codec):
+    path = os.path.join(tmp_dir, "bench_events.h5")
+    num_events = len(sample["t"])
+
+    start = time.perf_counter()
+    with h5py.File(path, "w") as f:
+        writer = EventStreamWriter(f, chunk_size=chunk_size, **codec)
+        for idx in range(0, num_events, slab_size):
+            sl = slice(idx, idx + slab_size)
+            writer.append(sample["x"][sl], sample["y"][sl], sample["t"][sl], sample["p"][sl])
+        writer.finalize()
+    write_s = time.perf_counter() - start
+
+    with h5py.File(path, "r") as f:
+        stored_bytes = sum(f["events"][name].id.get_storage_size() for name in ("x", "y", "t", "p"))
+        start = time.perf_counter()
+        for name in ("x", "y", "t", "p"):
+            decoded = f["events"][name][:]
+            assert np.array_equal(decoded, sample[name])
+        read_s = time.perf_counter() - start
+    os.remove(path)
+
+    raw_bytes = sum(sample[name].nbytes for name in ("x", "y", "t", "p"))
+    return dict(ratio=raw_bytes / max(stored_bytes, 1), stored_bytes=stored_bytes,
+                write_s=write_s, read_s=read_s, num_events=num_events)
+
+
+def settings_grid(complevels):
+    yield dict(codec="none", complevel=0, shuffle="none")
+    yield dict(codec="lzf", complevel=0, shuffle="byte")
+    yield dict(codec="gzip", complevel=1, shuffle="byte")
+    for codec, shuffle, complevel in itertools.product(("blosc:lz4", "blosc:zstd"), ("byte", "bit"), complevels):
+        yield dict(codec=codec, complevel=complevel, shuffle=shuffle)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark compression settings of the events.h5 event columns")
+    parser.add_argument("events_h5", help="Path to an existing events.h5 used as sample")
+    parser.add_argument("--num_events", "-n", default=2 * 10 ** 7, type=int, help="Number of events in the sample")
+    parser.add_argument("--offset", default=-1, type=int, help="First event of the sample (-1: middle of the file)")
+    parser.add_argument("--chunk_sizes", default=[DEFAULT_H5_CHUNK_SIZE], type=int, nargs="+",
+                        help="HDF5 chunk lengths (in events) to test")
+    parser.add_argument("--complevels", default=[1, 5], type=int, nargs="+", help="Blosc levels to test")
+    parser.add_argument("--disk_mb_s", default=200.0, type=float,
+                        help="Disk bandwidth used to estimate the total (write + read) time")
+    parser.add_argument("--tmp_dir", default=None, help="Directory for the temporary files (same disk as the data)")
+    args = parser.parse_args()
+
+    sample = load_sample(args.events_h5, args.num_events, args.offset)
+    num_events = len(sample["t"])
+    print(f"sample: {num_events} events from {args.events_h5}")
+
+    results = list()
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        for chunk_size in args.chunk_sizes:
+            for setting in settings_grid(args.complevels):
+                result = benchmark_setting(sample, tmp_dir, chunk_size, DEFAULT_SLAB_SIZE, **setting)
+                # 1回書き込んで1回読み出す場合の、10^9イベントあたりの推定時間
+                io_s = 2 * result["stored_bytes"] / (args.disk_mb_s * 1e6)
+                result["est_s_per_gev"] = (result["write_s"] + result["read_s"] + io_s) * 1e9 / max(num_events, 1)
+                results.append(dict(chunk_size=chunk_size, **setting, **result))
+
+    print(f"{'codec':<11} {'shuffle':<7} {'lvl':>3} {'chunk':>7} {'ratio':>6} "
+          f"{'write Mev/s':>11} {'read Mev/s':>10} {'est. s/Gev':>10}")
+    for r in sorted(results, key=lambda r: r["est_s_per_gev"]):
+        print(f"{r['codec']:<11} {r['shuffle']:<7} {r['complevel']:>3} {r['chunk_size']:>7} "
+              f"{r['ratio']:>6.2f} {num_events / r['write_s'] / 1e6:>11.1f} {num_events / r['read_s'] / 1e6:>10.1f} "
+              f"{r['est_s_per_gev']:>10.1f}")
@@ -0,0 +1,163 @@
+"""
+Benchmark of the output compression (codec, shuffle, level, frames per chunk) for an event representation.
+
+A sample of windows of a sequence is constructed once. For every setting, the sample is written with H5Writer as
+in preprocess_rvt.py, then read back frame by frame in random order (like a training dataloader).
+With --save, the selected setting is written to the writer section of the representation config, which
+preprocess_rvt.py passes to H5Writer.
+"""
+import argparse
+import itertools
+import os
+from pathlib import Path
+import re
+import tempfile
+import time
+from typing import Dict, List
+
+import h5py
+try:
+    import hdf5plugin
+except ImportError:
+    pass
+import numpy as np
+from omegaconf import OmegaConf
+
+from h5_codecs import CODECS, SHUFFLES
+from preprocess_rvt import EventReprJob, EventReprStream, H5Reader, H5Writer, dataset_2_height, dataset_2_width, \
+    get_configuration, get_window_extraction, name_2_ev_repr_factory
+
+OBJECTIVES = ('balanced', 'size', 'write', 'read')
+
+
+def sample_windows(h5_reader: H5Reader, ev_repr_delta_ts_ms: int, num_windows: int) -> np.ndarray:
+    """End timestamps of num_windows windows spread evenly over the sequence."""
+    t_first = int(h5_reader.get_event_slice(0, 1, convert_2_torch=False)['t'][0]) + h5_reader.t_offset
+    t_last = int(h5_reader.get_event_slice(h5_reader.num_events - 1, h5_reader.num_events,
+                                           convert_2_torch=False)['t'][0]) + h5_reader.t_offset
+    return np.linspace(t_first + ev_repr_delta_ts_ms * 1000, t_last, num_windows).astype('int64')
+
+
+def construct_sample(events_h5: Path, dataset: str, config, num_windows: int) -> np.ndarray:
+    """(num_windows, C, H, W) representations as stored by preprocess_rvt.py."""
+    height, width = dataset_2_height[dataset], dataset_2_width[dataset]
+    ev_repr = name_2_ev_repr_factory[config.name](config).create(height=height, width=width)
+    ev_repr_num_events, ev_repr_delta_ts_ms, _ = get_window_extraction(config.event_window_extraction)
+    with H5Reader(events_h5, dataset=dataset) as h5_reader:
+        timestamps_us = sample_windows(h5_reader, ev_repr_delta_ts_ms or 0, num_windows)
+        job = EventReprJob(ev_out_dir=Path(), event_representation=ev_repr, ev_repr_num_events=ev_repr_num_events,
+                           ev_repr_delta_ts_ms=ev_repr_delta_ts_ms, ev_repr_timestamps_us=timestamps_us,
+                           frameidx2repridx=np.zeros(0, dtype='int64'))
+        stream = EventReprStream(job=job, h5_reader=h5_reader, writer=None, downsample_by_2=dataset == 'gen4',
+                                 pipeline_depth=0, batch_size=1, incremental=False)
+        return np.concatenate([stream.compute(read()) for _, read in stream.read_requests()])
+
+
+def settings(codecs: List[str], shuffles: List[str], complevels: List[int], frames_per_chunk: List[int]):
+    for codec, shuffle, complevel, num_frames in itertools.product(codecs, shuffles, complevels, frames_per_chunk):
+        if codec == 'none' and (shuffle != 'none' or complevel != complevels[0]):
+            continue
+        if codec == 'lzf' and complevel != complevels[0]:
+            # no compression level
+            continue
+        if shuffle == 'bit' and not codec.startswith('blosc:'):
+            continue
+        yield dict(codec=codec, shuffle=shuffle, complevel=complevel, frames_per_chunk=num_frames)
+
+
+def measure(frames: np.ndarray, setting: Dict, h5_file: Path, num_reads: int) -> Dict:
+    start = time.perf_counter()
+    with H5Writer(h5_file, key='data', ev_repr_shape=frames.shape[1:], numpy_dtype=frames.dtype,
+                  num_frames=len(frames), **setting) as h5_writer:
+        for frame in frames:
+            h5_writer.add_data_batch(frame[None])
+    write_s = time.perf_counter() - start
+    file_size = os.path.getsize(h5_file)
+
+    read_idx = np.random.default_rng(0).integers(0, len(frames), num_reads)
+    with h5py.File(str(h5_file), 'r') as h5f:
+        data = h5f['data']
+        start = time.perf_counter()
+        for idx in read_idx:
+            data[int(idx)]
+        read_s = time.perf_counter() - start
+    frame_mb = frames[0].nbytes / 1024 ** 2
+    return dict(setting,
+                ratio=frames.nbytes / file_size,
+                write_mbs=len(frames) * frame_mb / write_s,
+                read_mbs=num_reads * frame_mb / read_s)
+
+
+def select(results: List[Dict], objective: str, disk_mbs: float) -> Dict:
+    """
+    size/write/read: best ratio/write throughput/read throughput.
+    balanced: least time per MB of representations to compress, decompress and transfer the compressed data once
+              from/to a storage with disk_mbs MB/s.
+    """
+    assert objective in OBJECTIVES, f'{objective=}'
+    if objective == 'size':
+        return max(results, key=lambda result: result['ratio'])
+    if objective in ('write', 'read'):
+        return max(results, key=lambda result: result[f'{objective}_mbs'])
+    return min(results, key=lambda result: 1 / result['write_mbs'] + 1 / result['read_mbs'] +
+               1 / (result['ratio'] * disk_mbs))
+
+
+def save_writer_config(ev_repr_yaml_config: Path, setting: Dict):
+    """Replaces the top level writer section of the yaml file, other lines (and comments) are kept."""
+    lines = ev_repr_yaml_config.read_text().splitlines()
+    kept, in_writer = list(), False
+    for line in lines:
+        if re.match(r'^writer\s*:', line):
+            in_writer = True
+            continue
+        if in_writer and (line.startswith((' ', '\t')) or not line.strip()):
+            continue
+        in_writer = False
+        kept.append(line)
+    kept.append('writer:  # bench_repr_codecs.py で選択')
+    kept.extend(f'  {key}: {value!r}' if isinstance(value, str) else f'  {key}: {value}'
+                for key, value in setting.items())
+    ev_repr_yaml_config.write_text('\n'.join(kept) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark compression settings of the event representation output')
+    parser.add_argument('events_h5', help='Path to an events.h5 file')
+    parser.add_argument('ev_repr_yaml_config', help='Path to event representation yaml config file')
+    parser.add_argument('extraction_yaml_config', help='Path to event window extraction yaml config file')
+    parser.add_argument('-ds', '--dataset', default='gifu', help='gen1, gen4 or gifu')
+    parser.add_argument('--num_windows', default=100, type=int, help='Number of sampled windows')
+    parser.add_argument('--num_reads', default=200, type=int, help='Number of random single frame reads')
+    parser.add_argument('--codecs', default=['none', 'gzip', 'lzf', 'blosc:lz4', 'blosc:zstd'], nargs='+',
+                        choices=CODECS)
+    parser.add_argument('--shuffles', default=['none', 'byte', 'bit'], nargs='+', choices=SHUFFLES)
+    parser.add_argument('--complevels', default=[1, 3, 5], type=int, nargs='+')
+    parser.add_argument('--frames_per_chunk', default=[1], type=int, nargs='+')
+    parser.add_argument('--objective', default='balanced', choices=OBJECTIVES)
+    parser.add_argument('--disk_mbs', default=200, type=float, help='Storage throughput [MB/s] (objective balanced)')
+    parser.add_argument('--save', action='store_true', help='Write the selected setting into ev_repr_yaml_config')
+    args = parser.parse_args()
+
+    config = get_configuration(ev_repr_yaml_config=Path(args.ev_repr_yaml_config),
+                               extraction_yaml_config=Path(args.extraction_yaml_config))
+    frames = construct_sample(Path(args.events_h5), args.dataset, config, args.num_windows)
+    print(f'{config.name}: {len(frames)} windows of {frames.shape[1:]} {frames.dtype}, '
+          f'{100 * np.count_nonzero(frames) / frames.size:.1f}% non-zero')
+
+    results = list()
+    print(f"{'codec':<12} {'shuffle':<8} {'level':>5} {'frames':>6} {'ratio':>7} {'write MB/s':>11} {'read MB/s':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for setting in settings(args.codecs, args.shuffles, args.complevels, args.frames_per_chunk):
+            result = measure(frames, setting, Path(tmp_dir) / 'bench.h5', args.num_reads)
+            results.append(result)
+            print(f"{result['codec']:<12} {result['shuffle']:<8} {result['complevel']:>5} "
+                  f"{result['frames_per_chunk']:>6} {result['ratio']:>7.2f} {result['write_mbs']:>11.1f} "
+                  f"{result['read_mbs']:>10.1f}")
+
+    best = select(results, args.objective, args.disk_mbs)
+    best_setting = {key: best[key] for key in ('codec', 'complevel', 'shuffle', 'frames_per_chunk')}
+    print(f'selected ({args.objective}): {OmegaConf.to_yaml(best_setting)}')
+    if args.save:
+        save_writer_config(Path(args.ev_repr_yaml_config), best_setting)
+        print(f'saved to {args.ev_repr_yaml_config}')
@@ -0,0 +1,105 @@
+import argparse
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from preprocess_rvt import EventFrame, H5Reader, MixedDensityEventStack, StackedHistogram, downsample_ev_repr
+from representations_numba import EventFrameNumba, MixedDensityEventStackNumba, StackedHistogramNumba, \
+    downsample_ev_repr_numpy
+
+
+def window_indices(h5_reader: H5Reader, window_ms: int, num_windows: int):
+    """Consecutive windows of window_ms starting at the middle of the sequence."""
+    time_first = int(h5_reader.get_event_slice(0, 1, convert_2_torch=False)['t'][0])
+    time_last = int(h5_reader.get_event_slice(h5_reader.num_events - 1, h5_reader.num_events,
+                                              convert_2_torch=False)['t'][0])
+    start_us = (time_first + time_last) // 2
+    ts_end = start_us + window_ms * 1000 * np.arange(1, num_windows + 1, dtype='int64')
+    ts_end = ts_end[ts_end <= time_last]
+    idx_end = h5_reader.get_event_indices(ts_end, side='right')
+    idx_start = h5_reader.get_event_indices(ts_end - window_ms * 1000, side='left')
+    return idx_start, idx_end
+
+
+def import_time_s(module: str) -> float:
+    """Import time of a module in a fresh interpreter (as paid by every spawned worker)."""
+    code = f'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+    return float(subprocess.run([sys.executable, '-c', code], capture_output=True, check=True, text=True).stdout)
+
+
+def run_torch(ev_repr, windows, downsample_by_2: bool):
+    outputs = list()
+    for window in windows:
+        x, y, p, t = (torch.from_numpy(window[key]) for key in ('x', 'y', 'p', 't'))
+        output = ev_repr.construct(x=x, y=y, pol=p, time=t).unsqueeze(0)
+        if downsample_by_2:
+            output = downsample_ev_repr(x=output, scale_factor=0.5)
+        outputs.append(output.numpy()[0])
+    return outputs
+
+
+def run_numba(ev_repr, windows, downsample_by_2: bool):
+    outputs = list()
+    for window in windows:
+        output = ev_repr.construct(x=window['x'], y=window['y'], pol=window['p'], time=window['t'])
+        if downsample_by_2:
+            output = downsample_ev_repr_numpy(output)
+        outputs.append(output)
+    return outputs
+
+
+def timed(fn, repeats: int):
+    result = fn()  # warm-up (numba compilation, allocator)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return result, (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the torch and numba representation backends')
+    parser.add_argument('events_h5', help='Path to an events.h5 file')
+    parser.add_argument('-ds', '--dataset', default='gifu', help='gen1, gen4 or gifu')
+    parser.add_argument('--window_ms', default=[10, 50], type=int, nargs='+', help='Window durations to test')
+    parser.add_argument('--num_windows', default=200, type=int)
+    parser.add_argument('--nbins', default=10, type=int)
+    parser.add_argument('--count_cutoff', default=10, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--downsample_by_2', action='store_true')
+    args = parser.parse_args()
+
+    print(f'import time: torch {import_time_s("torch"):.2f}s, numba {import_time_s("numba"):.2f}s')
+
+    with H5Reader(Path(args.events_h5), dataset=args.dataset) as h5_reader:
+        height, width = h5_reader.get_height_and_width()
+        backends = {
+            'event_frame': (EventFrame(height=height, width=width),
+                            EventFrameNumba(height=height, width=width)),
+            'stacked_histogram': (StackedHistogram(bins=args.nbins, height=height, width=width,
+                                                   count_cutoff=args.count_cutoff),
+                                  StackedHistogramNumba(bins=args.nbins, height=height, width=width,
+                                                        count_cutoff=args.count_cutoff)),
+            'mixeddensity_stack': (MixedDensityEventStack(bins=args.nbins, height=height, width=width,
+                                                          count_cutoff=args.count_cutoff),
+                                   MixedDensityEventStackNumba(bins=args.nbins, height=height, width=width,
+                                                               count_cutoff=args.count_cutoff)),
+        }
+        print(f"{'representation':<20} {'window':>7} {'ev/window':>10} {'torch ms':>9} {'numba ms':>9} "
+              f"{'speedup':>8} {'parity':>7}")
+        for window_ms in args.window_ms:
+            idx_start, idx_end = window_indices(h5_reader, window_ms, args.num_windows)
+            windows = [h5_reader.get_event_slice(int(start), int(end), convert_2_torch=False)
+                       for start, end in zip(idx_start, idx_end)]
+            num_events = np.mean([len(window['t']) for window in windows])
+            for name, (torch_repr, numba_repr) in backends.items():
+                torch_out, torch_s = timed(lambda: run_torch(torch_repr, windows, args.downsample_by_2),
+                                           args.repeats)
+                numba_out, numba_s = timed(lambda: run_numba(numba_repr, windows, args.downsample_by_2),
+                                           args.repeats)
+                parity = all(np.array_equal(a, b) for a, b in zip(torch_out, numba_out))
+                print(f'{name:<20} {window_ms:>5}ms {num_events:>10.0f} {1e3 * torch_s / len(windows):>9.3f} '
+                      f'{1e3 * numba_s / len(windows):>9.3f} {torch_s / numba_s:>7.1f}x {str(parity):>7}')
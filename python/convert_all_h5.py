@@ -0,0 +1,110 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import get_context
+
+import h5py
+
+from convert_h5 import (DEFAULT_H5_CHUNK_SIZE, DEFAULT_SLAB_SIZE, add_codec_arguments, add_filter_arguments,
+                        codec_kwargs, convert_hdf5, filter_kwargs, find_input_file)
+
+
+def find_sequences(input_dir):
+    """input_dir直下のサブディレクトリのうち、eventsディレクトリを持つものをシーケンスとして返す。"""
+    sequences = list()
+    for entry in sorted(os.scandir(input_dir), key=lambda e: e.name):
+        if entry.is_dir() and os.path.isdir(os.path.join(entry.path, "events")):
+            sequences.append(entry.path)
+    return sequences
+
+
+def is_complete(output_file):
+    """events.h5 が読めて、変換の最後 (finalize) に付与される monotonic 属性を持つか。"""
+    try:
+        with h5py.File(output_file, "r") as f:
+            return "events" in f and bool(f["events"].attrs.get("monotonic", False))
+    except OSError:
+        return False
+
+
+def is_up_to_date(base_dir):
+    """events.h5 が完全に書き込まれていて、入力の .hdf5 (または .raw) より新しければ変換済みとみなす。"""
+    event_dir = os.path.join(base_dir, "events")
+    output_file = os.path.join(event_dir, "events.h5")
+    if not os.path.exists(output_file):
+        return False
+    input_file = find_input_file(event_dir)
+    if input_file is None:
+        return False
+    return os.path.getmtime(output_file) > os.path.getmtime(input_file) and is_complete(output_file)
+
+
+def _convert_sequence(task):
+    base_dir, W, H, rotate, options = task
+    try:
+        stats = convert_hdf5(base_dir, W, H, rotate, **options)
+    except Exception as e:
+        print(f"Error converting {base_dir}: {e}")
+        stats = None
+    return base_dir, stats
+
+
+def print_summary(results, skipped, wall_time_s):
+    print("")
+    print(f"{'sequence':<40} {'events':>14} {'time [s]':>10} {'Mev/s':>8}")
+    total_events = 0
+    num_failed = 0
+    for base_dir, stats in sorted(results, key=lambda r: r[0]):
+        name = os.path.basename(os.path.normpath(base_dir))
+        if stats is None:
+            print(f"{name:<40} {'failed':>14}")
+            num_failed += 1
+            continue
+        total_events += stats["num_events"]
+        rate = stats["num_events"] / max(stats["elapsed_s"], 1e-9) / 1e6
+        print(f"{name:<40} {stats['num_events']:>14} {stats['elapsed_s']:>10.2f} {rate:>8.2f}")
+    for base_dir in skipped:
+        print(f"{os.path.basename(os.path.normpath(base_dir)):<40} {'up to date':>14}")
+    print(f"total: {total_events} events in {wall_time_s:.2f} s "
+          f"({total_events / max(wall_time_s, 1e-9) / 1e6:.2f} Mev/s), "
+          f"{len(results) - num_failed} converted, {num_failed} failed, {len(skipped)} skipped")
+    return num_failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert all Metavision .hdf5/.raw sequences under a directory in parallel")
+    parser.add_argument("--input_dir", "-i", required=True, help="Directory containing one sub-directory per sequence")
+    parser.add_argument("--width", "-W", default=640, type=int, help="Image width")
+    parser.add_argument("--height", "-H", default=480, type=int, help="Image height")
+    parser.add_argument("--rotate", "-r", action="store_true", help="Apply 180-degree rotation")
+    parser.add_argument("--num_workers", "-j", default=os.cpu_count(), type=int, help="Number of parallel workers")
+    parser.add_argument("--slab_size", "-s", default=DEFAULT_SLAB_SIZE, type=int,
+                        help="Number of events read and written per slab (bounds peak memory per worker)")
+    parser.add_argument("--chunk_size", "-c", default=DEFAULT_H5_CHUNK_SIZE, type=int,
+                        help="HDF5 chunk length (in events) of the output datasets")
+    parser.add_argument("--force", "-f", action="store_true", help="Convert even if events.h5 is up to date")
+    add_codec_arguments(parser)
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+
+    options = dict(slab_size=args.slab_size, chunk_size=args.chunk_size, **filter_kwargs(args), **codec_kwargs(args))
+    sequences = find_sequences(args.input_dir)
+    skipped = [] if args.force else [s for s in sequences if is_up_to_date(s)]
+    tasks = [(s, args.width, args.height, args.rotate, options) for s in sequences if s not in skipped]
+    print(f"{len(tasks)} sequences to convert, {len(skipped)} up to date, {args.num_workers} workers")
+
+    start_time = time.perf_counter()
+    results = list()
+    if args.num_workers > 1 and len(tasks) > 1:
+        with get_context("spawn").Pool(min(args.num_workers, len(tasks))) as pool:
+            for result in pool.imap_unordered(_convert_sequence, tasks, chunksize=1):
+                results.append(result)
+    else:
+        for task in tasks:
+            results.append(_convert_sequence(task))
+    wall_time_s = time.perf_counter() - start_time
+
+    num_failed = print_summary(results, skipped, wall_time_s)
+    if num_failed > 0:
+        sys.exit(1)
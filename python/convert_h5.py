@@ -2,62 +2,300 @@ import h5py
 import glob
 import argparse
 import os
+import time
 import numpy as np
+try:
+    import hdf5plugin
+except ImportError:
+    pass
 
-def convert_hdf5(base_dir, W, H, rotate):
+from h5_codecs import CODECS, SHUFFLES, compression_opts
+from event_filters import BackgroundActivityFilter, accumulate_pixel_counts, detect_hot_pixels, hot_pixel_keep_mask
+from raw_decoder import get_geometry, iter_raw_slabs, read_header
+
+# 1スラブ(一度に読み込むイベント数)。ピークメモリはこの値だけで決まり、録画長には依存しない。
+DEFAULT_SLAB_SIZE = 2 ** 21
+# 出力データセット x/y/t/p のHDF5チャンク長(イベント数)
+DEFAULT_H5_CHUNK_SIZE = 2 ** 16
+
+
+class EventStreamWriter:
+    """
+    DSEC形式の events.h5 にイベントをスラブ単位で追記する。
+    出力データセットはリサイズ可能なチャンク付きデータセットとして作成される。
+
+    タイムスタンプは書き込み時に非減少となるよう補正され (以前は H5Reader._correct_time が毎回行っていた)、
+    finalize() で events グループに monotonic=True 属性が付与される。
+
+    DSECと同様に /ms_to_idx と /t_offset も書き込む。
+    t はラベルと同じ絶対時刻のまま保存するため t_offset は常に0 (DSECのように先頭時刻を引くことはしない)。
+    ms_to_idx[ms] は t が ms * 1000 以上となる最初のイベントのインデックス。
+    """
+    def __init__(self, h5f: h5py.File, chunk_size: int = DEFAULT_H5_CHUNK_SIZE,
+                 codec: str = "none", complevel: int = 1, shuffle: str = "byte"):
+        """
+        :param codec: x/y/t/p の圧縮コーデック (h5_codecs.CODECS)。C++ツールで読む場合はプラグインが必要なため既定は無圧縮。
+        :param shuffle: none / byte / bit (bitはbloscのみ)
+        """
+        self.grp = grp = h5f.create_group("events")
+        self.dsets = dict()
+        for name, dtype in (("x", "u2"), ("y", "u2"), ("t", "u8"), ("p", "u1")):
+            opts = compression_opts(codec=codec, complevel=complevel, shuffle=shuffle)
+            self.dsets[name] = grp.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                                  chunks=(chunk_size,), **opts)
+        self.ms_to_idx = h5f.create_dataset("ms_to_idx", shape=(0,), maxshape=(None,), dtype="u8",
+                                            chunks=(chunk_size,))
+        h5f.create_dataset("t_offset", data=0, dtype="i8")
+        self.num_events = 0
+        self.num_corrected_timestamps = 0
+        # 時刻補正・時刻インデックス作成用の状態
+        self.t_max = 0
+        self.next_ms = 0
+
+    def append(self, x: np.ndarray, y: np.ndarray, t: np.ndarray, p: np.ndarray):
+        if len(t) == 0:
+            return
+        self.append_corrected(x, y, self.correct_time(t), p)
+
+    def append_corrected(self, x: np.ndarray, y: np.ndarray, t: np.ndarray, p: np.ndarray):
+        """
+        correct_time() で補正済みのタイムスタンプのイベントを追記する。
+        補正後にフィルタで一部のイベントを除いてもよい (非減少のまま)。
+        """
+        num_new = len(t)
+        if num_new == 0:
+            return
+        new_size = self.num_events + num_new
+        for name, data in (("x", x), ("y", y), ("t", t), ("p", p)):
+            dset = self.dsets[name]
+            dset.resize((new_size,))
+            dset[self.num_events:new_size] = data
+        self._update_time_index(t)
+        self.num_events = new_size
+
+    def correct_time(self, t: np.ndarray) -> np.ndarray:
+        # 前のスラブまでの最大値も含めた累積最大値 (H5Reader._correct_time と同じ結果)
+        t_corrected = np.maximum.accumulate(np.maximum(t, np.uint64(self.t_max)))
+        self.num_corrected_timestamps += int(np.count_nonzero(t_corrected != t))
+        self.t_max = int(t_corrected[-1])
+        return t_corrected
+
+    def _update_time_index(self, t_sorted: np.ndarray):
+        last_ms = self.t_max // 1000
+        if last_ms < self.next_ms:
+            return
+        # next_ms以降のミリ秒境界は必ずこのスラブ内 (またはその直後) に位置する
+        ms_boundaries_us = np.arange(self.next_ms, last_ms + 1, dtype=np.uint64) * 1000
+        indices = self.num_events + np.searchsorted(t_sorted, ms_boundaries_us, side="left")
+        old_size = self.ms_to_idx.shape[0]
+        self.ms_to_idx.resize((old_size + len(indices),))
+        self.ms_to_idx[old_size:] = indices
+        self.next_ms = last_ms + 1
+
+    def finalize(self):
+        self.grp.attrs["monotonic"] = True
+        self.grp.attrs["num_corrected_timestamps"] = self.num_corrected_timestamps
+
+
+def iter_cd_slabs(dset_in: h5py.Dataset, slab_size: int):
+    """/CD/events をスラブ単位で読み込み、DSEC形式のdtypeに変換した (x, y, t, p) を返す。"""
+    num_events = dset_in.shape[0]
+    for start in range(0, num_events, slab_size):
+        data = dset_in[start:min(start + slab_size, num_events)]
+        yield (data["x"].astype(np.uint16),
+               data["y"].astype(np.uint16),
+               data["t"].astype(np.uint64),
+               data["p"].astype(np.uint8))
+
+
+def iter_hdf5_slabs(input_file: str, slab_size: int):
+    with h5py.File(input_file, "r") as f_in:
+        yield from iter_cd_slabs(f_in["/CD/events"], slab_size)
+
+
+def in_frame_mask(x: np.ndarray, y: np.ndarray, W: int, H: int) -> np.ndarray:
+    # センササイズ外のイベント (指定した W, H と入力の解像度が異なる場合など) は回転・マスク前に除外する
+    return (np.asarray(x, dtype=np.int64) < W) & (np.asarray(y, dtype=np.int64) < H)
+
+
+def rotate_180(x: np.ndarray, y: np.ndarray, W: int, H: int):
+    return (W - 1 - x).astype(np.uint16), (H - 1 - y).astype(np.uint16)
+
+
+def find_input_file(event_dir):
+    # eventsディレクトリ内の.hdf5ファイルを探索し、無ければ.rawファイルを直接デコードする
+    for ext in ("hdf5", "raw"):
+        input_files = glob.glob(os.path.join(event_dir, f"*.{ext}"))
+        if len(input_files) == 1:
+            return input_files[0]
+        if len(input_files) > 1:
+            print(f"Warning: Multiple {ext} files found:", input_files)
+            return None
+    print("No HDF5 or RAW file found in", event_dir)
+    return None
+
+
+def compute_hot_pixel_mask(make_slabs, W, H, rotate, num_sigmas, sample_size):
+    """
+    先頭 sample_size 個 (0なら全イベント) のイベントから画素ごとのイベント数を1回のbincountで数え、
+    外れ値の画素をホットピクセルとして検出する。
+    """
+    counts = np.zeros(H * W, dtype=np.int64)
+    num_sampled = 0
+    for x_data, y_data, t_data, p_data in make_slabs():
+        if sample_size > 0:
+            x_data, y_data = x_data[:sample_size - num_sampled], y_data[:sample_size - num_sampled]
+        num_sampled += len(x_data)
+        valid = in_frame_mask(x_data, y_data, W, H)
+        x_data, y_data = x_data[valid], y_data[valid]
+        if rotate:
+            x_data, y_data = rotate_180(x_data, y_data, W, H)
+        accumulate_pixel_counts(counts, x_data, y_data, W)
+        if 0 < sample_size <= num_sampled:
+            break
+    return detect_hot_pixels(counts, H, W, num_sigmas=num_sigmas)
+
+
+def add_codec_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--codec", default="none", choices=CODECS, help="Compression codec of the event columns")
+    parser.add_argument("--complevel", default=1, type=int, help="Compression level")
+    parser.add_argument("--shuffle", default="byte", choices=SHUFFLES, help="Shuffle filter (bit requires blosc)")
+
+
+def codec_kwargs(args: argparse.Namespace):
+    return dict(codec=args.codec, complevel=args.complevel, shuffle=args.shuffle)
+
+
+def add_filter_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--remove_hot_pixels", action="store_true", help="Detect hot pixels and drop their events")
+    parser.add_argument("--hot_pixel_sigmas", default=10.0, type=float,
+                        help="Hot pixel threshold: median + N robust standard deviations of the per-pixel count")
+    parser.add_argument("--hot_pixel_sample", default=0, type=int,
+                        help="Number of events used to detect hot pixels (0: whole recording, requires a second pass)")
+    parser.add_argument("--ba_filter_dt_us", default=None, type=int,
+                        help="Enable the background activity filter with this support time window [us]")
+    parser.add_argument("--ba_filter_radius", default=1, type=int, help="Neighborhood radius of the background activity filter")
+
+
+def filter_kwargs(args: argparse.Namespace):
+    return dict(hot_pixel_sigmas=args.hot_pixel_sigmas if args.remove_hot_pixels else None,
+                hot_pixel_sample=args.hot_pixel_sample,
+                ba_filter_dt_us=args.ba_filter_dt_us,
+                ba_filter_radius=args.ba_filter_radius)
+
+
+def convert_hdf5(base_dir, W, H, rotate, slab_size=DEFAULT_SLAB_SIZE, chunk_size=DEFAULT_H5_CHUNK_SIZE,
+                 hot_pixel_sigmas=None, hot_pixel_sample=0, ba_filter_dt_us=None, ba_filter_radius=1, **codec):
     event_dir = os.path.join(base_dir, "events")
 
-    # eventsディレクトリ内の.hdf5ファイルを探索
-    hdf5_files = glob.glob(os.path.join(event_dir, "*.hdf5"))
-    if len(hdf5_files) == 1:
-        input_file = hdf5_files[0]
-        print("Found HDF5 file:", input_file)
-    elif len(hdf5_files) > 1:
-        print("Warning: Multiple HDF5 files found:", hdf5_files)
-        return
+    input_file = find_input_file(event_dir)
+    if input_file is None:
+        return None
+
+    if input_file.endswith(".raw"):
+        # metavision_file_to_hdf5 を経由せず、.raw (EVT2/EVT3) を直接デコードする
+        print("Found RAW file:", input_file)
+        geometry = get_geometry(read_header(input_file)[0])
+        if geometry is not None and geometry != (W, H):
+            print(f"Warning: RAW geometry {geometry} differs from the given size {(W, H)}")
+        make_slabs = lambda: iter_raw_slabs(input_file, slab_size)
     else:
-        print("No HDF5 file found in", event_dir)
-        return
+        print("Found HDF5 file:", input_file)
+        with h5py.File(input_file, "r") as f_in:
+            if "/CD/events" not in f_in:
+                print("データセット /CD/events が見つかりません。")
+                return None
+        make_slabs = lambda: iter_hdf5_slabs(input_file, slab_size)
 
     output_file = os.path.join(event_dir,"events.h5")
+    # 中断時に壊れた events.h5 が残らないよう一時ファイルに書き込み、完了後に置き換える
+    tmp_file = output_file + ".tmp"
 
-    # HDF5ファイルを開く
-    with h5py.File(input_file, "r") as f_in, h5py.File(output_file, "w") as f_out:
-        if "/CD/events" in f_in:
-            dset_in = f_in["/CD/events"]
-            data = dset_in[:]
-
-            # MetavisionのデータをDSECフォーマットに変換
-            x_data = data["x"].astype(np.uint16)
-            y_data = data["y"].astype(np.uint16)
-            t_data = data["t"].astype(np.uint64)
-            p_data = data["p"].astype(np.uint8)
+    if rotate:
+        print("180度回転を適用します。")
+    else:
+        print("回転なしでコピーします。")
 
+    start_time = time.perf_counter()
+    hot_pixel_mask = None
+    if hot_pixel_sigmas is not None:
+        hot_pixel_mask, hot_pixel_stats = compute_hot_pixel_mask(make_slabs, W, H, rotate,
+                                                                 num_sigmas=hot_pixel_sigmas,
+                                                                 sample_size=hot_pixel_sample)
+        print(f"ホットピクセル: {hot_pixel_stats['num_hot_pixels']} pixels "
+              f"(threshold {hot_pixel_stats['threshold']:.1f} events, "
+              f"{100 * hot_pixel_stats['hot_event_fraction']:.1f}% of the sampled events)")
+    ba_filter = None
+    if ba_filter_dt_us is not None:
+        ba_filter = BackgroundActivityFilter(H, W, dt_us=ba_filter_dt_us, radius=ba_filter_radius)
+    num_input_events = 0
+    num_hot_pixel_events = 0
+    num_out_of_range_events = 0
+    with h5py.File(tmp_file, "w") as f_out:
+        # スラブごとにDSECフォーマットへ変換して追記
+        writer = EventStreamWriter(f_out, chunk_size=chunk_size, **codec)
+        for x_data, y_data, t_data, p_data in make_slabs():
+            num_input_events += len(t_data)
+            valid = in_frame_mask(x_data, y_data, W, H)
+            if not valid.all():
+                num_out_of_range_events += len(valid) - int(np.count_nonzero(valid))
+                x_data, y_data, t_data, p_data = x_data[valid], y_data[valid], t_data[valid], p_data[valid]
             if rotate:
-                x_data = W - 1 - x_data
-                y_data = H - 1 - y_data
-                print("180度回転を適用しました。")
-            else:
-                print("回転なしでコピーします。")
-
-            # DSEC形式に保存
-            grp = f_out.create_group("events")
-            grp.create_dataset("x", data=x_data, dtype="u2")
-            grp.create_dataset("y", data=y_data, dtype="u2")
-            grp.create_dataset("t", data=t_data, dtype="u8")
-            grp.create_dataset("p", data=p_data, dtype="u1")
-
-            
-            print("変換が完了しました。")
-        else:
-            print("データセット /CD/events が見つかりません。")
+                x_data, y_data = rotate_180(x_data, y_data, W, H)
+            if hot_pixel_mask is not None:
+                keep = hot_pixel_keep_mask(x_data, y_data, hot_pixel_mask)
+                num_hot_pixel_events += len(keep) - int(np.count_nonzero(keep))
+                x_data, y_data, t_data, p_data = x_data[keep], y_data[keep], t_data[keep], p_data[keep]
+            if len(t_data) == 0:
+                continue
+            # ノイズ除去は補正後のタイムスタンプで行う (時刻が戻ったイベントが誤ってサポートされないように)
+            t_data = writer.correct_time(t_data)
+            if ba_filter is not None:
+                # ホットピクセル除去後に適用 (ホットピクセルが近傍のサポートにならないように)
+                keep = ba_filter(x_data, y_data, t_data)
+                x_data, y_data, t_data, p_data = x_data[keep], y_data[keep], t_data[keep], p_data[keep]
+            writer.append_corrected(x_data, y_data, t_data, p_data)
+        writer.finalize()
+        num_events = writer.num_events
+        writer.grp.attrs["num_out_of_range_events"] = num_out_of_range_events
+        if num_out_of_range_events > 0:
+            print(f"Warning: センササイズ {(W, H)} 外のイベント {num_out_of_range_events} 個を除去しました")
+        if ba_filter is not None:
+            writer.grp.attrs["ba_filter_dt_us"] = ba_filter.dt_us
+            writer.grp.attrs["ba_filter_radius"] = ba_filter.radius
+            writer.grp.attrs["ba_filter_removed_events"] = ba_filter.num_events_in - ba_filter.num_events_kept
+            print(f"ノイズ除去 (BA filter): {ba_filter.num_events_in - ba_filter.num_events_kept} events "
+                  f"({100 * ba_filter.removed_fraction:.1f}%) を除去しました")
+        if hot_pixel_mask is not None:
+            hot_pixel_stats["num_removed_events"] = num_hot_pixel_events
+            dset = f_out.create_dataset("hot_pixel_mask", data=hot_pixel_mask.astype(np.uint8), dtype="u1")
+            for key, value in hot_pixel_stats.items():
+                dset.attrs[key] = value
+            dset.attrs["num_sigmas"] = hot_pixel_sigmas
+            dset.attrs["sample_size"] = hot_pixel_sample
+            print(f"ホットピクセルのイベントを除去しました: {hot_pixel_stats['num_removed_events']} events")
+    os.replace(tmp_file, output_file)
+    elapsed = time.perf_counter() - start_time
+
+    events_per_sec = num_input_events / max(elapsed, 1e-9)
+    print(f"タイムスタンプを補正したイベント数: {writer.num_corrected_timestamps}")
+    print(f"変換が完了しました。 {num_events} events, {elapsed:.2f} s, {events_per_sec / 1e6:.2f} Mev/s")
+    return dict(input_file=input_file, output_file=output_file, num_events=num_events, elapsed_s=elapsed)
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert Metavision .hdf5 to DSEC-compatible .h5")
+    parser = argparse.ArgumentParser(description="Convert Metavision .hdf5 (or EVT2/EVT3 .raw) to DSEC-compatible .h5")
     parser.add_argument("--base_dir", "-b", required=True, help="Path to the input directory")
     parser.add_argument("--width", "-W", default=640, type=int, help="Image width")
     parser.add_argument("--height", "-H", default=480, type=int, help="Image height")
     parser.add_argument("--rotate", "-r", required=False, type=bool, default=False, help="Apply 180-degree rotation")
+    parser.add_argument("--slab_size", "-s", default=DEFAULT_SLAB_SIZE, type=int,
+                        help="Number of events read and written per slab (bounds peak memory)")
+    parser.add_argument("--chunk_size", "-c", default=DEFAULT_H5_CHUNK_SIZE, type=int,
+                        help="HDF5 chunk length (in events) of the output datasets")
+    add_codec_arguments(parser)
+    add_filter_arguments(parser)
     args = parser.parse_args()
 
-    convert_hdf5(args.base_dir, args.width, args.height, args.rotate)
+    convert_hdf5(args.base_dir, args.width, args.height, args.rotate,
+                 slab_size=args.slab_size, chunk_size=args.chunk_size, **filter_kwargs(args), **codec_kwargs(args))
@@ -0,0 +1,430 @@
+"""
+Output stores of the event representations besides HDF5 (H5Writer of preprocess_rvt.py) and a loader for all formats.
+
+    h5:      event_representations.h5, dataset 'data' of shape (N, C, H, W).
+    npy:     event_representations.npy, uncompressed and memory-mappable. Dataset attributes (e.g. of the EventFrame
+             state encodings) are stored in event_representations.json next to it.
+    chunked: event_representations.chunks/, a directory of chunk files of frames_per_chunk frames each
+             (<chunk index>.bin, compressed with zlib or raw) and index.json holding the shape, dtype, chunking,
+             codec and attributes. Chunks are independent files: readers neither share a handle nor a global lock.
+
+The writers have the interface of H5Writer (context manager, add_data, add_data_batch, get_current_length, flush,
+close) and its checkpoints: with a checkpoint_id, the high-water mark of the written frames is recorded in a json
+file (npy: <file>.checkpoint, chunked: checkpoint.json in the directory) and an existing output with the same id is
+resumed from there. Readers return views without copies where the format allows it (npy and raw chunks are
+memory-mapped).
+Parts holding consecutive frames (sequence shards of preprocess_rvt.py) are concatenated by merge_npy_files and
+merge_chunked_dirs.
+"""
+
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+import zlib
+
+import numpy as np
+
+OUTPUT_FORMATS = ('h5', 'npy', 'chunked')
+CHUNK_CODECS = ('none', 'gzip')
+CHUNK_SHUFFLES = ('none', 'byte')
+CHUNKED_INDEX_FILE = 'index.json'
+CHUNKED_CHECKPOINT_FILE = 'checkpoint.json'
+
+
+def output_suffix(output_format: str) -> str:
+    assert output_format in OUTPUT_FORMATS, f'{output_format=}'
+    return {'h5': '.h5', 'npy': '.npy', 'chunked': '.chunks'}[output_format]
+
+
+def npy_checkpoint_file(outfile: Path) -> Path:
+    return outfile.parent / (outfile.name + '.checkpoint')
+
+
+def _write_json_atomic(path: Path, content: Dict[str, Any]):
+    path_tmp = path.parent / (path.name + '.tmp')
+    with open(path_tmp, 'w') as f:
+        json.dump(content, f)
+    os.replace(path_tmp, path)
+
+
+def _read_checkpoint(path: Path, checkpoint_id: str) -> Optional[Dict[str, Any]]:
+    """:return: The checkpoint if it exists and was written with checkpoint_id, else None."""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return checkpoint if checkpoint.get('checkpoint_id') == checkpoint_id else None
+
+
+def _attrs_to_json(attrs: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return {key: value.item() if isinstance(value, np.generic) else value for key, value in (attrs or dict()).items()}
+
+
+class NpyWriter:
+    """Writes the representations into a preallocated, memory-mapped .npy file (uncompressed)."""
+    def __init__(self, outfile: Path, ev_repr_shape: Tuple, numpy_dtype: np.dtype, num_frames: int,
+                 attrs: Optional[Dict[str, Any]] = None, checkpoint_id: Optional[str] = None,
+                 checkpoint_interval_s: float = 60):
+        assert len(ev_repr_shape) == 3
+        assert num_frames is not None, 'the number of frames must be known in advance'
+        self.outfile = outfile
+        self.numpy_dtype = numpy_dtype
+        self.attrs = attrs
+        self.t_idx = 0
+        self.checkpoint_id = checkpoint_id
+        self.checkpoint_interval_s = checkpoint_interval_s
+        self.t_checkpoint = time.perf_counter()
+        shape = (num_frames,) + tuple(ev_repr_shape)
+        checkpoint = None
+        if checkpoint_id is not None and outfile.exists():
+            checkpoint = _read_checkpoint(npy_checkpoint_file(outfile), checkpoint_id)
+        if checkpoint is not None:
+            self.data = np.lib.format.open_memmap(str(outfile), mode='r+')
+            if self.data.shape == shape and self.data.dtype == numpy_dtype:
+                self.t_idx = checkpoint['num_frames']
+                return
+        self.data = np.lib.format.open_memmap(str(outfile), mode='w+', dtype=numpy_dtype, shape=shape)
+        if checkpoint_id is not None:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.data.flush()
+        _write_json_atomic(npy_checkpoint_file(self.outfile), dict(checkpoint_id=self.checkpoint_id,
+                                                                   num_frames=self.t_idx))
+        self.t_checkpoint = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.data = None
+
+    def get_current_length(self):
+        return self.t_idx
+
+    def add_data(self, data: np.ndarray):
+        self.add_data_batch(data[None])
+
+    def add_data_batch(self, data: np.ndarray):
+        assert data.dtype == self.numpy_dtype, f'{data.dtype=}, {self.numpy_dtype=}'
+        assert data.shape[1:] == self.data.shape[1:]
+        new_size = self.t_idx + len(data)
+        assert new_size <= len(self.data)
+        self.data[self.t_idx:new_size] = data
+        self.t_idx = new_size
+        if self.checkpoint_id is not None and time.perf_counter() - self.t_checkpoint >= self.checkpoint_interval_s:
+            self.checkpoint()
+
+    def flush(self):
+        self.data.flush()
+
+    def close(self):
+        if self.data is None:
+            return
+        assert self.t_idx == len(self.data), f'{self.t_idx=}, {len(self.data)=}'
+        self.flush()
+        self.data = None
+        if self.attrs is not None:
+            with open(self.outfile.with_suffix('.json'), 'w') as f:
+                json.dump(_attrs_to_json(self.attrs), f)
+        if npy_checkpoint_file(self.outfile).exists():
+            os.remove(npy_checkpoint_file(self.outfile))
+
+
+class ChunkedDirWriter:
+    """Writes the representations as one file per chunk of frames_per_chunk frames plus an index (index.json)."""
+    def __init__(self, outdir: Path, ev_repr_shape: Tuple, numpy_dtype: np.dtype,
+                 attrs: Optional[Dict[str, Any]] = None, num_frames: Optional[int] = None,
+                 frames_per_chunk: int = 1, buffer_frames: int = 8, codec: str = 'gzip', complevel: int = 1,
+                 shuffle: str = 'byte', checkpoint_id: Optional[str] = None, checkpoint_interval_s: float = 60):
+        """
+        :param codec: one of CHUNK_CODECS ('gzip' is zlib/deflate as for HDF5, 'none' chunks are memory-mappable).
+        :param shuffle: 'byte' groups the bytes of multi-byte dtypes before compression, or 'none'.
+        :param buffer_frames, num_frames: Only for compatibility with H5Writer, every chunk is written when full.
+        """
+        assert len(ev_repr_shape) == 3
+        assert frames_per_chunk > 0
+        if codec not in CHUNK_CODECS:
+            raise ValueError(f'codec {codec} is not supported by the chunked store, use one of {CHUNK_CODECS}')
+        if shuffle not in CHUNK_SHUFFLES:
+            raise ValueError(f'shuffle {shuffle} is not supported by the chunked store, use one of {CHUNK_SHUFFLES}')
+        checkpoint = None
+        if checkpoint_id is not None and outdir.is_dir():
+            checkpoint = _read_checkpoint(outdir / CHUNKED_CHECKPOINT_FILE, checkpoint_id)
+        if checkpoint is None and outdir.is_dir():
+            shutil.rmtree(outdir)
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir = outdir
+        self.ev_repr_shape = tuple(ev_repr_shape)
+        self.numpy_dtype = np.dtype(numpy_dtype)
+        self.attrs = attrs
+        self.frames_per_chunk = frames_per_chunk
+        self.codec = codec
+        self.complevel = complevel
+        self.shuffle = shuffle if self.numpy_dtype.itemsize > 1 else 'none'
+        self.buffer = np.empty((frames_per_chunk,) + self.ev_repr_shape, dtype=self.numpy_dtype)
+        self.num_buffered = 0
+        self.num_chunks = 0
+        self.t_idx = 0
+        self.is_closed = False
+        self.checkpoint_id = checkpoint_id
+        self.checkpoint_interval_s = checkpoint_interval_s
+        self.t_checkpoint = time.perf_counter()
+        if checkpoint is not None:
+            # Chunks after the checkpoint are overwritten.
+            self.num_chunks = checkpoint['num_chunks']
+            self.t_idx = self.num_chunks * frames_per_chunk
+        elif checkpoint_id is not None:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Only complete chunks are recorded, the buffered frames are written again after resuming.
+        _write_json_atomic(self.outdir / CHUNKED_CHECKPOINT_FILE, dict(checkpoint_id=self.checkpoint_id,
+                                                                       num_chunks=self.num_chunks))
+        self.t_checkpoint = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def get_current_length(self):
+        return self.t_idx + self.num_buffered
+
+    def _write_chunk(self, data: np.ndarray):
+        num_frames = len(data)
+        data = np.ascontiguousarray(data)
+        if self.shuffle == 'byte':
+            data = data.view(np.uint8).reshape(-1, self.numpy_dtype.itemsize).T
+        payload = data.tobytes()
+        if self.codec == 'gzip':
+            payload = zlib.compress(payload, self.complevel)
+        with open(self.outdir / f'{self.num_chunks:06d}.bin', 'wb') as f:
+            f.write(payload)
+        self.num_chunks += 1
+        if self.checkpoint_id is not None and num_frames == self.frames_per_chunk and \
+                time.perf_counter() - self.t_checkpoint >= self.checkpoint_interval_s:
+            self.checkpoint()
+
+    def add_data(self, data: np.ndarray):
+        self.add_data_batch(data[None])
+
+    def add_data_batch(self, data: np.ndarray):
+        assert data.dtype == self.numpy_dtype, f'{data.dtype=}, {self.numpy_dtype=}'
+        assert data.shape[1:] == self.ev_repr_shape
+        idx = 0
+        while idx < len(data):
+            if self.num_buffered == 0 and len(data) - idx >= self.frames_per_chunk:
+                # whole chunks are written directly
+                self._write_chunk(data[idx:idx + self.frames_per_chunk])
+                self.t_idx += self.frames_per_chunk
+                idx += self.frames_per_chunk
+                continue
+            num_copy = min(len(data) - idx, self.frames_per_chunk - self.num_buffered)
+            self.buffer[self.num_buffered:self.num_buffered + num_copy] = data[idx:idx + num_copy]
+            self.num_buffered += num_copy
+            idx += num_copy
+            if self.num_buffered == self.frames_per_chunk:
+                self._write_chunk(self.buffer)
+                self.t_idx += self.num_buffered
+                self.num_buffered = 0
+
+    def flush(self):
+        # Called at the end (close): the last chunk may be partial.
+        if self.num_buffered > 0:
+            self._write_chunk(self.buffer[:self.num_buffered])
+            self.t_idx += self.num_buffered
+            self.num_buffered = 0
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.flush()
+        index = dict(shape=[self.t_idx] + list(self.ev_repr_shape),
+                     dtype=self.numpy_dtype.str,
+                     frames_per_chunk=self.frames_per_chunk,
+                     num_chunks=self.num_chunks,
+                     codec=self.codec,
+                     shuffle=self.shuffle,
+                     attrs=_attrs_to_json(self.attrs))
+        # The index is written last: a directory with an index is complete.
+        with open(self.outdir / CHUNKED_INDEX_FILE, 'w') as f:
+            json.dump(index, f, indent=1)
+        if (self.outdir / CHUNKED_CHECKPOINT_FILE).exists():
+            os.remove(self.outdir / CHUNKED_CHECKPOINT_FILE)
+        self.is_closed = True
+
+
+class ChunkedDirReader:
+    """Random access to a chunked directory store. Raw chunks are memory-mapped, compressed chunks decompressed."""
+    def __init__(self, path: Path):
+        with open(path / CHUNKED_INDEX_FILE) as f:
+            index = json.load(f)
+        self.path = path
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.frames_per_chunk = index['frames_per_chunk']
+        self.num_chunks = index['num_chunks']
+        self.codec = index['codec']
+        self.shuffle = index['shuffle']
+        self.attrs = index['attrs']
+        self._chunk_cache_idx = None
+        self._chunk_cache = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _num_frames_of_chunk(self, chunk_idx: int) -> int:
+        return min(self.frames_per_chunk, self.shape[0] - chunk_idx * self.frames_per_chunk)
+
+    def get_chunk(self, chunk_idx: int) -> np.ndarray:
+        """(frames, C, H, W) of a chunk: a read-only memory map (codec 'none') or the decompressed buffer."""
+        if chunk_idx == self._chunk_cache_idx:
+            return self._chunk_cache
+        shape = (self._num_frames_of_chunk(chunk_idx),) + self.shape[1:]
+        chunk_file = self.path / f'{chunk_idx:06d}.bin'
+        if self.codec == 'none' and self.shuffle == 'none':
+            chunk = np.memmap(chunk_file, dtype=self.dtype, mode='r', shape=shape)
+        else:
+            with open(chunk_file, 'rb') as f:
+                payload = f.read()
+            if self.codec == 'gzip':
+                payload = zlib.decompress(payload)
+            chunk = np.frombuffer(payload, dtype=np.uint8)
+            if self.shuffle == 'byte':
+                chunk = chunk.reshape(self.dtype.itemsize, -1).T.copy()
+            chunk = chunk.view(self.dtype).reshape(shape)
+        self._chunk_cache_idx = chunk_idx
+        self._chunk_cache = chunk
+        return chunk
+
+    def __getitem__(self, item: Union[int, slice]) -> np.ndarray:
+        if isinstance(item, slice):
+            idx_start, idx_end, step = item.indices(len(self))
+            assert step == 1
+            if idx_end <= idx_start:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            chunk_first = idx_start // self.frames_per_chunk
+            chunk_last = (idx_end - 1) // self.frames_per_chunk
+            parts = [self.get_chunk(chunk_idx)[max(idx_start - chunk_idx * self.frames_per_chunk, 0):
+                                               idx_end - chunk_idx * self.frames_per_chunk]
+                     for chunk_idx in range(chunk_first, chunk_last + 1)]
+            # Views if the frames are within a single chunk.
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+        idx = int(item)
+        if idx < 0:
+            idx += len(self)
+        assert 0 <= idx < len(self)
+        return self.get_chunk(idx // self.frames_per_chunk)[idx % self.frames_per_chunk]
+
+
+class H5ReprReader:
+    """Random access to event_representations.h5 (one handle per reader)."""
+    def __init__(self, path: Path, key: str = 'data'):
+        import h5py
+        try:
+            import hdf5plugin
+        except ImportError:
+            pass
+        self.h5f = h5py.File(str(path), 'r')
+        self.data = self.h5f[key]
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+        self.attrs = dict(self.data.attrs)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item: Union[int, slice]) -> np.ndarray:
+        return self.data[item]
+
+
+class NpyReader:
+    """Random access to event_representations.npy through a read-only memory map (slices are views)."""
+    def __init__(self, path: Path):
+        self.data = np.load(str(path), mmap_mode='r')
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+        attrs_file = path.with_suffix('.json')
+        self.attrs = dict()
+        if attrs_file.exists():
+            with open(attrs_file) as f:
+                self.attrs = json.load(f)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item: Union[int, slice]) -> np.ndarray:
+        return self.data[item]
+
+
+def open_ev_repr(path: Path) -> Union[H5ReprReader, NpyReader, ChunkedDirReader]:
+    """
+    Opens event representations written in any of OUTPUT_FORMATS. The reader supports len(), indexing with an int
+    or a slice (N, C, H, W) and has the attributes shape, dtype and attrs.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return ChunkedDirReader(path)
+    if path.suffix == '.npy':
+        return NpyReader(path)
+    assert path.suffix in ('.h5', '.hdf5'), f'{path=}'
+    return H5ReprReader(path)
+
+
+def merge_npy_files(part_files: List[Path], outfile: Path):
+    """Concatenates .npy files of consecutive frames. The attributes (.json) are taken from the first part."""
+    parts = [np.load(str(part_file), mmap_mode='r') for part_file in part_files]
+    assert len({(part.shape[1:], part.dtype) for part in parts}) == 1
+    data = np.lib.format.open_memmap(str(outfile), mode='w+', dtype=parts[0].dtype,
+                                     shape=(sum(len(part) for part in parts),) + parts[0].shape[1:])
+    t_idx = 0
+    for part in parts:
+        data[t_idx:t_idx + len(part)] = part
+        t_idx += len(part)
+    data.flush()
+    del data
+    attrs_file = part_files[0].with_suffix('.json')
+    if attrs_file.exists():
+        shutil.copyfile(attrs_file, outfile.with_suffix('.json'))
+
+
+def merge_chunked_dirs(part_dirs: List[Path], outdir: Path):
+    """
+    Concatenates chunked directory stores of consecutive frames. The chunk files are hard-linked (copied if links
+    are not supported), which requires the same chunking and whole chunks in all but the last part.
+    """
+    indices = list()
+    for part_dir in part_dirs:
+        with open(part_dir / CHUNKED_INDEX_FILE) as f:
+            indices.append(json.load(f))
+    keys = ('dtype', 'frames_per_chunk', 'codec', 'shuffle')
+    if len({tuple(index[key] for key in keys) + tuple(index['shape'][1:]) for index in indices}) != 1:
+        raise ValueError(f'parts {part_dirs} differ in shape, dtype or chunking')
+    frames_per_chunk = indices[0]['frames_per_chunk']
+    if any(index['shape'][0] % frames_per_chunk != 0 for index in indices[:-1]):
+        raise ValueError(f'parts {part_dirs} are not aligned to chunks of {frames_per_chunk} frames')
+    os.makedirs(outdir, exist_ok=True)
+    num_chunks = 0
+    for part_dir, index in zip(part_dirs, indices):
+        for chunk_idx in range(index['num_chunks']):
+            chunk_file = outdir / f'{num_chunks:06d}.bin'
+            try:
+                os.link(part_dir / f'{chunk_idx:06d}.bin', chunk_file)
+            except OSError:
+                shutil.copyfile(part_dir / f'{chunk_idx:06d}.bin', chunk_file)
+            num_chunks += 1
+    index = dict(indices[0],
+                 shape=[sum(index['shape'][0] for index in indices)] + indices[0]['shape'][1:],
+                 num_chunks=num_chunks)
+    with open(outdir / CHUNKED_INDEX_FILE, 'w') as f:
+        json.dump(index, f, indent=1)
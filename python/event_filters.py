@@ -0,0 +1,114 @@
+"""
+Event stream filters used during conversion (convert_h5.py) and optionally when reading windows (preprocess_rvt.py).
+"""
+
+from typing import Dict, Tuple
+
+from numba import jit
+import numpy as np
+
+
+def accumulate_pixel_counts(counts: np.ndarray, x: np.ndarray, y: np.ndarray, width: int):
+    """Adds the number of events per pixel to counts (flattened (height * width) int64 array) in-place."""
+    counts += np.bincount(np.asarray(y, dtype=np.int64) * width + x, minlength=len(counts))
+
+
+def detect_hot_pixels(counts: np.ndarray, height: int, width: int,
+                      num_sigmas: float = 10.0, min_count: int = 10) -> Tuple[np.ndarray, Dict]:
+    """
+    Flags pixels whose event count is an outlier w.r.t. the other active pixels.
+    The threshold is median + num_sigmas * (robust std estimated from the median absolute deviation).
+    :param counts: flattened per-pixel event counts.
+    :param min_count: pixels with less events are never flagged.
+    :return: hot pixel mask of shape (height, width) and statistics.
+    """
+    assert counts.shape == (height * width,)
+    active = counts[counts > 0]
+    if len(active) == 0:
+        return np.zeros((height, width), dtype=bool), dict(threshold=0.0, num_hot_pixels=0, sampled_events=0,
+                                                          hot_event_fraction=0.0)
+    median = float(np.median(active))
+    robust_std = 1.4826 * float(np.median(np.abs(active - median)))
+    threshold = max(median + num_sigmas * max(robust_std, 1.0), float(min_count))
+    hot = counts > threshold
+    sampled_events = int(counts.sum())
+    stats = dict(threshold=threshold,
+                 num_hot_pixels=int(hot.sum()),
+                 sampled_events=sampled_events,
+                 hot_event_fraction=float(counts[hot].sum()) / sampled_events)
+    return hot.reshape(height, width), stats
+
+
+def hot_pixel_keep_mask(x: np.ndarray, y: np.ndarray, hot_pixel_mask: np.ndarray) -> np.ndarray:
+    """:return: boolean mask of the events that are not on a hot pixel (events outside of the mask are dropped)."""
+    height, width = hot_pixel_mask.shape
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    in_frame = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    keep = np.zeros(len(x), dtype=bool)
+    keep[in_frame] = ~hot_pixel_mask[y[in_frame], x[in_frame]]
+    return keep
+
+
+@jit(nopython=True)
+def _background_activity_filter(x, y, t, last_ts, dt_us, radius, keep):
+    # numba does not check the array bounds: events outside of the frame are dropped (and counted).
+    height, width = last_ts.shape
+    num_out_of_range = 0
+    for idx in range(len(t)):
+        x_ev = np.int64(x[idx])
+        y_ev = np.int64(y[idx])
+        t_ev = np.int64(t[idx])
+        if x_ev < 0 or x_ev >= width or y_ev < 0 or y_ev >= height:
+            keep[idx] = False
+            num_out_of_range += 1
+            continue
+        supported = False
+        for y_nb in range(max(y_ev - radius, 0), min(y_ev + radius + 1, height)):
+            for x_nb in range(max(x_ev - radius, 0), min(x_ev + radius + 1, width)):
+                if y_nb == y_ev and x_nb == x_ev:
+                    continue
+                if t_ev - last_ts[y_nb, x_nb] <= dt_us:
+                    supported = True
+                    break
+            if supported:
+                break
+        keep[idx] = supported
+        last_ts[y_ev, x_ev] = t_ev
+    return num_out_of_range
+
+
+class BackgroundActivityFilter:
+    """
+    Spatiotemporal background activity filter.
+    Keeps an event only if one of the pixels in its (2 * radius + 1)^2 neighborhood (excluding itself) had an event
+    within the last dt_us microseconds. The last timestamp per pixel is kept between calls such that a stream can be
+    filtered slab by slab. Call reset() before filtering an unrelated part of the stream.
+    The timestamps must be non-decreasing (corrected), events outside of the frame are dropped.
+    """
+    def __init__(self, height: int, width: int, dt_us: int, radius: int = 1):
+        assert dt_us > 0
+        assert radius >= 1
+        self.dt_us = int(dt_us)
+        self.radius = int(radius)
+        self.last_ts = np.empty((height, width), dtype=np.int64)
+        self.reset()
+        self.num_events_in = 0
+        self.num_events_kept = 0
+        self.num_events_out_of_range = 0
+
+    def reset(self):
+        self.last_ts.fill(np.iinfo(np.int64).min // 2)
+
+    def __call__(self, x: np.ndarray, y: np.ndarray, t: np.ndarray) -> np.ndarray:
+        """:return: boolean mask of the events to keep."""
+        keep = np.empty(len(t), dtype=np.bool_)
+        self.num_events_out_of_range += _background_activity_filter(x, y, t, self.last_ts, self.dt_us, self.radius,
+                                                                    keep)
+        self.num_events_in += len(t)
+        self.num_events_kept += int(np.count_nonzero(keep))
+        return keep
+
+    @property
+    def removed_fraction(self) -> float:
+        return 1 - self.num_events_kept / max(self.num_events_in, 1)
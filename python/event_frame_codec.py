@@ -0,0 +1,98 @@
+"""
+Storage encodings of EventFrame outputs and their (NumPy only) decoder for the loading side.
+
+Every pixel of an event frame is in one of three states: background, ON or OFF. Besides the RGB frame, the states
+can be stored directly:
+    rgb:    (3, H, W) uint8 RGB frame (background gray, ON red, OFF blue). Original format.
+    state:  (1, H, W) uint8 state map (FRAME_STATE_*).
+    packed: (1, H, ceil(W / 4)) uint8, 2 bits per pixel: the state of pixel x is in bits 2 * (x % 4) of byte x // 4.
+The h5 dataset of the state encodings holds the attributes 'encoding', 'width' and 'background_color'.
+"""
+
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+EVENT_FRAME_BACKGROUND = 114
+
+EVENT_FRAME_ENCODINGS = ('rgb', 'state', 'packed')
+
+# Pixel states, index into the color table: background, ON, OFF.
+FRAME_STATE_BACKGROUND = 0
+FRAME_STATE_ON = 1
+FRAME_STATE_OFF = 2
+
+_PACK_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+
+def event_frame_colors(background_color: int, encoding: str = 'rgb') -> np.ndarray:
+    """
+    :return: (channels, 3 states) uint8 table of the values written for each state.
+             rgb: (3, 3) colors: background gray, ON red and OFF blue. state encodings: (1, 3) the state itself.
+    """
+    assert encoding in EVENT_FRAME_ENCODINGS, f'{encoding=}'
+    if encoding != 'rgb':
+        return np.array([[FRAME_STATE_BACKGROUND, FRAME_STATE_ON, FRAME_STATE_OFF]], dtype=np.uint8)
+    return np.array([[background_color, 255, 0],
+                     [background_color, 0, 0],
+                     [background_color, 0, 255]], dtype=np.uint8)
+
+
+def packed_shape(state_shape: Tuple[int, ...]) -> Tuple[int, ...]:
+    """Shape of pack_states(states) for states of shape state_shape."""
+    return tuple(state_shape[:-1]) + ((state_shape[-1] + 3) // 4,)
+
+
+def pack_states(states: np.ndarray) -> np.ndarray:
+    """(..., W) uint8 states -> (..., ceil(W / 4)) uint8 with 4 pixels per byte."""
+    pad = -states.shape[-1] % 4
+    if pad > 0:
+        states = np.pad(states, [(0, 0)] * (states.ndim - 1) + [(0, pad)])
+    states = states.reshape(states.shape[:-1] + (-1, 4))
+    return states[..., 0] | (states[..., 1] << 2) | (states[..., 2] << 4) | (states[..., 3] << 6)
+
+
+def unpack_states(packed: np.ndarray, width: int) -> np.ndarray:
+    """(..., ceil(W / 4)) uint8 -> (..., W) uint8 states."""
+    assert packed.shape[-1] == (width + 3) // 4
+    states = (packed[..., None] >> _PACK_SHIFTS) & 3
+    return states.reshape(packed.shape[:-1] + (-1,))[..., :width]
+
+
+def states_to_rgb(states: np.ndarray, background_color: int = EVENT_FRAME_BACKGROUND) -> np.ndarray:
+    """(N, 1, H, W) states -> (N, 3, H, W) RGB frames as written by EventFrame."""
+    assert states.ndim == 4 and states.shape[1] == 1
+    colors = event_frame_colors(background_color)
+    return np.stack([colors[ch][states[:, 0]] for ch in range(3)], axis=1)
+
+
+def storage_attrs(encoding: str, width: int, background_color: int) -> Dict[str, Any]:
+    """h5 dataset attributes required to decode frames of the state encodings."""
+    assert encoding in EVENT_FRAME_ENCODINGS, f'{encoding=}'
+    return dict(encoding=encoding, width=width, background_color=background_color)
+
+
+def decode_event_frames(data: np.ndarray, attrs: Dict[str, Any], output: str = 'rgb') -> np.ndarray:
+    """
+    :param data: (N, C, H, W') frames as stored.
+    :param attrs: attributes of the h5 dataset (empty for the rgb encoding).
+    :param output: 'rgb' for (N, 3, H, W) RGB frames or 'state' for (N, 1, H, W) state maps.
+    """
+    assert output in ('rgb', 'state'), f'{output=}'
+    encoding = attrs.get('encoding', 'rgb')
+    assert encoding in EVENT_FRAME_ENCODINGS, f'{encoding=}'
+    if encoding == 'rgb':
+        assert output == 'rgb', 'the states of rgb frames are not stored'
+        return data
+    states = unpack_states(data, int(attrs['width'])) if encoding == 'packed' else data
+    if output == 'state':
+        return states
+    return states_to_rgb(states, int(attrs['background_color']))
+
+
+def read_event_frames(path: Path, idx_start: int, idx_end: int, output: str = 'rgb') -> np.ndarray:
+    """Reads and decodes the event frames [idx_start, idx_end) of event representations in any output format."""
+    from ev_repr_store import open_ev_repr
+    ev_repr = open_ev_repr(path)
+    return decode_event_frames(ev_repr[idx_start:idx_end], ev_repr.attrs, output=output)
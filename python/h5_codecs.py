@@ -0,0 +1,42 @@
+"""
+HDF5 compression settings shared by convert_h5.py and preprocess_rvt.py.
+
+Blosc based filters require hdf5plugin to be imported before the datasets are created or read.
+"""
+
+BLOSC_COMPRESSORS = ['blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib', 'zstd']
+CODECS = ['none', 'gzip', 'lzf'] + ['blosc:' + c for c in BLOSC_COMPRESSORS]
+SHUFFLES = ['none', 'byte', 'bit']
+
+
+def blosc_opts(complevel=1, complib='blosc:zstd', shuffle='byte'):
+    shuffle = 2 if shuffle == 'bit' else 1 if shuffle == 'byte' else 0
+    complib = ['blosc:' + c for c in BLOSC_COMPRESSORS].index(complib)
+    args = {
+        'compression': 32001,
+        'compression_opts': (0, 0, 0, 0, complevel, shuffle, complib),
+    }
+    if shuffle > 0:
+        # Do not use h5py shuffle if blosc shuffle is enabled.
+        args['shuffle'] = False
+    return args
+
+
+def compression_opts(codec='none', complevel=1, shuffle='byte'):
+    """
+    Keyword arguments for h5py create_dataset.
+    :param codec: one of CODECS.
+    :param complevel: compression level (ignored for lzf).
+    :param shuffle: one of SHUFFLES. Bit shuffle is only available for blosc codecs.
+    """
+    assert codec in CODECS, f'{codec=}'
+    assert shuffle in SHUFFLES, f'{shuffle=}'
+    if codec.startswith('blosc:'):
+        return blosc_opts(complevel=complevel, complib=codec, shuffle=shuffle)
+    assert shuffle != 'bit', 'bit shuffle requires a blosc codec'
+    if codec == 'none':
+        return dict()
+    args = {'compression': codec, 'shuffle': shuffle == 'byte'}
+    if codec == 'gzip':
+        args['compression_opts'] = complevel
+    return args
@@ -0,0 +1,192 @@
+"""
+Incremental construction of count-type event representations over sliding windows.
+
+For windows [idx_start, idx_end) whose start and end indices never decrease (DURATION and COUNT extraction),
+consecutive windows share most events if they overlap. Instead of rebuilding each window, a running per pixel state
+is updated with the events that enter (added) and leave (removed) the window, and only the pixels touched by these
+events are re-rendered. Every event is read once and processed twice (once in, once out) regardless of the overlap.
+
+Supported are representations that only depend on per pixel and polarity counts (and the polarity of the last
+event), i.e. StackedHistogram with a single bin and EventFrame.
+"""
+
+from abc import ABC, abstractmethod
+import collections
+from typing import Tuple
+
+from numba import jit
+import numpy as np
+
+from event_frame_codec import FRAME_STATE_BACKGROUND, FRAME_STATE_OFF, FRAME_STATE_ON, event_frame_colors
+from representations_numba import EVENT_FRAME_POLICIES
+
+
+@jit(nopython=True, cache=True)
+def _update_counts(x, y, pol, sign, shift, height, width, clip, counts, last_pol):
+    # counts: (2, height_out * width_out) int32 (0: OFF, 1: ON), last_pol: (height_out * width_out,) uint8
+    height_out = height >> shift
+    width_out = width >> shift
+    for idx in range(len(x)):
+        p_ev = pol[idx]
+        if p_ev != 0 and p_ev != 1:
+            continue
+        x_ev = np.int64(x[idx])
+        y_ev = np.int64(y[idx])
+        if clip:
+            x_ev = min(max(x_ev, 0) >> shift, width_out - 1)
+            y_ev = min(max(y_ev, 0) >> shift, height_out - 1)
+        pixel = x_ev + width_out * y_ev
+        counts[p_ev, pixel] += sign
+        if sign > 0:
+            # Events are added in time order: the last added event is the last event in the window.
+            last_pol[pixel] = p_ev
+
+
+@jit(nopython=True, cache=True)
+def _render_histogram(x, y, width, counts, count_cutoff, fastmode, out):
+    # out: (2, height * width) uint8
+    for idx in range(len(x)):
+        pixel = np.int64(x[idx]) + width * np.int64(y[idx])
+        for p_ev in range(2):
+            count = counts[p_ev, pixel]
+            if fastmode:
+                # uint8 accumulation wraps around
+                value = count & 0xFF
+            else:
+                # int16 accumulation wraps around, negative values are clipped to 0
+                value = ((count + 32768) & 0xFFFF) - 32768
+                value = max(value, 0)
+            out[p_ev, pixel] = min(value, count_cutoff)
+
+
+@jit(nopython=True, cache=True)
+def _render_event_frame(x, y, pol, shift, height, width, policy, min_count, colors, counts, last_pol, out):
+    # out: (C, height_out * width_out) uint8, colors: (C, 3 states)
+    height_out = height >> shift
+    width_out = width >> shift
+    for idx in range(len(x)):
+        p_ev = pol[idx]
+        if p_ev != 0 and p_ev != 1:
+            continue
+        x_ev = min(max(np.int64(x[idx]), 0) >> shift, width_out - 1)
+        y_ev = min(max(np.int64(y[idx]), 0) >> shift, height_out - 1)
+        pixel = x_ev + width_out * y_ev
+        off = counts[0, pixel]
+        on = counts[1, pixel]
+        last_state = FRAME_STATE_ON if last_pol[pixel] == 1 else FRAME_STATE_OFF
+        if on == 0 and off == 0:
+            state = FRAME_STATE_BACKGROUND
+        elif policy == 0:
+            state = FRAME_STATE_OFF if off > 0 else FRAME_STATE_ON
+        elif policy == 1:
+            state = last_state
+        else:
+            state = FRAME_STATE_ON if on > off else FRAME_STATE_OFF if off > on else last_state
+            if policy == 3 and on + off < min_count:
+                state = FRAME_STATE_BACKGROUND
+        for ch in range(colors.shape[0]):
+            out[ch, pixel] = colors[ch, state]
+
+
+class IncrementalRepresentation(ABC):
+    """
+    Running state of a sliding window. Call update() with the events entering the window, in window order,
+    and get the representation of the current window.
+    """
+    def __init__(self, shape: Tuple[int, int, int], numpy_dtype: np.dtype, height: int, width: int, shift: int):
+        self.shape = shape
+        self.numpy_dtype = numpy_dtype
+        self.height = height
+        self.width = width
+        self.shift = shift
+        num_pixels = (height >> shift) * (width >> shift)
+        self.counts = np.zeros((2, num_pixels), dtype=np.int32)
+        self.last_pol = np.zeros(num_pixels, dtype=np.uint8)
+        self.output = np.zeros(shape, dtype=numpy_dtype)
+        # (first event index, (x, y, p)) chunks of the events in the current window
+        self.window_events = collections.deque()
+        self.idx_start = 0
+        self.idx_end = 0
+
+    def added_range(self, idx_start: int, idx_end: int) -> Tuple[int, int]:
+        """:return: index range of the events that enter the window when moving from the current window."""
+        return max(self.idx_end, idx_start), idx_end
+
+    def _clip(self) -> bool:
+        return True
+
+    @abstractmethod
+    def _render(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray):
+        ...
+
+    def _apply(self, events: Tuple[np.ndarray, np.ndarray, np.ndarray], sign: int):
+        x, y, pol = events
+        _update_counts(x, y, pol, sign, self.shift, self.height, self.width, self._clip(), self.counts, self.last_pol)
+
+    def update(self, added: dict, idx_start: int, idx_end: int) -> np.ndarray:
+        """
+        Moves the window to [idx_start, idx_end).
+        The events that leave the window are taken from the events added before, such that every event is read once.
+        :param added: events (x, y, p) in added_range(idx_start, idx_end).
+        :return: representation of the current window (a copy of the running output).
+        """
+        assert idx_start >= self.idx_start and idx_end >= self.idx_end, 'windows must not move backwards'
+        assert idx_end >= idx_start
+        added_start, added_end = self.added_range(idx_start, idx_end)
+        assert len(added['x']) == added_end - added_start
+
+        removed = list()
+        while self.window_events and self.window_events[0][0] < idx_start:
+            chunk_start, chunk = self.window_events.popleft()
+            num_removed = min(idx_start - chunk_start, len(chunk[0]))
+            removed.append(tuple(array[:num_removed] for array in chunk))
+            if num_removed < len(chunk[0]):
+                self.window_events.appendleft((chunk_start + num_removed, tuple(array[num_removed:] for array in chunk)))
+        # Copy: the slices may be views of reused read buffers.
+        added = tuple(np.array(added[key]) for key in ('x', 'y', 'p'))
+        if len(added[0]) > 0:
+            self.window_events.append((added_start, added))
+        self.idx_start, self.idx_end = idx_start, idx_end
+
+        for events in removed:
+            self._apply(events, -1)
+        self._apply(added, 1)
+        for events in removed + [added]:
+            self._render(*events)
+        return self.output.copy()
+
+
+class IncrementalStackedHistogram(IncrementalRepresentation):
+    """Incremental StackedHistogram with a single bin (per pixel ON and OFF counts)."""
+    def __init__(self, height: int, width: int, count_cutoff: int, fastmode: bool):
+        super().__init__(shape=(2, height, width), numpy_dtype=np.dtype('uint8'), height=height, width=width, shift=0)
+        self.count_cutoff = count_cutoff
+        self.fastmode = fastmode
+
+    def _clip(self) -> bool:
+        return False
+
+    def _render(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray):
+        if len(pol) > 0:
+            assert pol.max() <= 1
+        _render_histogram(x, y, self.width, self.counts, self.count_cutoff, self.fastmode,
+                          self.output.reshape(2, -1))
+
+
+class IncrementalEventFrame(IncrementalRepresentation):
+    """Incremental EventFrame (all policies and encodings)."""
+    def __init__(self, height: int, width: int, downsample: bool, policy: str, min_count: int,
+                 background_color: int, encoding: str = 'rgb'):
+        assert policy in EVENT_FRAME_POLICIES, f'{policy=}'
+        shift = 1 if downsample else 0
+        colors = event_frame_colors(background_color, encoding)
+        super().__init__(shape=(len(colors), height >> shift, width >> shift), numpy_dtype=np.dtype('uint8'),
+                         height=height, width=width, shift=shift)
+        self.policy = EVENT_FRAME_POLICIES.index(policy)
+        self.min_count = min_count
+        self.colors = colors
+        self.output[:] = self.colors[:, FRAME_STATE_BACKGROUND, None, None]
+
+    def _render(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray):
+        _render_event_frame(x, y, pol, self.shift, self.height, self.width, self.policy, self.min_count,
+                            self.colors, self.counts, self.last_pol, self.output.reshape(len(self.colors), -1))
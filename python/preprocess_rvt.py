@@ -1,6 +1,7 @@
 """
 adding Event Frame Factory
 """
+from __future__ import annotations
 
 import os
 
@@ -12,17 +13,26 @@ os.environ["NUMEXPR_NUM_THREADS"] = "1"
 
 from abc import ABC, abstractmethod
 import argparse
-from dataclasses import dataclass, field
+import contextlib
+from dataclasses import dataclass, field, replace
 from enum import Enum, auto
 from functools import partial
+import heapq
+import itertools
+import json
 from multiprocessing import get_context
 from pathlib import Path
+import queue
+import re
 import shutil
 import sys
+import threading
+import time
 
 sys.path.append('../..')
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 import weakref
+import zlib
 
 import h5py
 try:
@@ -32,9 +42,24 @@ except ImportError:
 from numba import jit
 import numpy as np
 from omegaconf import OmegaConf, DictConfig, MISSING
-import torch
+try:
+    import torch
+except ImportError:
+    # Only the numba representation backend is available.
+    torch = None
 from tqdm import tqdm
 
+from event_filters import BackgroundActivityFilter
+from ev_repr_store import CHUNK_CODECS, CHUNK_SHUFFLES, ChunkedDirWriter, NpyWriter, OUTPUT_FORMATS, \
+    merge_chunked_dirs, merge_npy_files, npy_checkpoint_file, output_suffix
+from event_frame_codec import EVENT_FRAME_BACKGROUND, EVENT_FRAME_ENCODINGS, FRAME_STATE_BACKGROUND, FRAME_STATE_OFF, \
+    FRAME_STATE_ON, event_frame_colors, pack_states, packed_shape, storage_attrs
+from h5_codecs import CODECS, SHUFFLES, compression_opts
+from profiling import format_summary, get_profiler, merge_reports, profiling, write_report
+from incremental_repr import IncrementalEventFrame, IncrementalRepresentation, IncrementalStackedHistogram
+from representations_numba import EVENT_FRAME_POLICIES, EventFrameNumba, MixedDensityEventStackNumba, \
+    StackedHistogramNumba, downsample_ev_repr_numpy
+
 
 """
 adding a new representation: Event Frame
@@ -45,10 +70,12 @@ from typing import Optional, Tuple
 
 import math
 import numpy as np
-import torch as th
+th = torch
 
 
 class RepresentationBase(ABC):
+    backend = 'torch'
+
     @abstractmethod
     def construct(self, x: th.Tensor, y: th.Tensor, pol: th.Tensor, time: th.Tensor) -> th.Tensor:
         ...
@@ -75,26 +102,72 @@ class RepresentationBase(ABC):
     def _is_int_tensor(tensor: th.Tensor) -> bool:
         return not th.is_floating_point(tensor) and not th.is_complex(tensor)
 
+    def _batch_output(self, num_windows: int, out: Optional[th.Tensor], device: th.device) -> th.Tensor:
+        """Zeroed (num_windows,) + get_shape() tensor, a view of out if given (reused across batches)."""
+        shape = (num_windows,) + tuple(self.get_shape())
+        if out is None:
+            return th.zeros(shape, dtype=self.get_torch_dtype(), device=device, requires_grad=False)
+        assert out.dtype == self.get_torch_dtype() and out.is_contiguous()
+        assert len(out) >= num_windows and out.shape[1:] == shape[1:]
+        out = out[:num_windows]
+        out.zero_()
+        return out
+
+    @staticmethod
+    def _window_ids_and_bounds(time: th.Tensor, offsets: th.Tensor) -> Tuple[th.Tensor, th.Tensor, th.Tensor]:
+        """
+        For events of N windows concatenated along the first dimension, with window i at [offsets[i], offsets[i + 1]).
+        :return: per event: window index, first timestamp and last timestamp of its window.
+        """
+        assert offsets.dim() == 1 and offsets.numel() >= 1
+        num_events_per_window = offsets[1:] - offsets[:-1]
+        assert th.all(num_events_per_window >= 0)
+        window_ids = th.repeat_interleave(th.arange(len(num_events_per_window), device=time.device),
+                                          num_events_per_window)
+        # Empty windows contribute no events, the clamp only keeps the (unused) lookups in range.
+        first_idx = th.clamp(offsets[:-1], max=max(time.numel() - 1, 0))
+        last_idx = th.clamp(offsets[1:] - 1, min=0)
+        t0 = time[first_idx][window_ids]
+        t1 = time[last_idx][window_ids]
+        return window_ids, t0, t1
+
 
 ## adding Event Frame representation
 class EventFrame(RepresentationBase):
-    def __init__(self, height: int, width: int, downsample: bool = False):
+    def __init__(self, height: int, width: int, downsample: bool = False, policy: str = 'off_priority',
+                 min_count: int = 2, background_color: int = EVENT_FRAME_BACKGROUND, encoding: str = 'rgb'):
         """
         Event Frame representation that maps ON and OFF events to a 2D RGB frame.
         :param height: Height of the event frame.
         :param width: Width of the event frame.
-        :param downsample: Whether to downsample the frame by half.
+        :param downsample: Whether to build the frame at half resolution (events of 2x2 pixels are combined).
+        :param policy: Color of pixels with ON and OFF events, one of EVENT_FRAME_POLICIES:
+                       off_priority (OFF wins, original behavior), last (last event wins), majority, or
+                       count (majority, but only pixels with at least min_count events are colored).
+        :param background_color: Gray value of pixels without events.
+        :param encoding: One of EVENT_FRAME_ENCODINGS. The state encodings ('state', 'packed') construct a
+                         (1, H, W) map of the pixel states instead of the RGB frame, see event_frame_codec.py.
         """
         super().__init__()
+        assert policy in EVENT_FRAME_POLICIES, f'{policy=}'
+        assert encoding in EVENT_FRAME_ENCODINGS, f'{encoding=}'
+        assert 0 <= background_color <= 255
         self.height = height
         self.width = width
         self.downsample = downsample
+        self.policy = policy
+        self.min_count = min_count
+        self.background_color = background_color
+        self.encoding = encoding
+        self.colors = None
+        self.pixel_scratch = None
 
     def get_shape(self) -> Tuple[int, int, int]:
-        # RGB frame shape: 3 channels
+        # RGB frame shape: 3 channels, state map: 1 channel
+        num_channels = 3 if self.encoding == 'rgb' else 1
         if self.downsample:
-            return (3, self.height // 2, self.width // 2)
-        return (3, self.height, self.width)
+            return (num_channels, self.height // 2, self.width // 2)
+        return (num_channels, self.height, self.width)
 
     @staticmethod
     def get_numpy_dtype() -> np.dtype:
@@ -107,48 +180,62 @@ class EventFrame(RepresentationBase):
     def construct(self, x: th.Tensor, y: th.Tensor, pol: th.Tensor, time: th.Tensor) -> th.Tensor:
         """
         Constructs an event frame with ON events in red and OFF events in blue.
+        Each pixel with events is written once, with the color decided by the policy.
         :param x: x-coordinates of events.
         :param y: y-coordinates of events.
-        :param pol: polarity of events (+1 for ON, -1 for OFF).
+        :param pol: polarity of events (1 for ON, 0 for OFF, other values are ignored).
         :param time: timestamps of events (not used here).
         :return: RGB event frame as a Torch tensor.
         """
         device = x.device
         assert y.device == pol.device == time.device == device
-
-        # Initialize a gray frame (114, 114, 114)
-        frame = th.full((3, self.height, self.width), fill_value=114, dtype=th.uint8, device=device)
-
-        # Clip x and y coordinates to fit within the frame dimensions
-        x_clipped = th.clamp(x, min=0, max=self.width - 1)
-        y_clipped = th.clamp(y, min=0, max=self.height - 1)
-
-        # ON events (pol == 1) → Red channel
-        on_mask = (pol == 1)
-        frame[0, y_clipped[on_mask], x_clipped[on_mask]] = 255  # Red
-        frame[1, y_clipped[on_mask], x_clipped[on_mask]] = 0
-        frame[2, y_clipped[on_mask], x_clipped[on_mask]] = 0
-
-        # OFF events (pol == -1) → Blue channel
-        off_mask = (pol == 0)
-        frame[0, y_clipped[off_mask], x_clipped[off_mask]] = 0
-        frame[1, y_clipped[off_mask], x_clipped[off_mask]] = 0
-        frame[2, y_clipped[off_mask], x_clipped[off_mask]] = 255  # Blue
-
-        # Downsample the frame if required
-        if self.downsample:
-            frame = th.nn.functional.interpolate(
-                frame.unsqueeze(0).float(),
-                size=(self.height // 2, self.width // 2),
-                mode="bilinear",
-                align_corners=False
-            ).squeeze(0).to(th.uint8)
-
+        num_channels, ht, wd = self.get_shape()
+        if self.colors is None or self.colors.device != device:
+            self.colors = th.from_numpy(event_frame_colors(self.background_color, self.encoding)).to(device)
+
+        valid = (pol == 0) | (pol == 1)
+        if not th.all(valid):
+            x, y, pol = x[valid], y[valid], pol[valid]
+        shift = 1 if self.downsample else 0
+        # Clip x and y coordinates to fit within the frame dimensions.
+        x_clipped = th.clamp(x.long() >> shift, min=0, max=wd - 1)
+        y_clipped = th.clamp(y.long() >> shift, min=0, max=ht - 1)
+        pixel_idx = x_clipped + wd * y_clipped
+
+        if self.pixel_scratch is None or self.pixel_scratch.device != device:
+            # Per pixel scratch (last event index, ON count, event count), reset sparsely after each use.
+            self.pixel_scratch = th.zeros((3, ht * wd), dtype=th.int64, device=device)
+            self.pixel_scratch[0] = -1
+        last_idx, num_on_per_pixel, num_events_per_pixel = self.pixel_scratch
+
+        # Select the last event of each pixel: every pixel with events is written exactly once by it.
+        event_idx = th.arange(len(pixel_idx), device=device)
+        last_idx.scatter_reduce_(0, pixel_idx, event_idx, reduce='amax')
+        is_last = last_idx[pixel_idx] == event_idx
+        pixel_idx_last = pixel_idx[is_last]
+        last_idx[pixel_idx_last] = -1
+        state = th.where(pol[is_last] == 1, FRAME_STATE_ON, FRAME_STATE_OFF)
+        if self.policy != 'last':
+            num_on_per_pixel.scatter_add_(0, pixel_idx, pol.long())
+            num_events_per_pixel.scatter_add_(0, pixel_idx, th.ones_like(pixel_idx))
+            num_on = num_on_per_pixel[pixel_idx_last]
+            num_off = num_events_per_pixel[pixel_idx_last] - num_on
+            num_on_per_pixel[pixel_idx_last] = 0
+            num_events_per_pixel[pixel_idx_last] = 0
+            if self.policy == 'off_priority':
+                state = th.where(num_off > 0, FRAME_STATE_OFF, FRAME_STATE_ON)
+            else:
+                state = th.where(num_on > num_off, FRAME_STATE_ON, th.where(num_off > num_on, FRAME_STATE_OFF, state))
+                if self.policy == 'count':
+                    enough = num_on + num_off >= self.min_count
+                    pixel_idx_last, state = pixel_idx_last[enough], state[enough]
+
+        frame = th.full((num_channels, ht, wd), fill_value=int(self.colors[0, FRAME_STATE_BACKGROUND]),
+                        dtype=th.uint8, device=device)
+        frame.view(num_channels, -1)[:, pixel_idx_last] = self.colors[:, state]
         return frame
 
 
-
-
 class StackedHistogram(RepresentationBase):
     def __init__(self, bins: int, height: int, width: int, count_cutoff: Optional[int] = None, fastmode: bool = True):
         """
@@ -223,10 +310,12 @@ class StackedHistogram(RepresentationBase):
         t_idx = t_norm.floor()
         t_idx = th.clamp(t_idx, max=bn - 1)
 
-        indices = x.long() + \
-                  wd * y.long() + \
-                  ht * wd * t_idx.long() + \
-                  bn * ht * wd * pol.long()
+        # Index arithmetic in int32 (ch * bn * ht * wd < 2^31), only put_ requires int64.
+        indices = x.int() + \
+                  wd * y.int() + \
+                  ht * wd * t_idx.int() + \
+                  bn * ht * wd * pol.int()
+        indices = indices.long()
         values = th.ones_like(indices, dtype=dtype, device=device)
         representation.put_(indices, values, accumulate=True)
         representation = th.clamp(representation, min=0, max=self.count_cutoff)
@@ -235,6 +324,63 @@ class StackedHistogram(RepresentationBase):
 
         return self.merge_channel_and_bins(representation)
 
+    def construct_batch(self, x: th.Tensor, y: th.Tensor, pol: th.Tensor, time: th.Tensor,
+                        offsets: th.Tensor, out: Optional[th.Tensor] = None) -> th.Tensor:
+        """
+        Constructs the representations of N windows with a single scatter.
+        The events of window i are at [offsets[i], offsets[i + 1]) of the concatenated x, y, pol and time.
+        The result is identical to stacking construct() of each window.
+        :param out: optional uint8 tensor of shape (>= N, 2 * bins, height, width) that is reused for the result.
+                    Allocating and page-faulting a fresh output for every batch costs more than the scatter itself.
+        :return: tensor of shape (N, 2 * bins, height, width)
+        """
+        device = x.device
+        assert y.device == pol.device == time.device == device
+        assert self._is_int_tensor(x)
+        assert self._is_int_tensor(y)
+        assert self._is_int_tensor(pol)
+        assert self._is_int_tensor(time)
+        assert x.numel() == y.numel() == pol.numel() == time.numel() == offsets[-1]
+
+        dtype = th.uint8 if self.fastmode else th.int16
+        num_windows = len(offsets) - 1
+
+        output = self._batch_output(num_windows, out, device)
+        if self.fastmode:
+            representation = output.view(num_windows, self.channels, self.bins, self.height, self.width)
+        else:
+            representation = th.zeros((num_windows, self.channels, self.bins, self.height, self.width),
+                                      dtype=dtype, device=device, requires_grad=False)
+
+        if x.numel() > 0:
+            assert pol.min() >= 0
+            assert pol.max() <= 1
+
+            bn, ch, ht, wd = self.bins, self.channels, self.height, self.width
+
+            # NOTE: assume sorted time within each window
+            window_ids, t0, t1 = self._window_ids_and_bounds(time, offsets)
+            assert th.all(t1 >= t0)
+            t_norm = time - t0
+            t_norm = t_norm / th.clamp(t1 - t0, min=1)
+            t_norm = t_norm * bn
+            t_idx = t_norm.floor()
+            t_idx = th.clamp(t_idx, max=bn - 1)
+
+            indices = x.int() + \
+                      wd * y.int() + \
+                      ht * wd * t_idx.int() + \
+                      bn * ht * wd * pol.int()
+            # The window offset can exceed int32 for large batches.
+            indices = indices.long() + ch * bn * ht * wd * window_ids
+            values = th.ones_like(indices, dtype=dtype, device=device)
+            representation.put_(indices, values, accumulate=True)
+            representation.clamp_(min=0, max=self.count_cutoff)
+        if not self.fastmode:
+            output.copy_(representation.view(output.shape))
+
+        return output
+
 
 def cumsum_channel(x: th.Tensor, num_channels: int):
     for i in reversed(range(num_channels)):
@@ -297,7 +443,7 @@ class MixedDensityEventStack(RepresentationBase):
 
         assert pol.min() >= 0  # maybe remove because too costly
         assert pol.max() <= 1  # maybe remove because too costly
-        pol = pol * 2 - 1
+        pol = pol.to(dtype) * 2 - 1
 
         bn, ht, wd = self.bins, self.height, self.width
 
@@ -322,29 +468,71 @@ class MixedDensityEventStack(RepresentationBase):
         bin_float = th.clamp(bin_float, min=0)
         t_idx = bin_float.floor()
 
-        indices = x.long() + \
-                  wd * y.long() + \
-                  ht * wd * t_idx.long()
-        values = th.asarray(pol, dtype=dtype, device=device)
+        # Index arithmetic in int32 (bn * ht * wd < 2^31), only put_ requires int64.
+        indices = x.int() + \
+                  wd * y.int() + \
+                  ht * wd * t_idx.int()
+        indices = indices.long()
+        values = pol
         representation.put_(indices, values, accumulate=True)
         representation = self.cumsum_ch_opt(representation, num_channels=self.bins)
         if self.count_cutoff is not None:
             representation = th.clamp(representation, min=-self.count_cutoff, max=self.count_cutoff)
         return representation
 
+    def construct_batch(self, x: th.Tensor, y: th.Tensor, pol: th.Tensor, time: th.Tensor,
+                        offsets: th.Tensor, out: Optional[th.Tensor] = None) -> th.Tensor:
+        """
+        Constructs the representations of N windows with a single scatter.
+        The events of window i are at [offsets[i], offsets[i + 1]) of the concatenated x, y, pol and time.
+        The result is identical to stacking construct() of each window.
+        :param out: optional int8 tensor of shape (>= N, bins, height, width) that is reused for the result.
+        :return: tensor of shape (N, bins, height, width)
+        """
+        device = x.device
+        assert y.device == pol.device == time.device == device
+        assert self._is_int_tensor(x)
+        assert self._is_int_tensor(y)
+        assert self._is_int_tensor(pol)
+        assert self._is_int_tensor(time)
+        assert x.numel() == y.numel() == pol.numel() == time.numel() == offsets[-1]
+
+        dtype = th.int8
+        num_windows = len(offsets) - 1
 
-def _blosc_opts(complevel=1, complib='blosc:zstd', shuffle='byte'):
-    shuffle = 2 if shuffle == 'bit' else 1 if shuffle == 'byte' else 0
-    compressors = ['blosclz', 'lz4', 'lz4hc', 'snappy', 'zlib', 'zstd']
-    complib = ['blosc:' + c for c in compressors].index(complib)
-    args = {
-        'compression': 32001,
-        'compression_opts': (0, 0, 0, 0, complevel, shuffle, complib),
-    }
-    if shuffle > 0:
-        # Do not use h5py shuffle if blosc shuffle is enabled.
-        args['shuffle'] = False
-    return args
+        representation = self._batch_output(num_windows, out, device)
+
+        if x.numel() == 0:
+            return representation
+
+        assert pol.min() >= 0  # maybe remove because too costly
+        assert pol.max() <= 1  # maybe remove because too costly
+        pol = pol.to(dtype) * 2 - 1
+
+        bn, ht, wd = self.bins, self.height, self.width
+
+        # NOTE: assume sorted time within each window
+        window_ids, t0, t1 = self._window_ids_and_bounds(time, offsets)
+        assert th.all(t1 >= t0)
+        t_norm = (time - t0) / th.clamp(t1 - t0, min=1)
+        t_norm = th.clamp(t_norm, min=1e-6, max=1 - 1e-6)
+        # See construct() for the mapping from normalized time to bins.
+        bin_float = self.bins - th.log(t_norm) / math.log(1 / 2)
+        bin_float = th.clamp(bin_float, min=0)
+        t_idx = bin_float.floor()
+
+        indices = x.int() + \
+                  wd * y.int() + \
+                  ht * wd * t_idx.int()
+        # The window offset can exceed int32 for large batches.
+        indices = indices.long() + bn * ht * wd * window_ids
+        representation.put_(indices, pol, accumulate=True)
+        # In-place cumsum over the bins. int8 wraps around like the int64 sums of cumsum_channel cast to int8.
+        for i in range(1, self.bins):
+            representation[:, i] += representation[:, i - 1]
+        if self.count_cutoff is not None:
+            representation.clamp_(min=-self.count_cutoff, max=self.count_cutoff)
+        return representation
 
 
 class DataKeys(Enum):
@@ -387,53 +575,205 @@ class NoLabelsException(Exception):
 
 
 class H5Writer:
-    def __init__(self, outfile: Path, key: str, ev_repr_shape: Tuple, numpy_dtype: np.dtype):
+    def __init__(self, outfile: Path, key: str, ev_repr_shape: Tuple, numpy_dtype: np.dtype,
+                 attrs: Optional[Dict[str, Any]] = None, num_frames: Optional[int] = None,
+                 frames_per_chunk: int = 1, buffer_frames: int = 8, codec: str = 'blosc:zstd', complevel: int = 1,
+                 shuffle: str = 'byte', checkpoint_id: Optional[str] = None, checkpoint_interval_s: float = 60):
+        """
+        :param attrs: Attributes of the dataset, e.g. required to decode the stored representations.
+        :param num_frames: Final number of frames if known. The dataset is allocated once instead of being resized
+                           for every write.
+        :param frames_per_chunk: Number of frames per HDF5 chunk. Several frames per chunk compress better (short
+                                 windows), but a reader of a single frame decompresses the whole chunk.
+        :param buffer_frames: Frames are buffered and written in blocks of at least this many frames (rounded up to
+                              whole chunks), such that every write covers complete chunks.
+        :param codec, complevel, shuffle: Compression of the chunks, see h5_codecs.compression_opts.
+        :param checkpoint_id: If set, the number of written frames is recorded in the file as a high-water mark
+                              together with this id (e.g. a checksum of the window timestamps and the settings), at
+                              most every checkpoint_interval_s seconds. An existing outfile with the same id is
+                              resumed: get_current_length() is its high-water mark and new frames are appended there.
+        """
         assert len(ev_repr_shape) == 3
-        self.h5f = h5py.File(str(outfile), 'w')
-        self._finalizer = weakref.finalize(self, self.close_callback, self.h5f)
+        assert frames_per_chunk > 0 and buffer_frames > 0
         self.key = key
         self.numpy_dtype = numpy_dtype
+        self.checkpoint_id = checkpoint_id
+        self.checkpoint_interval_s = checkpoint_interval_s
+        self.t_checkpoint = time.perf_counter()
 
-        # create hdf5 datasets
         maxshape = (None,) + ev_repr_shape
-        chunkshape = (1,) + ev_repr_shape
+        chunkshape = (frames_per_chunk,) + ev_repr_shape
         self.maxshape = maxshape
-        self.h5f.create_dataset(key, dtype=self.numpy_dtype.name, shape=chunkshape, chunks=chunkshape,
-                                maxshape=maxshape, **_blosc_opts(complevel=1, shuffle='byte'))
+        self.num_frames = num_frames
+        self.frames_per_chunk = frames_per_chunk
+        buffer_len = -(-buffer_frames // frames_per_chunk) * frames_per_chunk
+        self.buffer = np.empty((buffer_len,) + ev_repr_shape, dtype=numpy_dtype)
+        self.num_buffered = 0
         self.t_idx = 0
 
+        self.h5f = self._open_checkpoint(outfile) if checkpoint_id is not None and outfile.exists() else None
+        if self.h5f is not None:
+            self.dataset = self.h5f[key]
+            self.t_idx = int(self.dataset.attrs['checkpoint_num_frames'])
+        else:
+            self.h5f = h5py.File(str(outfile), 'w')
+            # create hdf5 datasets
+            self.dataset = self.h5f.create_dataset(key, dtype=self.numpy_dtype.name,
+                                                   shape=(num_frames or 0,) + ev_repr_shape, chunks=chunkshape,
+                                                   maxshape=maxshape,
+                                                   **compression_opts(codec=codec, complevel=complevel,
+                                                                      shuffle=shuffle))
+            if attrs is not None:
+                self.dataset.attrs.update(attrs)
+            if checkpoint_id is not None:
+                self.dataset.attrs['checkpoint_id'] = checkpoint_id
+                self.checkpoint()
+        self._finalizer = weakref.finalize(self, self.close_callback, self.h5f)
+
+    def _open_checkpoint(self, outfile: Path) -> Optional[h5py.File]:
+        """:return: The file opened for appending if it has a valid checkpoint of checkpoint_id, else None."""
+        try:
+            h5f = h5py.File(str(outfile), 'r+')
+        except OSError:
+            # e.g. a file of a crash without flushed metadata
+            return None
+        dataset = h5f.get(self.key)
+        if dataset is None or dataset.attrs.get('checkpoint_id') != self.checkpoint_id or \
+                dataset.shape[1:] != self.maxshape[1:] or dataset.chunks != (self.frames_per_chunk,) + self.maxshape[1:] \
+                or dataset.attrs.get('checkpoint_num_frames', len(dataset) + 1) > len(dataset):
+            h5f.close()
+            return None
+        return h5f
+
+    def checkpoint(self):
+        """Records the written frames (without the buffered ones) as high-water mark and flushes the file."""
+        self.dataset.attrs['checkpoint_num_frames'] = self.t_idx
+        self.h5f.flush()
+        self.t_checkpoint = time.perf_counter()
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+            self._remove_checkpoint()
         self._finalizer()
 
     @staticmethod
     def close_callback(h5f: h5py.File):
         h5f.close()
 
+    def _remove_checkpoint(self):
+        # Complete files hold no checkpoint.
+        for key in ('checkpoint_id', 'checkpoint_num_frames'):
+            if key in self.dataset.attrs:
+                del self.dataset.attrs[key]
+
     def close(self):
+        self.flush()
+        self._remove_checkpoint()
         self.h5f.close()
 
     def get_current_length(self):
-        return self.t_idx
+        # including the buffered frames
+        return self.t_idx + self.num_buffered
+
+    def _write(self, data: np.ndarray):
+        new_size = self.t_idx + len(data)
+        if new_size > len(self.dataset):
+            self.dataset.resize(new_size, axis=0)
+        self.dataset[self.t_idx:new_size] = data
+        self.t_idx = new_size
+        if self.checkpoint_id is not None and time.perf_counter() - self.t_checkpoint >= self.checkpoint_interval_s:
+            self.checkpoint()
+
+    def flush(self):
+        """Writes the buffered frames and trims the dataset to the number of written frames."""
+        if self.num_buffered > 0:
+            self._write(self.buffer[:self.num_buffered])
+            self.num_buffered = 0
+        if len(self.dataset) != self.t_idx:
+            self.dataset.resize(self.t_idx, axis=0)
 
     def add_data(self, data: np.ndarray):
-        assert data.dtype == self.numpy_dtype, f'{data.dtype=}, {self.numpy_dtype=}'
         assert data.shape == self.maxshape[1:]
-        new_size = self.t_idx + 1
-        self.h5f[self.key].resize(new_size, axis=0)
-        self.h5f[self.key][self.t_idx:new_size] = data
-        self.t_idx = new_size
+        self.add_data_batch(data[None])
+
+    def add_data_batch(self, data: np.ndarray):
+        """Appends a batch of representations of shape (N,) + ev_repr_shape."""
+        assert data.dtype == self.numpy_dtype, f'{data.dtype=}, {self.numpy_dtype=}'
+        assert data.shape[1:] == self.maxshape[1:]
+        buffer_len = len(self.buffer)
+        idx = 0
+        while idx < len(data):
+            num_left = len(data) - idx
+            if self.num_buffered == 0 and num_left >= buffer_len:
+                # Large batches are written directly, in whole chunks.
+                num_direct = num_left // self.frames_per_chunk * self.frames_per_chunk
+                self._write(data[idx:idx + num_direct])
+                idx += num_direct
+                continue
+            num_copy = min(num_left, buffer_len - self.num_buffered)
+            self.buffer[self.num_buffered:self.num_buffered + num_copy] = data[idx:idx + num_copy]
+            self.num_buffered += num_copy
+            idx += num_copy
+            if self.num_buffered == buffer_len:
+                self._write(self.buffer)
+                self.num_buffered = 0
+
+
+class SliceBuffers:
+    """Ring of preallocated per-column event buffers that are reused by consecutive event slices."""
+    def __init__(self, dtypes: List[np.dtype], num_buffers: int = 2):
+        assert num_buffers >= 1
+        self.dtypes = dtypes
+        self.buffers = [None] * num_buffers
+        self.buffer_idx = 0
+
+    def get(self, num_events: int) -> Tuple[np.ndarray, ...]:
+        buffers = self.buffers[self.buffer_idx]
+        if buffers is None or len(buffers[0]) < num_events:
+            capacity = max(num_events, 1024)
+            if buffers is not None:
+                capacity = max(capacity, int(1.5 * len(buffers[0])))
+            buffers = tuple(np.empty(capacity, dtype=dtype) for dtype in self.dtypes)
+            self.buffers[self.buffer_idx] = buffers
+        self.buffer_idx = (self.buffer_idx + 1) % len(self.buffers)
+        return buffers
+
+
+# H5Reader.get_event_indices: buckets of the millisecond index closer than this many events are read at once, up to
+# this many events per read.
+EVENT_INDEX_MAX_GAP = 2 ** 14
+EVENT_INDEX_MAX_READ = 2 ** 20
 
 
 class H5Reader:
-    def __init__(self, h5_file: Path, dataset: str = 'gen4'):
+    def __init__(self, h5_file: Path, dataset: str = 'gen4', validate_time: bool = False,
+                 ba_filter_dt_us: Optional[int] = None, ba_filter_radius: int = 1,
+                 prefetch_num_events: Optional[int] = None, chunk_cache_mb: Optional[float] = None,
+                 compact_slices: bool = False, num_slice_buffers: int = 2):
+        """
+        :param compact_slices: Return event slices in their native (narrow) dtypes instead of int64:
+                               x, y: int16, p: uint8, t: int64 (zero-copy views of the stored u2/u1/u8 columns).
+                               Without prefetching, slices are read into num_slice_buffers reused buffers, i.e.
+                               a slice is only valid until num_slice_buffers further slices have been read.
+        :param prefetch_num_events: If set, events are read in contiguous blocks of at least this many events and
+                                    subsequent (increasing) windows are served as views into the current block.
+                                    The next block starts with the events of the current block that are still needed.
+        :param chunk_cache_mb: Size of the h5py chunk cache. Should hold the chunks shared by overlapping windows.
+        """
         assert h5_file.exists()
         assert h5_file.suffix == '.h5' or h5_file.suffix == '.hdf5'
         assert dataset in {'gen1', 'gen4', "gifu"}
 
-        self.h5f = h5py.File(str(h5_file), 'r')
+        cache_kwargs = dict()
+        if chunk_cache_mb is not None:
+            cache_kwargs['rdcc_nbytes'] = int(chunk_cache_mb * 1024 ** 2)
+            # The number of hash slots should be much larger than the number of chunks in the cache.
+            cache_kwargs['rdcc_nslots'] = max(521, 100 * int(chunk_cache_mb) + 1)
+        self.h5f = h5py.File(str(h5_file), 'r', **cache_kwargs)
         self._finalizer = weakref.finalize(self, self._close_callback, self.h5f)
         self.is_open = True
 
@@ -447,6 +787,41 @@ class H5Reader:
         self.height = dataset_2_height[dataset]
         self.width = dataset_2_width[dataset]
 
+        self.num_events = self.h5f['events']['t'].shape[0]
+        # DSEC-style time index written by convert_h5.py (optional).
+        # ms_to_idx[ms] is the first event index with (corrected) t >= t_offset + ms * 1000.
+        self.ms_to_idx = None
+        if 'ms_to_idx' in self.h5f:
+            self.ms_to_idx = np.asarray(self.h5f['ms_to_idx'], dtype='int64')
+        self.t_offset = int(self.h5f['t_offset'][()]) if 't_offset' in self.h5f else 0
+        # Timestamps of files converted with convert_h5.py are already corrected to be non-decreasing.
+        self.is_monotonic = bool(self.h5f['events'].attrs.get('monotonic', False))
+        if self.is_monotonic and validate_time:
+            self.validate_time()
+
+        # Optional background activity (denoising) filter applied to the event slices as to the whole stream.
+        self.ba_filter = None
+        if ba_filter_dt_us is not None:
+            self.ba_filter = BackgroundActivityFilter(self.height, self.width,
+                                                      dt_us=ba_filter_dt_us, radius=ba_filter_radius)
+        # Filter decisions of the events [ba_keep_start, ba_idx_end), see _ba_filter_keep.
+        self.ba_keep = np.zeros(0, dtype=bool)
+        self.ba_keep_start = 0
+        self.ba_idx_end = 0
+
+        assert prefetch_num_events is None or prefetch_num_events > 0
+        self.prefetch_num_events = prefetch_num_events
+        self.block = None
+        self.block_idx_start = 0
+        self.block_idx_end = 0
+
+        self.compact_slices = compact_slices
+        if compact_slices:
+            ev_data = self.h5f['events']
+            for key, dtypes in (('x', ('u2', 'i2')), ('y', ('u2', 'i2')), ('p', ('u1', 'i1')), ('t', ('u8', 'i8'))):
+                assert ev_data[key].dtype.str[1:] in dtypes, f'{key}: {ev_data[key].dtype} not supported'
+            self.slice_buffers = SliceBuffers(dtypes=[ev_data[key].dtype for key in ('x', 'y', 'p', 't')],
+                                              num_buffers=num_slice_buffers)
 
         self.all_times = None
 
@@ -474,9 +849,21 @@ class H5Reader:
         assert self.is_open
         if self.all_times is None:
             self.all_times = np.asarray(self.h5f['events']['t'])
-            self._correct_time(self.all_times)
+            if not self.is_monotonic:
+                with get_profiler().stage('correct_time'):
+                    self._correct_time(self.all_times)
         return self.all_times
 
+    def validate_time(self, block_size: int = 2 ** 22):
+        # One-time check (in blocks of constant size) that the stored timestamps are non-decreasing.
+        time_dset = self.h5f['events']['t']
+        time_last = 0
+        for idx_start in range(0, self.num_events, block_size):
+            time_block = time_dset[idx_start:idx_start + block_size]
+            assert time_block[0] >= time_last, f'timestamps decrease at index {idx_start}'
+            assert np.all(time_block[:-1] <= time_block[1:]), f'timestamps decrease in block at index {idx_start}'
+            time_last = time_block[-1]
+
     @staticmethod
     @jit(nopython=True)
     def _correct_time(time_array: np.ndarray):
@@ -488,16 +875,179 @@ class H5Reader:
             else:
                 time_last = time
 
+    def _read_time(self, idx_start: int, idx_end: int) -> np.ndarray:
+        # Corrected timestamps in [idx_start, idx_end) without loading the full time array.
+        if self.all_times is not None:
+            return self.all_times[idx_start:idx_end]
+        if self.is_monotonic:
+            return self.h5f['events']['t'][idx_start:idx_end]
+        if self.ms_to_idx is None:
+            return self.time[idx_start:idx_end]
+        # The first event of a millisecond bucket is never modified by the time correction.
+        # Hence, we only have to re-apply the running maximum from the start of the bucket containing idx_start.
+        bucket = max(int(np.searchsorted(self.ms_to_idx, idx_start, side='right')) - 1, 0)
+        idx_bucket_start = min(int(self.ms_to_idx[bucket]), idx_start) if len(self.ms_to_idx) > 0 else 0
+        time_array = np.asarray(self.h5f['events']['t'][idx_bucket_start:idx_end])
+        with get_profiler().stage('correct_time'):
+            np.maximum.accumulate(time_array, out=time_array)
+        return time_array[idx_start - idx_bucket_start:]
+
+    def get_event_indices(self, timestamps_us: np.ndarray, side: str) -> np.ndarray:
+        """
+        Equivalent to np.searchsorted(time, timestamps_us, side=side) on the corrected time array.
+        Uses the millisecond index if available such that only the millisecond buckets of the timestamps are read:
+        nearby buckets are read at once and all timestamps of a read are searched at once.
+        """
+        assert self.is_open
+        assert side in ('left', 'right')
+        timestamps_us = np.asarray(timestamps_us, dtype='int64')
+        if self.ms_to_idx is None:
+            return np.searchsorted(self.time, timestamps_us - self.t_offset, side=side)
+        ts_rel = timestamps_us - self.t_offset
+        ms = ts_rel // 1000
+        indices = np.where(ts_rel < 0, 0, self.num_events).astype('int64')
+        in_index = np.flatnonzero((ts_rel >= 0) & (ms < len(self.ms_to_idx)))
+        bucket_starts = self.ms_to_idx[ms[in_index]]
+        ms_next = ms[in_index] + 1
+        bucket_ends = np.where(ms_next < len(self.ms_to_idx),
+                               self.ms_to_idx[np.minimum(ms_next, len(self.ms_to_idx) - 1)], self.num_events)
+        indices[in_index] = bucket_starts
+        # All (corrected) timestamps in a bucket are within its millisecond, i.e. only non-empty buckets are searched.
+        # The events of a read before (after) the bucket of a timestamp are earlier (later), hence the whole read can
+        # be searched.
+        searched = np.flatnonzero(bucket_ends > bucket_starts)
+        searched = searched[np.argsort(bucket_starts[searched], kind='stable')]
+        unique_starts, first_searched = np.unique(bucket_starts[searched], return_index=True)
+        unique_ends = bucket_ends[searched[first_searched]]
+        first_searched = np.append(first_searched, len(searched))
+        read_start = read_end = first_bucket = 0
+        for bucket_idx, (bucket_start, bucket_end) in enumerate(zip(unique_starts.tolist(), unique_ends.tolist())):
+            if bucket_idx > 0 and bucket_start - read_end <= EVENT_INDEX_MAX_GAP and \
+                    bucket_end - read_start <= EVENT_INDEX_MAX_READ:
+                read_end = bucket_end
+                continue
+            if bucket_idx > 0:
+                ts_idx = in_index[searched[first_searched[first_bucket]:first_searched[bucket_idx]]]
+                indices[ts_idx] = self._search_read(read_start, read_end, ts_rel[ts_idx], side)
+            read_start, read_end, first_bucket = bucket_start, bucket_end, bucket_idx
+        if len(unique_starts) > 0:
+            ts_idx = in_index[searched[first_searched[first_bucket]:]]
+            indices[ts_idx] = self._search_read(read_start, read_end, ts_rel[ts_idx], side)
+        return indices
+
+    def _search_read(self, idx_start: int, idx_end: int, ts_rel: np.ndarray, side: str) -> np.ndarray:
+        return idx_start + np.searchsorted(self._read_time(idx_start, idx_end), ts_rel, side=side)
+
+    def _read_events(self, idx_start: int, idx_end: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        profiler = get_profiler()
+        profiler.count('events_read', idx_end - idx_start)
+        with profiler.stage('h5_read'):
+            ev_data = self.h5f['events']
+            x_array = np.asarray(ev_data['x'][idx_start:idx_end], dtype='int64')
+            y_array = np.asarray(ev_data['y'][idx_start:idx_end], dtype='int64')
+            p_array = np.asarray(ev_data['p'][idx_start:idx_end], dtype='int64')
+            p_array = np.clip(p_array, a_min=0, a_max=None)
+            # Non-decreasing by construction: corrected here or at conversion time (see validate_time).
+            t_array = np.asarray(self._read_time(idx_start, idx_end), dtype='int64')
+        return x_array, y_array, p_array, t_array
+
+    def _read_events_compact(self, idx_start: int, idx_end: int,
+                             reuse_buffers: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        profiler = get_profiler()
+        profiler.count('events_read', idx_end - idx_start)
+        with profiler.stage('h5_read'):
+            ev_data = self.h5f['events']
+            num_events = idx_end - idx_start
+            if reuse_buffers:
+                x_array, y_array, p_array, t_array = (buffer[:num_events]
+                                                      for buffer in self.slice_buffers.get(num_events))
+                if num_events > 0:
+                    source_sel = np.s_[idx_start:idx_end]
+                    dest_sel = np.s_[0:num_events]
+                    ev_data['x'].read_direct(x_array, source_sel=source_sel, dest_sel=dest_sel)
+                    ev_data['y'].read_direct(y_array, source_sel=source_sel, dest_sel=dest_sel)
+                    ev_data['p'].read_direct(p_array, source_sel=source_sel, dest_sel=dest_sel)
+                    if self.is_monotonic:
+                        ev_data['t'].read_direct(t_array, source_sel=source_sel, dest_sel=dest_sel)
+                    else:
+                        t_array[:] = self._read_time(idx_start, idx_end)
+            else:
+                x_array = ev_data['x'][idx_start:idx_end]
+                y_array = ev_data['y'][idx_start:idx_end]
+                p_array = ev_data['p'][idx_start:idx_end]
+                t_array = np.asarray(self._read_time(idx_start, idx_end))
+            if p_array.dtype.kind == 'i':
+                np.clip(p_array, a_min=0, a_max=None, out=p_array)
+            # Coordinates < 2^15 and timestamps < 2^63: reinterpret unsigned as signed without a copy
+            # (torch compatible).
+            return x_array.view('int16'), y_array.view('int16'), p_array.view('uint8'), t_array.view('int64')
+
+    def _read_events_prefetched(self, idx_start: int, idx_end: int) -> Tuple[np.ndarray, ...]:
+        if self.block is None or idx_start < self.block_idx_start or idx_end > self.block_idx_end:
+            block_idx_end = min(max(idx_start + self.prefetch_num_events, idx_end), self.num_events)
+            # Events of the current block at or after idx_start are kept, such that increasing (possibly
+            # overlapping) windows read every event once.
+            read_idx_start = idx_start
+            if self.block is not None and self.block_idx_start <= idx_start < self.block_idx_end:
+                read_idx_start = self.block_idx_end
+            if self.compact_slices:
+                block = self._read_events_compact(read_idx_start, block_idx_end, reuse_buffers=False)
+            else:
+                block = self._read_events(read_idx_start, block_idx_end)
+            if read_idx_start > idx_start:
+                offset = idx_start - self.block_idx_start
+                block = tuple(np.concatenate((old[offset:], new)) for old, new in zip(self.block, block))
+            self.block = block
+            self.block_idx_start = idx_start
+            self.block_idx_end = block_idx_end
+        # Views into the block (no copy).
+        offset_start = idx_start - self.block_idx_start
+        offset_end = idx_end - self.block_idx_start
+        return tuple(array[offset_start:offset_end] for array in self.block)
+
+    def _ba_filter_keep(self, idx_start: int, idx_end: int,
+                        x: np.ndarray, y: np.ndarray, t: np.ndarray) -> np.ndarray:
+        """
+        Background activity filter decisions of the events [idx_start, idx_end) (x, y, t), the same as if the whole
+        stream was filtered at once: the filter state is carried over from the previous slices and every event is
+        filtered once (also if windows overlap). Only the events within dt_us before an event can support it, hence
+        after a jump (or for the first slice) the filter starts dt_us before the slice instead of at the first event.
+        The starts of consecutive slices must not decrease, otherwise the filter starts over.
+        """
+        if idx_end == idx_start:
+            return np.zeros(0, dtype=bool)
+        if idx_start < self.ba_keep_start or idx_start > self.ba_idx_end:
+            warm_up_start = int(self.get_event_indices(
+                np.array([int(t[0]) + self.t_offset - self.ba_filter.dt_us]), side='left')[0])
+            if idx_start < self.ba_keep_start or warm_up_start > self.ba_idx_end:
+                self.ba_filter.reset()
+                self.ba_idx_end = warm_up_start
+            # The skipped events are filtered for the filter state only.
+            x_skipped, y_skipped, _, t_skipped = self._read_events(self.ba_idx_end, idx_start)
+            self.ba_filter(x_skipped, y_skipped, t_skipped)
+            self.ba_keep = np.zeros(0, dtype=bool)
+            self.ba_keep_start = self.ba_idx_end = idx_start
+        if idx_end > self.ba_idx_end:
+            offset = self.ba_idx_end - idx_start
+            keep_new = self.ba_filter(x[offset:], y[offset:], t[offset:])
+            self.ba_keep = np.concatenate((self.ba_keep[idx_start - self.ba_keep_start:], keep_new))
+            self.ba_keep_start = idx_start
+            self.ba_idx_end = idx_end
+        return self.ba_keep[idx_start - self.ba_keep_start:idx_end - self.ba_keep_start]
+
     def get_event_slice(self, idx_start: int, idx_end: int, convert_2_torch: bool = True):
         assert self.is_open
         assert idx_end >= idx_start
-        ev_data = self.h5f['events']
-        x_array = np.asarray(ev_data['x'][idx_start:idx_end], dtype='int64')
-        y_array = np.asarray(ev_data['y'][idx_start:idx_end], dtype='int64')
-        p_array = np.asarray(ev_data['p'][idx_start:idx_end], dtype='int64')
-        p_array = np.clip(p_array, a_min=0, a_max=None)
-        t_array = np.asarray(self.time[idx_start:idx_end], dtype='int64')
-        assert np.all(t_array[:-1] <= t_array[1:])
+        if self.prefetch_num_events is not None:
+            x_array, y_array, p_array, t_array = self._read_events_prefetched(idx_start, idx_end)
+        elif self.compact_slices:
+            x_array, y_array, p_array, t_array = self._read_events_compact(idx_start, idx_end, reuse_buffers=True)
+        else:
+            x_array, y_array, p_array, t_array = self._read_events(idx_start, idx_end)
+        if self.ba_filter is not None:
+            with get_profiler().stage('ba_filter'):
+                keep = self._ba_filter_keep(idx_start, idx_end, x_array, y_array, t_array)
+                x_array, y_array, p_array, t_array = x_array[keep], y_array[keep], p_array[keep], t_array[keep]
         ev_data = dict(
             x=x_array if not convert_2_torch else torch.from_numpy(x_array),
             y=y_array if not convert_2_torch else torch.from_numpy(y_array),
@@ -509,6 +1059,46 @@ class H5Reader:
         return ev_data
 
 
+    def get_event_batch(self, idx_starts: np.ndarray, idx_ends: np.ndarray, convert_2_torch: bool = True):
+        """
+        Events of several windows concatenated along the first dimension.
+        'offsets' (N + 1,) holds the start of each window in the concatenation and the total number of events.
+        Without the background activity filter the union of the windows is read at once.
+        """
+        assert len(idx_starts) == len(idx_ends) > 0
+        idx_starts = np.asarray(idx_starts, dtype='int64')
+        idx_ends = np.asarray(idx_ends, dtype='int64')
+        assert np.all(idx_ends >= idx_starts)
+        if self.ba_filter is not None:
+            # Windows are read (and filtered) one by one, the filter decisions are kept for the overlapping events.
+            windows = [self.get_event_slice(idx_start, idx_end, convert_2_torch=False)
+                       for idx_start, idx_end in zip(idx_starts, idx_ends)]
+            num_events = np.array([len(window['t']) for window in windows], dtype='int64')
+            arrays = {key: np.concatenate([window[key] for window in windows]) for key in ('x', 'y', 'p', 't')}
+        else:
+            union_start = int(idx_starts.min())
+            arrays = self.get_event_slice(union_start, int(idx_ends.max()), convert_2_torch=False)
+            num_events = idx_ends - idx_starts
+            is_contiguous = np.all(idx_starts[1:] == idx_ends[:-1])
+            if not is_contiguous:
+                # Overlapping (or unordered) windows: gather the events of each window.
+                num_total = int(num_events.sum())
+                gather_idx = np.arange(num_total, dtype='int64') - \
+                    np.repeat(np.cumsum(num_events) - num_events - (idx_starts - union_start), num_events)
+                arrays = {key: arrays[key][gather_idx] for key in ('x', 'y', 'p', 't')}
+        offsets = np.zeros(len(num_events) + 1, dtype='int64')
+        np.cumsum(num_events, out=offsets[1:])
+        return dict(
+            x=arrays['x'] if not convert_2_torch else torch.from_numpy(arrays['x']),
+            y=arrays['y'] if not convert_2_torch else torch.from_numpy(arrays['y']),
+            p=arrays['p'] if not convert_2_torch else torch.from_numpy(arrays['p']),
+            t=arrays['t'] if not convert_2_torch else torch.from_numpy(arrays['t']),
+            offsets=offsets if not convert_2_torch else torch.from_numpy(offsets),
+            height=self.height,
+            width=self.width,
+        )
+
+
 def prophesee_bbox_filter(labels: np.ndarray, dataset_type: str) -> np.ndarray:
     assert dataset_type in {'gen1', 'gen4', "gifu"}
 
@@ -761,36 +1351,79 @@ def labels_and_ev_repr_timestamps(npy_file: Path,
     return labels_per_frame, frame_timestamps_us, ev_repr_timestamps_us_end, frameidx_2_repridx
 
 
+@dataclass
+class EventReprTarget:
+    """An event representation with its window extraction, written to event_representations_v2/<name>."""
+    name: str
+    event_representation: RepresentationBase
+    ev_repr_num_events: Optional[int]
+    ev_repr_delta_ts_ms: Optional[int]
+    ts_step_ev_repr_ms: int
+    # Writer settings of the representation config (WriterConf), overridden by the writer_options of the CLI.
+    writer_options: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class EventReprJob:
+    """The event representations of one target for one sequence."""
+    ev_out_dir: Path
+    event_representation: RepresentationBase
+    ev_repr_num_events: Optional[int]
+    ev_repr_delta_ts_ms: Optional[int]
+    ev_repr_timestamps_us: np.ndarray
+    frameidx2repridx: np.ndarray
+    writer_options: Dict[str, Any] = field(default_factory=dict)
+
+
 def write_event_data(in_h5_file: Path,
-                     ev_out_dir: Path,
                      dataset: str,
-                     event_representation: RepresentationBase,
-                     ev_repr_num_events: Optional[int],
-                     ev_repr_delta_ts_ms: Optional[int],
-                     ev_repr_timestamps_us: np.ndarray,
+                     jobs: List[EventReprJob],
                      downsample_by_2: bool,
-                     frameidx2repridx: np.ndarray) -> None:
-    frameidx2repridx_file = ev_out_dir / 'objframe_idx_2_repr_idx.npy'
-    if frameidx2repridx_file.exists():
-        frameidx2repridx_loaded = np.load(str(frameidx2repridx_file))
-        assert np.array_equal(frameidx2repridx_loaded, frameidx2repridx)
-    else:
-        np.save(str(frameidx2repridx_file), frameidx2repridx)
-    timestamps_file = ev_out_dir / 'timestamps_us.npy'
-    if timestamps_file.exists():
-        timestamps_loaded = np.load(str(timestamps_file))
-        assert np.array_equal(timestamps_loaded, ev_repr_timestamps_us)
-    else:
-        np.save(str(timestamps_file), ev_repr_timestamps_us)
+                     reader_options: Optional[Dict[str, Any]] = None,
+                     writer_options: Optional[Dict[str, Any]] = None,
+                     output_format: str = 'h5',
+                     pipeline_depth: int = 0,
+                     batch_size: int = 1,
+                     incremental: bool = False,
+                     shard: Optional[Tuple[int, int]] = None,
+                     checkpoint_interval_s: Optional[float] = None) -> None:
+    """
+    :param shard: (shard index, number of shards) to write a part of the windows, see write_event_representations.
+    :param checkpoint_interval_s: Checkpoints of the writers to resume interrupted outputs, see
+                                  write_event_representations.
+    """
+    for job in jobs:
+        if shard is not None and shard[0] > 0:
+            # The first shard saves the files shared by all shards.
+            break
+        frameidx2repridx_file = job.ev_out_dir / 'objframe_idx_2_repr_idx.npy'
+        if frameidx2repridx_file.exists():
+            frameidx2repridx_loaded = np.load(str(frameidx2repridx_file))
+            assert np.array_equal(frameidx2repridx_loaded, job.frameidx2repridx)
+        else:
+            np.save(str(frameidx2repridx_file), job.frameidx2repridx)
+        timestamps_file = job.ev_out_dir / 'timestamps_us.npy'
+        if timestamps_file.exists():
+            timestamps_loaded = np.load(str(timestamps_file))
+            assert np.array_equal(timestamps_loaded, job.ev_repr_timestamps_us)
+        else:
+            np.save(str(timestamps_file), job.ev_repr_timestamps_us)
+    if shard is not None and shard[0] > 0 and reader_options is not None:
+        # The timestamps of the input file are validated once, by the first shard.
+        reader_options = dict(reader_options, validate_time=False)
     write_event_representations(in_h5_file=in_h5_file,
-                                ev_out_dir=ev_out_dir,
                                 dataset=dataset,
-                                event_representation=event_representation,
-                                ev_repr_num_events=ev_repr_num_events,
-                                ev_repr_delta_ts_ms=ev_repr_delta_ts_ms,
-                                ev_repr_timestamps_us=ev_repr_timestamps_us,
+                                jobs=jobs,
                                 downsample_by_2=downsample_by_2,
-                                overwrite_if_exists=False)
+                                overwrite_if_exists=False,
+                                reader_options=reader_options,
+                                writer_options=writer_options,
+                                output_format=output_format,
+                                pipeline_depth=pipeline_depth,
+                                batch_size=batch_size,
+                                incremental=incremental,
+                                shard=shard,
+                                checkpoint_interval_s=checkpoint_interval_s)
 
 
 def downsample_ev_repr(x: torch.Tensor, scale_factor: float):
@@ -806,113 +1439,788 @@ def downsample_ev_repr(x: torch.Tensor, scale_factor: float):
     return x
 
 
+def create_incremental_representation(event_representation) -> Optional[IncrementalRepresentation]:
+    """:return: incremental engine equivalent to the representation, None if it is not a count-type representation."""
+    if isinstance(event_representation, (StackedHistogram, StackedHistogramNumba)) and event_representation.bins == 1:
+        return IncrementalStackedHistogram(height=event_representation.height,
+                                           width=event_representation.width,
+                                           count_cutoff=event_representation.count_cutoff,
+                                           fastmode=event_representation.fastmode)
+    if isinstance(event_representation, (EventFrame, EventFrameNumba)):
+        return IncrementalEventFrame(height=event_representation.height,
+                                     width=event_representation.width,
+                                     downsample=event_representation.downsample,
+                                     policy=event_representation.policy,
+                                     min_count=event_representation.min_count,
+                                     background_color=event_representation.background_color,
+                                     encoding=event_representation.encoding)
+    return None
+
+
+class BackgroundIterator:
+    """
+    Consumes an iterator in a background thread and hands its items over through a bounded queue.
+    The queue size bounds the number of items that are read ahead (backpressure).
+    """
+    _END = object()
+
+    def __init__(self, iterable, maxsize: int):
+        assert maxsize > 0
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stop_event = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(iter(iterable),), daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put(item):
+                    return
+        except BaseException as e:
+            self.error = e
+        self._put(self._END)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._END:
+                    break
+                yield item
+        finally:
+            self.stop_event.set()
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class BackgroundConsumer:
+    """Calls consume_fn for every item put() into a bounded queue from a background thread."""
+    _END = object()
+
+    def __init__(self, consume_fn, maxsize: int):
+        assert maxsize > 0
+        self.consume_fn = consume_fn
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._END:
+                return
+            if self.error is None:
+                try:
+                    self.consume_fn(item)
+                except BaseException as e:
+                    # Keep draining the queue such that the producer never blocks.
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(self._END)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.queue.put(self._END)
+            self.thread.join()
+
+
+class EventReprStream:
+    """
+    The windows of one EventReprJob: which events to read (read_requests), how to compute the representations from
+    the read events (compute) and where to write them (writer).
+    """
+    def __init__(self,
+                 job: EventReprJob,
+                 h5_reader: H5Reader,
+                 writer: Union[H5Writer, NpyWriter, ChunkedDirWriter],
+                 downsample_by_2: bool,
+                 pipeline_depth: int,
+                 batch_size: int,
+                 incremental: bool):
+        self.h5_reader = h5_reader
+        self.writer = writer
+        self.event_representation = job.event_representation
+        # Representations built at half resolution are not downsampled again.
+        self.downsample_by_2 = ev_repr_downsampling(self.event_representation, downsample_by_2) == 'nearest'
+        self.batch_size = batch_size
+        # EventFrame state maps are packed to 2 bits per pixel after downsampling.
+        self.pack_states = getattr(self.event_representation, 'encoding', 'rgb') == 'packed'
+
+        with get_profiler().stage('event_indices'):
+            self.end_indices = h5_reader.get_event_indices(job.ev_repr_timestamps_us, side='right')
+            if job.ev_repr_num_events is not None:
+                self.start_indices = np.maximum(self.end_indices - job.ev_repr_num_events, 0)
+            else:
+                assert job.ev_repr_delta_ts_ms is not None
+                self.start_indices = h5_reader.get_event_indices(
+                    job.ev_repr_timestamps_us - job.ev_repr_delta_ts_ms * 1000, side='left')
+
+        self.use_torch = self.event_representation.backend == 'torch'
+        self.incremental_repr = None
+        if incremental and h5_reader.ba_filter is None:
+            self.incremental_repr = create_incremental_representation(self.event_representation)
+        self.use_batches = self.incremental_repr is None and batch_size > 1 and \
+            hasattr(self.event_representation, 'construct_batch')
+        if self.use_batches:
+            # Reused outputs must outlive the batches waiting to be written and the one being computed.
+            self.num_out_buffers = pipeline_depth + 3 if pipeline_depth > 0 else 1
+            out_shape = (batch_size,) + tuple(self.event_representation.get_shape())
+            if self.use_torch:
+                self.out_buffers = [torch.empty(out_shape, dtype=self.event_representation.get_torch_dtype())
+                                    for _ in range(self.num_out_buffers)]
+            else:
+                self.out_buffers = [np.empty(out_shape, dtype=self.event_representation.get_numpy_dtype())
+                                    for _ in range(self.num_out_buffers)]
+            self.out_buffer_idx = itertools.count()
+
+    def read_requests(self) -> Iterator[Tuple[int, Callable[[], Any]]]:
+        """
+        Yields (index of the first event to read, read function) in window order. The read function returns the
+        input of compute(). The first event indices are non-decreasing.
+        """
+        h5_reader = self.h5_reader
+        if self.incremental_repr is not None:
+            # Only the events entering the window are read, the engine keeps the events of the window.
+            idx_end_prev = 0
+            for idx_start, idx_end in zip(self.start_indices, self.end_indices):
+                added_idx_start = max(idx_end_prev, idx_start)
+                idx_end_prev = idx_end
+                yield added_idx_start, partial(self._read_added_events, added_idx_start, idx_start, idx_end)
+            return
+        if self.use_batches:
+            for idx in range(0, len(self.start_indices), self.batch_size):
+                idx_starts = self.start_indices[idx:idx + self.batch_size]
+                idx_ends = self.end_indices[idx:idx + self.batch_size]
+                yield idx_starts[0], partial(h5_reader.get_event_batch, idx_starts, idx_ends,
+                                             convert_2_torch=self.use_torch)
+            return
+        for idx_start, idx_end in zip(self.start_indices, self.end_indices):
+            yield idx_start, partial(h5_reader.get_event_slice, idx_start=idx_start, idx_end=idx_end,
+                                     convert_2_torch=self.use_torch)
+
+    def _read_added_events(self, added_idx_start: int, idx_start: int, idx_end: int):
+        return self.h5_reader.get_event_slice(added_idx_start, idx_end, convert_2_torch=False), idx_start, idx_end
+
+    def compute(self, ev_window) -> np.ndarray:
+        # Always returns a batch (N, C, H, W), N = 1 for single windows.
+        profiler = get_profiler()
+        with profiler.stage('construct'):
+            ev_repr = self._construct(ev_window)
+        # The incremental engine computes numpy arrays for all backends.
+        is_torch = self.use_torch and self.incremental_repr is None
+        if self.downsample_by_2:
+            with profiler.stage('downsample'):
+                ev_repr = downsample_ev_repr(x=ev_repr, scale_factor=0.5) if is_torch else \
+                    downsample_ev_repr_numpy(ev_repr)
+        if is_torch:
+            ev_repr = ev_repr.numpy()
+        if self.pack_states:
+            with profiler.stage('pack_states'):
+                ev_repr = pack_states(ev_repr)
+        return ev_repr
+
+    def _construct(self, ev_window):
+        if self.incremental_repr is not None:
+            return self.incremental_repr.update(*ev_window)[None]
+        if self.use_batches:
+            out = self.out_buffers[next(self.out_buffer_idx) % self.num_out_buffers]
+            return self.event_representation.construct_batch(x=ev_window['x'],
+                                                             y=ev_window['y'],
+                                                             pol=ev_window['p'],
+                                                             time=ev_window['t'],
+                                                             offsets=ev_window['offsets'],
+                                                             out=out)
+        return self.event_representation.construct(x=ev_window['x'],
+                                                    y=ev_window['y'],
+                                                    pol=ev_window['p'],
+                                                    time=ev_window['t'])[None]
+
+
+def create_ev_repr_writer(output_format: str,
+                          outfile: Path,
+                          ev_repr_shape: Tuple[int, int, int],
+                          numpy_dtype: np.dtype,
+                          attrs: Optional[Dict[str, Any]],
+                          num_frames: int,
+                          writer_options: Optional[Dict[str, Any]] = None,
+                          checkpoint_id: Optional[str] = None,
+                          checkpoint_interval_s: float = 60) -> Union[H5Writer, NpyWriter, ChunkedDirWriter]:
+    """
+    :param output_format: one of OUTPUT_FORMATS (see ev_repr_store.py).
+    :param writer_options: Chunking, buffering and compression (ignored by the uncompressed npy output).
+    :param checkpoint_id: Record checkpoints and resume an existing outfile with the same id (see H5Writer).
+    """
+    assert output_format in OUTPUT_FORMATS, f'{output_format=}'
+    writer_options = writer_options or dict()
+    checkpoint_options = dict(checkpoint_id=checkpoint_id, checkpoint_interval_s=checkpoint_interval_s)
+    if output_format == 'npy':
+        return NpyWriter(outfile, ev_repr_shape=ev_repr_shape, numpy_dtype=numpy_dtype, num_frames=num_frames,
+                         attrs=attrs, **checkpoint_options)
+    writer_class = ChunkedDirWriter if output_format == 'chunked' else partial(H5Writer, key='data')
+    return writer_class(outfile, ev_repr_shape=ev_repr_shape, numpy_dtype=numpy_dtype, attrs=attrs,
+                        num_frames=num_frames, **writer_options, **checkpoint_options)
+
+
+def ev_repr_checkpoint_id(timestamps_us: np.ndarray, settings: Dict[str, Any]) -> str:
+    """
+    Checksum of the window timestamps and the settings of the output (shape, dtype, compression, filter):
+    a checkpoint is only resumed by a writer of the same windows and settings.
+    """
+    checksum = zlib.crc32(np.ascontiguousarray(timestamps_us, dtype='int64').tobytes())
+    checksum = zlib.crc32(repr(sorted(settings.items())).encode(), checksum)
+    return f'{checksum:08x}'
+
+
+def ev_repr_output_files(path: Path) -> List[Path]:
+    """Output file (or directory) and the attributes and checkpoint files of npy outputs."""
+    return [path, path.with_suffix('.json'), npy_checkpoint_file(path)] if path.suffix == '.npy' else [path]
+
+
+def ev_repr_output_size(path: Path) -> int:
+    """Bytes on disk of an output (file or directory)."""
+    if path.is_dir():
+        return sum(child.stat().st_size for child in path.iterdir())
+    return path.stat().st_size
+
+
+def remove_ev_repr_output(path: Path):
+    for output_path in ev_repr_output_files(path):
+        if output_path.is_dir():
+            shutil.rmtree(output_path)
+        elif output_path.exists():
+            os.remove(output_path)
+
+
+def ev_repr_downsampling(event_representation: RepresentationBase, downsample_by_2: bool) -> Optional[str]:
+    """
+    :return: How the outputs of the representation are downsampled: None (full resolution), 'binned' (built at half
+             resolution, the events of 2x2 pixels are combined, EventFrame(downsample=True)) or 'nearest' (the full
+             resolution representation is downsampled with nearest-exact, downsample_ev_repr).
+    """
+    if not downsample_by_2:
+        return None
+    return 'binned' if getattr(event_representation, 'downsample', False) else 'nearest'
+
+
+def ev_repr_outfile(ev_out_dir: Path, downsampling: Optional[str], output_format: str) -> Path:
+    """:param downsampling: see ev_repr_downsampling."""
+    downsampling_str = f'_ds2_{downsampling}' if downsampling is not None else ''
+    return ev_out_dir / f'event_representations{downsampling_str}{output_suffix(output_format)}'
+
+
+def in_progress_path(path: Path) -> Path:
+    return path.parent / (path.stem + '_in_progress' + path.suffix)
+
+
+def shard_window_range(num_windows: int, shard: Tuple[int, int], frames_per_chunk: int) -> Tuple[int, int]:
+    """
+    Contiguous window index range [idx_start, idx_end) of shard (shard index, number of shards). The shard boundaries
+    are multiples of frames_per_chunk, such that the parts can be merged by copying whole chunks.
+    """
+    shard_idx, num_shards = shard
+    assert 0 <= shard_idx < num_shards
+
+    def boundary(idx: int) -> int:
+        if idx == num_shards:
+            return num_windows
+        return num_windows * idx // num_shards // frames_per_chunk * frames_per_chunk
+
+    return boundary(shard_idx), boundary(shard_idx + 1)
+
+
+def ev_repr_part_path(ev_outfile: Path, idx_start: int, idx_end: int) -> Path:
+    """Output of the windows [idx_start, idx_end) of ev_outfile."""
+    return ev_outfile.parent / f'{ev_outfile.stem}_part{idx_start:08d}-{idx_end:08d}{ev_outfile.suffix}'
+
+
+def find_ev_repr_parts(ev_outfile: Path) -> List[Tuple[int, int, Path]]:
+    """Completed parts (idx_start, idx_end, path) of ev_outfile, sorted."""
+    parts = list()
+    for path in ev_outfile.parent.glob(f'{ev_outfile.stem}_part*{ev_outfile.suffix}'):
+        match = re.fullmatch(rf'{re.escape(ev_outfile.stem)}_part(\d+)-(\d+)', path.stem)
+        if match is not None:
+            parts.append((int(match.group(1)), int(match.group(2)), path))
+    return sorted(parts)
+
+
+def merge_h5_parts(part_files: List[Path], outfile: Path):
+    """
+    Concatenates the datasets 'data' of h5 files of consecutive frames. Chunks are copied without decompression if
+    the parts have the same chunking and compression and are aligned to chunks.
+    """
+    shutil.copyfile(part_files[0], outfile)
+    with h5py.File(str(outfile), 'r+') as h5f:
+        data = h5f['data']
+        t_idx = len(data)
+        data.resize(t_idx + sum(get_h5_num_frames(part_file) for part_file in part_files[1:]), axis=0)
+        frames_per_chunk = data.chunks[0]
+        for part_file in part_files[1:]:
+            with h5py.File(str(part_file), 'r') as h5f_part:
+                part = h5f_part['data']
+                is_raw_copy = part.chunks == data.chunks and t_idx % frames_per_chunk == 0 and \
+                    get_h5_filters(part) == get_h5_filters(data)
+                if is_raw_copy:
+                    for chunk_start in range(0, len(part), frames_per_chunk):
+                        filter_mask, chunk = part.id.read_direct_chunk((chunk_start, 0, 0, 0))
+                        data.id.write_direct_chunk((t_idx + chunk_start, 0, 0, 0), chunk, filter_mask)
+                else:
+                    data[t_idx:t_idx + len(part)] = part[:]
+                t_idx += len(part)
+
+
+def get_h5_filters(dataset: h5py.Dataset) -> List[Tuple]:
+    """(filter id, flags, parameters) of the filter pipeline (compression) of a dataset."""
+    plist = dataset.id.get_create_plist()
+    return [plist.get_filter(idx)[:3] for idx in range(plist.get_nfilters())]
+
+
+def get_h5_num_frames(h5_file: Path) -> int:
+    with h5py.File(str(h5_file), 'r') as h5f:
+        return len(h5f['data'])
+
+
+def merge_ev_repr_parts(ev_outfile: Path, num_windows: int) -> bool:
+    """
+    Merges the parts of ev_outfile if they cover all num_windows windows. As for a sequence written at once, the
+    merged output is written as *_in_progress and renamed when complete. The parts are removed afterwards.
+    :return: True if ev_outfile exists.
+    """
+    parts = find_ev_repr_parts(ev_outfile)
+    if not ev_outfile.exists():
+        # Parts that chain from window 0 to num_windows.
+        part_files, idx_next = list(), 0
+        for idx_start, idx_end, path in parts:
+            if idx_start == idx_next and idx_end > idx_start:
+                part_files.append(path)
+                idx_next = idx_end
+        if idx_next != num_windows or len(part_files) == 0:
+            return False
+        ev_outfile_in_progress = in_progress_path(ev_outfile)
+        remove_ev_repr_output(ev_outfile_in_progress)
+        if ev_outfile.suffix == '.npy':
+            merge_npy_files(part_files, ev_outfile_in_progress)
+        elif ev_outfile.suffix == output_suffix('chunked'):
+            merge_chunked_dirs(part_files, ev_outfile_in_progress)
+        else:
+            merge_h5_parts(part_files, ev_outfile_in_progress)
+        for path_in_progress, path in zip(ev_repr_output_files(ev_outfile_in_progress), ev_repr_output_files(ev_outfile)):
+            if path_in_progress.exists():
+                os.rename(path_in_progress, path)
+    for _, _, path in parts:
+        remove_ev_repr_output(path)
+    return True
+
+
+# Block size of the shared event reads if several jobs are written at once.
+MULTI_JOB_PREFETCH_NUM_EVENTS = 2 ** 20
+
+
 def write_event_representations(in_h5_file: Path,
-                                ev_out_dir: Path,
                                 dataset: str,
-                                event_representation: RepresentationBase,
-                                ev_repr_num_events: Optional[int],
-                                ev_repr_delta_ts_ms: Optional[int],
-                                ev_repr_timestamps_us: np.ndarray,
+                                jobs: List[EventReprJob],
                                 downsample_by_2: bool,
-                                overwrite_if_exists: bool = False) -> None:
-    ev_outfile = ev_out_dir / f"event_representations{'_ds2_nearest' if downsample_by_2 else ''}.h5"
-    if ev_outfile.exists() and not overwrite_if_exists:
+                                overwrite_if_exists: bool = False,
+                                reader_options: Optional[Dict[str, Any]] = None,
+                                writer_options: Optional[Dict[str, Any]] = None,
+                                output_format: str = 'h5',
+                                pipeline_depth: int = 0,
+                                batch_size: int = 1,
+                                incremental: bool = False,
+                                shard: Optional[Tuple[int, int]] = None,
+                                checkpoint_interval_s: Optional[float] = None) -> None:
+    """
+    Writes the event representations of all jobs of a sequence. The input file is opened once and the windows of all
+    jobs are read in the order of their first event, such that every event is read once (for several jobs through a
+    sliding block of events) and fanned out to the representation and the writer of its job.
+    :param writer_options: Additional keyword arguments of the writer (chunking, buffering, compression).
+                           They override the writer options of the jobs.
+    :param output_format: one of OUTPUT_FORMATS: h5 (H5Writer), npy or chunked (see ev_repr_store.py).
+    :param pipeline_depth: If > 0, event windows are read by a background thread and the representations are
+                           compressed and written by another background thread. pipeline_depth is the size of the
+                           bounded queues between the stages. If 0, all stages run sequentially.
+    :param batch_size: If > 1 and the representation implements construct_batch, this many consecutive windows
+                       are constructed at once.
+    :param incremental: Update a running state with the events entering and leaving the window instead of
+                        rebuilding overlapping windows (count-type representations, without background activity
+                        filter: the engine tracks the events of the window by their index).
+    :param shard: (shard index, number of shards): Only the windows of the shard (shard_window_range) are written,
+                  to a part file of the output. The parts are merged by merge_ev_repr_parts.
+    :param checkpoint_interval_s: If set, the writers record the number of written windows at most every
+                                  checkpoint_interval_s seconds. A stale *_in_progress output of the same windows and
+                                  settings is resumed after its last checkpoint instead of being written again.
+    """
+    pending_jobs = list()
+    for job in jobs:
+        ev_outfile = ev_repr_outfile(job.ev_out_dir, ev_repr_downsampling(job.event_representation, downsample_by_2),
+                                     output_format)
+        if ev_outfile.exists() and not overwrite_if_exists:
+            continue
+        if shard is not None:
+            frames_per_chunk = 1 if output_format == 'npy' else \
+                dict(job.writer_options, **(writer_options or dict())).get('frames_per_chunk', 1)
+            idx_start, idx_end = shard_window_range(len(job.ev_repr_timestamps_us), shard, frames_per_chunk)
+            ev_outfile = ev_repr_part_path(ev_outfile, idx_start, idx_end)
+            if idx_end == idx_start or (ev_outfile.exists() and not overwrite_if_exists):
+                continue
+            # Windows are independent: a shard starts like a sequence of its own (also the incremental state).
+            job = replace(job, ev_repr_timestamps_us=job.ev_repr_timestamps_us[idx_start:idx_end])
+        ev_outfile_in_progress = in_progress_path(ev_outfile)
+        if checkpoint_interval_s is None:
+            remove_ev_repr_output(ev_outfile_in_progress)
+        pending_jobs.append((job, ev_outfile, ev_outfile_in_progress))
+    if len(pending_jobs) == 0:
         return
-    ev_outfile_in_progress = ev_outfile.parent / (ev_outfile.stem + '_in_progress' + ev_outfile.suffix)
-    if ev_outfile_in_progress.exists():
-        os.remove(ev_outfile_in_progress)
-    ev_repr_shape = tuple(event_representation.get_shape())
-    if downsample_by_2:
-        ev_repr_shape = ev_repr_shape[0], ev_repr_shape[1] // 2, ev_repr_shape[2] // 2
-    ev_repr_dtype = event_representation.get_numpy_dtype()
-    with H5Reader(in_h5_file, dataset=dataset) as h5_reader, \
-            H5Writer(ev_outfile_in_progress,
-                     key='data',
-                     ev_repr_shape=ev_repr_shape,
-                     numpy_dtype=ev_repr_dtype) as h5_writer:
+    # reader_options: additional keyword arguments of H5Reader (denoising, prefetching, chunk cache)
+    reader_options = dict(reader_options or dict())
+    if len(pending_jobs) > 1 and reader_options.get('prefetch_num_events') is None:
+        reader_options['prefetch_num_events'] = MULTI_JOB_PREFETCH_NUM_EVENTS
+    if pipeline_depth > 0:
+        # Reused slice buffers must outlive the windows waiting in the queue and the one being computed.
+        reader_options['num_slice_buffers'] = pipeline_depth + 3
+    profiler = get_profiler()
+    with H5Reader(in_h5_file, dataset=dataset, **reader_options) as h5_reader, contextlib.ExitStack() as writers:
         height, width = h5_reader.get_height_and_width()
-        if downsample_by_2:
-            assert (height // 2, width // 2) == ev_repr_shape[-2:]
-        else:
-            assert (height, width) == ev_repr_shape[-2:]
-        ev_ts_us = h5_reader.time
-
-        end_indices = np.searchsorted(ev_ts_us, ev_repr_timestamps_us, side='right')
-        if ev_repr_num_events is not None:
-            start_indices = np.maximum(end_indices - ev_repr_num_events, 0)
-        else:
-            assert ev_repr_delta_ts_ms is not None
-            start_indices = np.searchsorted(ev_ts_us, ev_repr_timestamps_us - ev_repr_delta_ts_ms * 1000, side='left')
-
-        for idx_start, idx_end in zip(start_indices, end_indices):
-            ev_window = h5_reader.get_event_slice(idx_start=idx_start, idx_end=idx_end)
-
-            ev_repr = event_representation.construct(x=ev_window['x'],
-                                                     y=ev_window['y'],
-                                                     pol=ev_window['p'],
-                                                     time=ev_window['t'])
-            if downsample_by_2:
-                ev_repr = ev_repr.unsqueeze(0)
-                ev_repr = downsample_ev_repr(x=ev_repr, scale_factor=0.5)
-                ev_repr_numpy = ev_repr.numpy()[0]
+        streams = list()
+        for job, _, ev_outfile_in_progress in pending_jobs:
+            ev_repr_shape = tuple(job.event_representation.get_shape())
+            downsampling = ev_repr_downsampling(job.event_representation, downsample_by_2)
+            if downsampling == 'nearest':
+                ev_repr_shape = ev_repr_shape[0], ev_repr_shape[1] // 2, ev_repr_shape[2] // 2
+            if downsampling is not None:
+                assert (height // 2, width // 2) == ev_repr_shape[-2:]
             else:
-                ev_repr_numpy = ev_repr.numpy()
-            h5_writer.add_data(ev_repr_numpy)
-        num_written_ev_repr = h5_writer.get_current_length()
-    assert num_written_ev_repr == len(ev_repr_timestamps_us)
-    os.rename(ev_outfile_in_progress, ev_outfile)
+                assert (height, width) == ev_repr_shape[-2:]
+            attrs = None
+            encoding = getattr(job.event_representation, 'encoding', 'rgb')
+            if encoding != 'rgb':
+                attrs = storage_attrs(encoding=encoding,
+                                      width=ev_repr_shape[2],
+                                      background_color=job.event_representation.background_color)
+                if encoding == 'packed':
+                    ev_repr_shape = packed_shape(ev_repr_shape)
+            numpy_dtype = job.event_representation.get_numpy_dtype()
+            job_writer_options = dict(job.writer_options, **(writer_options or dict()))
+            checkpoint_id = None
+            if checkpoint_interval_s is not None:
+                settings = {key: value for key, value in job_writer_options.items() if key != 'buffer_frames'}
+                settings.update(shape=ev_repr_shape, dtype=np.dtype(numpy_dtype).str, attrs=attrs,
+                                output_format=output_format, ba_filter_dt_us=reader_options.get('ba_filter_dt_us'),
+                                ba_filter_radius=reader_options.get('ba_filter_radius'))
+                checkpoint_id = ev_repr_checkpoint_id(job.ev_repr_timestamps_us, settings)
+            writer = writers.enter_context(create_ev_repr_writer(
+                output_format=output_format,
+                outfile=ev_outfile_in_progress,
+                ev_repr_shape=ev_repr_shape,
+                numpy_dtype=numpy_dtype,
+                attrs=attrs,
+                num_frames=len(job.ev_repr_timestamps_us),
+                writer_options=job_writer_options,
+                checkpoint_id=checkpoint_id,
+                checkpoint_interval_s=checkpoint_interval_s))
+            num_resumed = writer.get_current_length()
+            if num_resumed > 0:
+                print(f'{ev_outfile_in_progress}: resuming after {num_resumed}/{len(job.ev_repr_timestamps_us)} '
+                      f'windows')
+                # The windows are independent: the remaining windows are written like a sequence of their own.
+                job = replace(job, ev_repr_timestamps_us=job.ev_repr_timestamps_us[num_resumed:])
+            streams.append(EventReprStream(job=job,
+                                           h5_reader=h5_reader,
+                                           writer=writer,
+                                           downsample_by_2=downsample_by_2,
+                                           pipeline_depth=pipeline_depth,
+                                           batch_size=batch_size,
+                                           incremental=incremental))
+
+        def read_windows():
+            # Reads of all streams merged in the order of their first event.
+            requests = heapq.merge(*(zip(itertools.repeat(stream), stream.read_requests()) for stream in streams),
+                                   key=lambda request: request[1][0])
+            for stream, (_, read) in requests:
+                with profiler.stage('read'):
+                    ev_window = read()
+                yield stream, ev_window
+
+        def compute(item):
+            stream, ev_window = item
+            return stream, stream.compute(ev_window)
+
+        def write(item):
+            stream, ev_repr = item
+            profiler.count('windows', len(ev_repr))
+            profiler.count('bytes_raw', ev_repr.nbytes)
+            # includes the compression of the written chunks
+            with profiler.stage('write'):
+                stream.writer.add_data_batch(ev_repr)
+
+        if pipeline_depth > 0:
+            # read -> compute -> write, each stage in its own thread with bounded queues in between.
+            with BackgroundConsumer(write, maxsize=pipeline_depth) as writer:
+                for item in BackgroundIterator(read_windows(), maxsize=pipeline_depth):
+                    writer.put(compute(item))
+        else:
+            for item in read_windows():
+                write(compute(item))
+        num_written_ev_repr = [stream.writer.get_current_length() for stream in streams]
+        # Writes the buffered representations
+        with profiler.stage('close'):
+            writers.close()
+        if h5_reader.ba_filter is not None:
+            ba_filter = h5_reader.ba_filter
+            print(f'{in_h5_file}: background activity filter removed '
+                  f'{ba_filter.num_events_in - ba_filter.num_events_kept}/{ba_filter.num_events_in} events '
+                  f'({100 * ba_filter.removed_fraction:.1f}%)')
+    # pending_jobs hold all windows of the outputs (including resumed ones)
+    for (job, ev_outfile, ev_outfile_in_progress), num_written in zip(pending_jobs, num_written_ev_repr):
+        assert num_written == len(job.ev_repr_timestamps_us)
+        remove_ev_repr_output(ev_outfile)
+        for path_in_progress, path in zip(ev_repr_output_files(ev_outfile_in_progress), ev_repr_output_files(ev_outfile)):
+            if path_in_progress.exists():
+                os.rename(path_in_progress, path)
+        if profiler.enabled:
+            profiler.count('bytes_written', ev_repr_output_size(ev_outfile))
 
 
 def process_sequence(dataset: str,
                      filter_cfg: DictConfig,
-                     event_representation: RepresentationBase,
-                     ev_repr_num_events: Optional[int],
-                     ev_repr_delta_ts_ms: Optional[int],
-                     ts_step_ev_repr_ms: int,
+                     targets: List[EventReprTarget],
                      downsample_by_2: bool,
-                     sequence_data: Dict[DataKeys, Union[Path, SplitType]]):
+                     sequence_data: Dict[DataKeys, Union[Path, SplitType]],
+                     reader_options: Optional[Dict[str, Any]] = None,
+                     writer_options: Optional[Dict[str, Any]] = None,
+                     output_format: str = 'h5',
+                     pipeline_depth: int = 0,
+                     batch_size: int = 1,
+                     incremental: bool = False,
+                     shard: Optional[Tuple[int, int]] = None,
+                     checkpoint_interval_s: Optional[float] = None):
+    """
+    :param shard: (shard index, number of shards) to write the part of the windows of a shard of the sequence.
+    :param checkpoint_interval_s: Checkpoints of the writers to resume interrupted outputs.
+    """
     in_npy_file = sequence_data[DataKeys.InNPY]
     in_h5_file = sequence_data[DataKeys.InH5]
     out_labels_dir = sequence_data[DataKeys.OutLabelDir]
+    # Parent directory of the output directories of the targets (event_representations_v2)
     out_ev_repr_dir = sequence_data[DataKeys.OutEvReprDir]
     split_type = sequence_data[DataKeys.SplitType]
     assert out_labels_dir.is_dir()
-    assert ts_step_ev_repr_ms > 0
-    assert bool(ev_repr_num_events is not None) ^ bool(ev_repr_delta_ts_ms is not None), \
-        f'{ev_repr_num_events=}, {ev_repr_delta_ts_ms=}'
+    assert len(targets) > 0
+    for target in targets:
+        assert target.ts_step_ev_repr_ms > 0
+        assert bool(target.ev_repr_num_events is not None) ^ bool(target.ev_repr_delta_ts_ms is not None), \
+            f'{target.ev_repr_num_events=}, {target.ev_repr_delta_ts_ms=}'
 
     # 1) extract: labels_per_frame, frame_timestamps_us, ev_repr_timestamps_us, frameidx2repridx
+    # The labels do not depend on the targets, the ev repr timestamps only on ts_step_ev_repr_ms.
     align_t_ms = 100
+    ts_step_2_ev_repr_timestamps = dict()
+    profiler = get_profiler()
     try:
-        labels_per_frame, frame_timestamps_us, ev_repr_timestamps_us, frameidx2repridx = \
-            labels_and_ev_repr_timestamps(
-                npy_file=in_npy_file,
-                split_type=split_type,
-                filter_cfg=filter_cfg,
-                align_t_ms=align_t_ms,
-                ts_step_ev_repr_ms=ts_step_ev_repr_ms,
-                dataset_type=dataset)
+        for ts_step_ev_repr_ms in sorted({target.ts_step_ev_repr_ms for target in targets}):
+            with profiler.stage('labels'):
+                labels_per_frame, frame_timestamps_us, ev_repr_timestamps_us, frameidx2repridx = \
+                    labels_and_ev_repr_timestamps(
+                        npy_file=in_npy_file,
+                        split_type=split_type,
+                        filter_cfg=filter_cfg,
+                        align_t_ms=align_t_ms,
+                        ts_step_ev_repr_ms=ts_step_ev_repr_ms,
+                        dataset_type=dataset)
+            ts_step_2_ev_repr_timestamps[ts_step_ev_repr_ms] = ev_repr_timestamps_us, frameidx2repridx
     except NoLabelsException:
+        if shard is not None and shard[0] > 0:
+            return
         parent_dir = out_labels_dir.parent
         print(f'No labels after filtering. Deleting {str(parent_dir)}')
         shutil.rmtree(parent_dir)
         return
 
     # 2) save: labels_per_frame, frame_timestamps_us
-    save_labels(out_labels_dir=out_labels_dir,
-                labels_per_frame=labels_per_frame,
-                frame_timestamps_us=frame_timestamps_us)
-
-    # 3) retrieve event data, compute event representations and save them
+    if shard is None or shard[0] == 0:
+        with profiler.stage('save_labels'):
+            save_labels(out_labels_dir=out_labels_dir,
+                        labels_per_frame=labels_per_frame,
+                        frame_timestamps_us=frame_timestamps_us)
+
+    # 3) retrieve event data once, compute the event representations of all targets and save them
+    jobs = list()
+    for target in targets:
+        ev_repr_timestamps_us, frameidx2repridx = ts_step_2_ev_repr_timestamps[target.ts_step_ev_repr_ms]
+        ev_out_dir = out_ev_repr_dir / target.name
+        os.makedirs(ev_out_dir, exist_ok=True)
+        jobs.append(EventReprJob(ev_out_dir=ev_out_dir,
+                                 event_representation=target.event_representation,
+                                 ev_repr_num_events=target.ev_repr_num_events,
+                                 ev_repr_delta_ts_ms=target.ev_repr_delta_ts_ms,
+                                 ev_repr_timestamps_us=ev_repr_timestamps_us,
+                                 frameidx2repridx=frameidx2repridx,
+                                 writer_options=target.writer_options))
     write_event_data(in_h5_file=in_h5_file,
-                     ev_out_dir=out_ev_repr_dir,
                      dataset=dataset,
-                     event_representation=event_representation,
-                     ev_repr_num_events=ev_repr_num_events,
-                     ev_repr_delta_ts_ms=ev_repr_delta_ts_ms,
-                     ev_repr_timestamps_us=ev_repr_timestamps_us,
+                     jobs=jobs,
                      downsample_by_2=downsample_by_2,
-                     frameidx2repridx=frameidx2repridx)
+                     reader_options=reader_options,
+                     writer_options=writer_options,
+                     output_format=output_format,
+                     pipeline_depth=pipeline_depth,
+                     batch_size=batch_size,
+                     incremental=incremental,
+                     shard=shard,
+                     checkpoint_interval_s=checkpoint_interval_s)
+
+
+def process_sequence_profiled(profile: bool, **process_kwargs) -> Optional[Dict[str, Any]]:
+    """Runs process_sequence. :return: The profiling report (see profiling.py) if profile is set, else None."""
+    t_start = time.perf_counter()
+    with profiling(enabled=profile) as profiler:
+        process_sequence(**process_kwargs)
+    return profiler.report(wall_s=time.perf_counter() - t_start) if profile else None
+
+
+def merge_sequence_parts(sequence_data: Dict[DataKeys, Union[Path, SplitType]],
+                         targets: List[EventReprTarget],
+                         downsample_by_2: bool,
+                         output_format: str = 'h5') -> bool:
+    """Merges the parts written by the shards of a sequence. :return: False if parts are missing."""
+    is_complete = True
+    for target in targets:
+        ev_out_dir = sequence_data[DataKeys.OutEvReprDir] / target.name
+        timestamps_file = ev_out_dir / 'timestamps_us.npy'
+        if not timestamps_file.exists():
+            # deleted sequence (no labels)
+            continue
+        num_windows = len(np.load(str(timestamps_file)))
+        ev_outfile = ev_repr_outfile(ev_out_dir, ev_repr_downsampling(target.event_representation, downsample_by_2),
+                                     output_format)
+        if not merge_ev_repr_parts(ev_outfile, num_windows):
+            print(f'Missing parts of {ev_outfile}')
+            is_complete = False
+    return is_complete
+
+
+def assign_node_shards(sequence_costs: Dict[str, int], num_shards: int) -> Dict[str, int]:
+    """
+    Assigns the sequences (key: <split>/<sequence>) of a dataset to num_shards shards, e.g. one per machine, with
+    balanced costs: the sequences in order of decreasing cost (ties by key) go to the shard with the least total cost
+    (ties by shard index). The assignment only depends on the keys and costs, i.e. it is the same on every machine.
+    :return: shard index per sequence key.
+    """
+    shard_costs = [(0, shard_index) for shard_index in range(num_shards)]
+    assignment = dict()
+    for key in sorted(sequence_costs, key=lambda key: (-sequence_costs[key], key)):
+        total_cost, shard_index = heapq.heappop(shard_costs)
+        assignment[key] = shard_index
+        heapq.heappush(shard_costs, (total_cost + sequence_costs[key], shard_index))
+    return assignment
+
+
+def shard_manifest_path(target_dir: Path, shard_index: int, num_shards: int) -> Path:
+    return target_dir / 'manifests' / f'shard_{shard_index:03d}_of_{num_shards:03d}.json'
+
+
+def write_shard_manifest(path: Path, manifest: Dict[str, Any]):
+    """
+    Manifest of a node shard: the sequences of the dataset with their costs, the sequences assigned to the shard, the
+    outputs (targets, format) and the finished sequences ('done' or 'no_labels'). Replaced atomically after every
+    finished sequence. See verify_shards.py.
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    path_tmp = path.parent / (path.name + '.tmp')
+    with open(path_tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path_tmp, path)
+
+
+def estimate_sequence_cost(sequence_data: Dict[DataKeys, Union[Path, SplitType]]) -> int:
+    """Processing cost of a sequence: its number of events (or the size of the h5 file if unreadable)."""
+    in_h5_file = sequence_data[DataKeys.InH5]
+    try:
+        with h5py.File(str(in_h5_file), 'r') as h5f:
+            return int(h5f['events']['t'].shape[0])
+    except (OSError, KeyError):
+        return os.path.getsize(in_h5_file)
+
+
+def warm_up_representation(event_representation):
+    """Constructs a representation of a single event, such that JIT compilation is not part of the first sequence."""
+    events = dict(x=np.zeros(1, dtype='int64'), y=np.zeros(1, dtype='int64'),
+                  p=np.ones(1, dtype='int64'), t=np.zeros(1, dtype='int64'))
+    if event_representation.backend == 'torch':
+        events = {key: torch.from_numpy(value) for key, value in events.items()}
+    event_representation.construct(x=events['x'], y=events['y'], pol=events['p'], time=events['t'])
+
+
+# process_sequence arguments shared by all sequences, set once per worker process by init_worker.
+_worker_kwargs: Optional[Dict[str, Any]] = None
+_worker_profile = False
+
+
+def init_worker(process_kwargs: Dict[str, Any], profile: bool = False):
+    global _worker_kwargs, _worker_profile
+    _worker_kwargs = process_kwargs
+    _worker_profile = profile
+    for target in process_kwargs['targets']:
+        warm_up_representation(target.event_representation)
+
+
+def process_sequence_in_worker(task: Tuple[Dict[DataKeys, Union[Path, SplitType]], Optional[Tuple[int, int]]]) \
+        -> Tuple[Path, Optional[Dict[str, Any]], int, float, float]:
+    """
+    :param task: (sequence data, shard or None for the whole sequence).
+    :return: (output directory of the sequence, profiling report or None, process id, start time, end time).
+    """
+    assert _worker_kwargs is not None, 'init_worker was not called'
+    sequence_data, shard = task
+    t_start = time.time()
+    report = process_sequence_profiled(_worker_profile, sequence_data=sequence_data, shard=shard, **_worker_kwargs)
+    return sequence_data[DataKeys.OutEvReprDir], report, os.getpid(), t_start, time.time()
+
+
+def print_worker_utilization(task_times: List[Tuple[int, float, float]], t_pool_start: float, t_pool_end: float):
+    """
+    Per worker: startup time (spawn, imports and init_worker until the first sequence), busy time and idle time at
+    the end (waiting for the last sequences of other workers).
+    """
+    wall_s = t_pool_end - t_pool_start
+    pid_2_times = dict()
+    for pid, t_start, t_end in task_times:
+        pid_2_times.setdefault(pid, list()).append((t_start, t_end))
+    print(f'worker utilization (wall time {wall_s:.1f}s):')
+    total_busy_s = 0
+    for pid, times in sorted(pid_2_times.items()):
+        busy_s = sum(t_end - t_start for t_start, t_end in times)
+        total_busy_s += busy_s
+        startup_s = min(t_start for t_start, _ in times) - t_pool_start
+        tail_idle_s = t_pool_end - max(t_end for _, t_end in times)
+        print(f'  pid {pid}: {len(times)} tasks, startup {startup_s:.1f}s, '
+              f'busy {busy_s:.1f}s ({100 * busy_s / wall_s:.1f}%), idle at the end {tail_idle_s:.1f}s')
+    print(f'  total: {100 * total_busy_s / (wall_s * len(pid_2_times)):.1f}% busy')
 
 
 class AggregationType(Enum):
@@ -932,6 +2240,15 @@ class FilterConf:
     apply_faulty_bbox_filter: bool = MISSING
 
 
+@dataclass
+class WriterConf:
+    # Output chunking and compression, see bench_repr_codecs.py to choose them per representation.
+    codec: Optional[str] = None  # None: blosc:zstd (h5), gzip (chunked)
+    complevel: int = 1
+    shuffle: str = 'byte'
+    frames_per_chunk: int = 1
+
+
 @dataclass
 class EventWindowExtractionConf:
     method: AggregationType = MISSING
@@ -945,7 +2262,15 @@ adding Event Frame Conf
 class EventFrameConf:
     name: str = MISSING  # 必須: イベントフレームの名前
     background_color: int = 114  # 背景色（0〜255のグレースケール値）
+    policy: str = 'off_priority'  # ON/OFF両方のイベントがある画素の色: off_priority, last, majority, count
+    min_count: int = 2  # policy=count: 色を付けるのに必要な画素あたりの最小イベント数
+    encoding: str = 'rgb'  # 保存形式: rgb (3ch RGB), state (1ch 状態マップ), packed (2bit/画素の状態マップ)
+    # gen4 (半解像度で保存) の縮小方法: nearest (全解像度で構築後に nearest-exact, *_ds2_nearest) または
+    # binned (2x2画素のイベントをまとめて半解像度で直接構築, *_ds2_binned)
+    downsample: str = 'nearest'
     event_window_extraction: EventWindowExtractionConf = field(default_factory=EventWindowExtractionConf)
+    writer: WriterConf = field(default_factory=WriterConf)
+    backend: str = 'torch'  # torch or numba
 
 
 @dataclass
@@ -954,7 +2279,9 @@ class StackedHistogramConf:
     nbins: int = MISSING
     count_cutoff: Optional[int] = MISSING
     event_window_extraction: EventWindowExtractionConf = field(default_factory=EventWindowExtractionConf)
+    writer: WriterConf = field(default_factory=WriterConf)
     fastmode: bool = True
+    backend: str = 'torch'  # torch or numba
 
 
 @dataclass
@@ -963,6 +2290,8 @@ class MixedDensityEventStackConf:
     nbins: int = MISSING
     count_cutoff: Optional[int] = MISSING
     event_window_extraction: EventWindowExtractionConf = field(default_factory=EventWindowExtractionConf)
+    writer: WriterConf = field(default_factory=WriterConf)
+    backend: str = 'torch'  # torch or numba
 
 
 """
@@ -985,9 +2314,22 @@ class EventRepresentationFactory(ABC):
         ...
 
     @abstractmethod
-    def create(self, height: int, width: int) -> Any:
+    def create(self, height: int, width: int, downsample_by_2: bool = False) -> Any:
+        """
+        :param downsample_by_2: The outputs are written at half resolution. Representations configured to be built at
+                                half resolution directly (EventFrame with downsample: binned) are created so, the
+                                others are downsampled after the construction (see ev_repr_downsampling).
+        """
         ...
 
+    @property
+    def use_numba(self) -> bool:
+        backend = self.config.backend
+        assert backend in ('torch', 'numba'), f'{backend=}'
+        if backend == 'torch' and torch is None:
+            raise ImportError('torch is not installed, set "backend: numba" in the representation config')
+        return backend == 'numba'
+
 """
 adding Event Frae Factory
 """
@@ -996,11 +2338,25 @@ class EventFrameFactory(EventRepresentationFactory):
     @property
     def name(self) -> str:
         extraction = self.config.event_window_extraction
-        return f'{self.config.name}_{aggregation_2_string[extraction.method]}={extraction.ev_repr_delta_ts_ms}'
-
-
-    def create(self, height: int, width: int) -> EventFrame:
-        return EventFrame(height=height, width=width)
+        policy_str = ''
+        if self.config.policy != 'off_priority':
+            policy_str = f'_policy={self.config.policy}'
+            if self.config.policy == 'count':
+                policy_str += f'{self.config.min_count}'
+        encoding_str = f'_enc={self.config.encoding}' if self.config.encoding != 'rgb' else ''
+        return f'{self.config.name}_{aggregation_2_string[extraction.method]}={extraction.ev_repr_delta_ts_ms}{policy_str}{encoding_str}'
+
+
+    def create(self, height: int, width: int, downsample_by_2: bool = False) -> EventFrame:
+        assert self.config.downsample in ('nearest', 'binned'), f'{self.config.downsample=}'
+        ev_repr_class = EventFrameNumba if self.use_numba else EventFrame
+        return ev_repr_class(height=height,
+                             width=width,
+                             downsample=downsample_by_2 and self.config.downsample == 'binned',
+                             policy=self.config.policy,
+                             min_count=self.config.min_count,
+                             background_color=self.config.background_color,
+                             encoding=self.config.encoding)
 
 
 class StackedHistogramFactory(EventRepresentationFactory):
@@ -1009,12 +2365,13 @@ class StackedHistogramFactory(EventRepresentationFactory):
         extraction = self.config.event_window_extraction
         return f'{self.config.name}_{aggregation_2_string[extraction.method]}={extraction.ev_repr_delta_ts_ms}_nbins={self.config.nbins}'
 
-    def create(self, height: int, width: int) -> StackedHistogram:
-        return StackedHistogram(bins=self.config.nbins,
-                                height=height,
-                                width=width,
-                                count_cutoff=self.config.count_cutoff,
-                                fastmode=self.config.fastmode)
+    def create(self, height: int, width: int, downsample_by_2: bool = False) -> StackedHistogram:
+        ev_repr_class = StackedHistogramNumba if self.use_numba else StackedHistogram
+        return ev_repr_class(bins=self.config.nbins,
+                             height=height,
+                             width=width,
+                             count_cutoff=self.config.count_cutoff,
+                             fastmode=self.config.fastmode)
 
 
 class MixedDensityStackFactory(EventRepresentationFactory):
@@ -1024,11 +2381,12 @@ class MixedDensityStackFactory(EventRepresentationFactory):
         cutoff_str = f'_cutoff={self.config.count_cutoff}' if self.config.count_cutoff is not None else ''
         return f'{self.config.name}_{aggregation_2_string[extraction.method]}={extraction.ev_repr_delta_ts_ms}_nbins={self.config.nbins}{cutoff_str}'
 
-    def create(self, height: int, width: int) -> MixedDensityEventStack:
-        return MixedDensityEventStack(bins=self.config.nbins,
-                                      height=height,
-                                      width=width,
-                                      count_cutoff=self.config.count_cutoff)
+    def create(self, height: int, width: int, downsample_by_2: bool = False) -> MixedDensityEventStack:
+        ev_repr_class = MixedDensityEventStackNumba if self.use_numba else MixedDensityEventStack
+        return ev_repr_class(bins=self.config.nbins,
+                             height=height,
+                             width=width,
+                             count_cutoff=self.config.count_cutoff)
 
 
 name_2_ev_repr_factory = {
@@ -1038,6 +2396,35 @@ name_2_ev_repr_factory = {
 }
 
 
+def get_window_extraction(extraction_config: DictConfig) -> Tuple[Optional[int], Optional[int], int]:
+    """:return: ev_repr_num_events, ev_repr_delta_ts_ms, ts_step_ev_repr_ms"""
+    ev_repr_num_events = None
+    ev_repr_delta_ts_ms = None
+    """
+    modification : define ts_step_ev_repr_ms from config
+    """
+    if extraction_config.method == AggregationType.COUNT:
+        ev_repr_num_events = extraction_config.value
+        ## イベント表現を生成する間隔
+        ts_step_ev_repr_ms = 50  # Could be an argument of the script.
+    else:
+        assert extraction_config.method == AggregationType.DURATION
+        ## イベント表現を生成する時に使われるイベントの時間 例: 過去100msのイベントを利用してイベントヒストグラムを生成
+        ev_repr_delta_ts_ms = extraction_config.ev_repr_delta_ts_ms
+        ts_step_ev_repr_ms = extraction_config.ts_step_ev_repr_ms
+    return ev_repr_num_events, ev_repr_delta_ts_ms, ts_step_ev_repr_ms
+
+
+def get_writer_options(writer_config: DictConfig) -> Dict[str, Any]:
+    """Keyword arguments of the writers (create_ev_repr_writer) from a WriterConf."""
+    writer_options = dict(complevel=writer_config.complevel,
+                          shuffle=writer_config.shuffle,
+                          frames_per_chunk=writer_config.frames_per_chunk)
+    if writer_config.codec is not None:
+        writer_options['codec'] = writer_config.codec
+    return writer_options
+
+
 def get_configuration(ev_repr_yaml_config: Path, extraction_yaml_config: Path) -> DictConfig:
     config = OmegaConf.load(ev_repr_yaml_config)
     event_window_extraction_config = OmegaConf.load(extraction_yaml_config)
@@ -1056,32 +2443,111 @@ if __name__ == '__main__':
     parser.add_argument('ev_repr_yaml_config', help='Path to event representation yaml config file')
     parser.add_argument('extraction_yaml_config', help='Path to event window extraction yaml config file')
     parser.add_argument('bbox_filter_yaml_config', help='Path to bbox filter yaml config file')
+    parser.add_argument('--extra_ev_repr_yaml_configs', nargs='+', default=[],
+                        help='Additional event representation yaml config files')
+    parser.add_argument('--extra_extraction_yaml_configs', nargs='+', default=[],
+                        help='Additional event window extraction yaml config files. Every combination of the '
+                             'representation and extraction configs is written in a single pass over the events')
     parser.add_argument('-ds', '--dataset', default='gen1', help='gen1 or gen4')
     parser.add_argument('-np', '--num_processes', type=int, default=1, help="Num proceesses to run in parallel")
+    parser.add_argument('--validate_time', action='store_true',
+                        help='Check once per input file that the timestamps of files marked as monotonic by '
+                             'convert_h5.py are non-decreasing (reads the full time array)')
+    parser.add_argument('--ba_filter_dt_us', type=int, default=None,
+                        help='Apply the background activity filter with this support time window [us] to the events '
+                             '(with the same decisions as for the whole stream)')
+    parser.add_argument('--ba_filter_radius', type=int, default=1, help='Neighborhood radius of the background activity filter')
+    parser.add_argument('--prefetch_events', type=int, default=None,
+                        help='Read events in contiguous blocks of at least this many events and serve windows from them')
+    parser.add_argument('--chunk_cache_mb', type=float, default=None, help='h5py chunk cache size per input file [MB]')
+    parser.add_argument('--compact_slices', action='store_true',
+                        help='Keep event slices in their native dtypes with reused buffers instead of int64 copies')
+    parser.add_argument('--frames_per_chunk', type=int, default=None,
+                        help='Event representations per HDF5 chunk of the output (several for short windows). '
+                             'This and the compression options override the writer section of the representation config')
+    parser.add_argument('--write_buffer_frames', type=int, default=8,
+                        help='Buffer this many event representations and write them at once')
+    parser.add_argument('--output_format', default='h5', choices=OUTPUT_FORMATS,
+                        help='h5, npy (uncompressed, memory-mappable) or chunked (directory of compressed chunks)')
+    parser.add_argument('--codec', default=None, choices=CODECS,
+                        help='Compression codec of the output (default: blosc:zstd for h5, gzip for chunked)')
+    parser.add_argument('--complevel', type=int, default=None, help='Compression level of the output')
+    parser.add_argument('--shuffle', default=None, choices=SHUFFLES, help='Shuffle filter of the output')
+    parser.add_argument('--pipeline_depth', type=int, default=0,
+                        help='Overlap reading, computing and writing with threads and queues of this size (0: off)')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Construct this many windows at once (stacked_histogram and mixeddensity_stack)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Update overlapping windows incrementally (event_frame, stacked_histogram with nbins=1)')
+    parser.add_argument('--shard_num_events', type=int, default=None,
+                        help='Split the windows of sequences with more events into contiguous shards (at most '
+                             'num_processes) written by several processes into parts, which are then merged')
+    parser.add_argument('--num_shards', '--num-shards', type=int, default=1,
+                        help='Split the sequences of the dataset into this many shards with balanced costs, e.g. to '
+                             'run one shard per machine on a shared storage (see verify_shards.py)')
+    parser.add_argument('--shard_index', '--shard-index', type=int, default=0, help='Shard processed by this run')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time the stages (read, construct, write, ...) and count events and bytes. Reports per '
+                             'sequence and per run are written to <target_dir>/profiles')
+    parser.add_argument('--checkpoint_interval_s', type=float, default=60,
+                        help='Record the written windows at most every this many seconds, such that an interrupted '
+                             'output is resumed by the next run (0: off, interrupted outputs are written again)')
     args = parser.parse_args()
 
+    reader_options = dict(validate_time=args.validate_time,
+                          ba_filter_dt_us=args.ba_filter_dt_us,
+                          ba_filter_radius=args.ba_filter_radius,
+                          prefetch_num_events=args.prefetch_events,
+                          chunk_cache_mb=args.chunk_cache_mb,
+                          compact_slices=args.compact_slices)
+    writer_options = dict(buffer_frames=args.write_buffer_frames)
+    for key in ('frames_per_chunk', 'codec', 'complevel', 'shuffle'):
+        if getattr(args, key) is not None:
+            writer_options[key] = getattr(args, key)
+
     num_processes = args.num_processes
 
     dataset = args.dataset
     assert dataset in ('gen1', 'gen4', 'gifu')
     downsample_by_2 = True if dataset == 'gen4' else False
 
-    config = get_configuration(ev_repr_yaml_config=Path(args.ev_repr_yaml_config),
-                               extraction_yaml_config=Path(args.extraction_yaml_config))
-
     bbox_filter_yaml_config = Path(args.bbox_filter_yaml_config)
     assert bbox_filter_yaml_config.exists()
     filter_cfg = OmegaConf.load(str(bbox_filter_yaml_config))
     filter_cfg = OmegaConf.merge(OmegaConf.structured(FilterConf), filter_cfg)
 
-    print('')
-    print(OmegaConf.to_yaml(config))
-
-    ev_repr_factory: EventRepresentationFactory = name_2_ev_repr_factory[config.name](config)
     height = dataset_2_height[args.dataset]
     width = dataset_2_width[args.dataset]
-    ev_repr = ev_repr_factory.create(height=height, width=width)
-    ev_repr_string = ev_repr_factory.name
+    targets = list()
+    for ev_repr_yaml_config, extraction_yaml_config in itertools.product(
+            [args.ev_repr_yaml_config] + args.extra_ev_repr_yaml_configs,
+            [args.extraction_yaml_config] + args.extra_extraction_yaml_configs):
+        config = get_configuration(ev_repr_yaml_config=Path(ev_repr_yaml_config),
+                                   extraction_yaml_config=Path(extraction_yaml_config))
+        ev_repr_factory: EventRepresentationFactory = name_2_ev_repr_factory[config.name](config)
+        if ev_repr_factory.name in (target.name for target in targets):
+            continue
+        print('')
+        print(OmegaConf.to_yaml(config))
+
+        ev_repr_num_events, ev_repr_delta_ts_ms, ts_step_ev_repr_ms = \
+            get_window_extraction(config.event_window_extraction)
+        targets.append(EventReprTarget(name=ev_repr_factory.name,
+                                       event_representation=ev_repr_factory.create(height=height, width=width,
+                                                                                   downsample_by_2=downsample_by_2),
+                                       ev_repr_num_events=ev_repr_num_events,
+                                       ev_repr_delta_ts_ms=ev_repr_delta_ts_ms,
+                                       ts_step_ev_repr_ms=ts_step_ev_repr_ms,
+                                       writer_options=get_writer_options(config.writer)))
+    if args.output_format == 'chunked':
+        # The chunked store supports fewer compression settings than HDF5, fail before any work starts.
+        for target in targets:
+            target_writer_options = dict(target.writer_options, **writer_options)
+            codec = target_writer_options.get('codec', 'gzip')
+            shuffle = target_writer_options.get('shuffle', 'byte')
+            if codec not in CHUNK_CODECS or shuffle not in CHUNK_SHUFFLES:
+                parser.error(f'{target.name}: codec {codec} / shuffle {shuffle} is not supported by '
+                             f'--output_format chunked (codecs: {CHUNK_CODECS}, shuffles: {CHUNK_SHUFFLES})')
 
     dataset_input_path = Path(args.input_dir)
     train_path = dataset_input_path / 'train'
@@ -1094,7 +2560,8 @@ if __name__ == '__main__':
     assert val_path.exists(), f'{val_path=}'
     assert test_path.exists(), f'{test_path=}'
 
-    seq_data_list = list()
+    assert 0 <= args.shard_index < args.num_shards, f'{args.shard_index=}, {args.num_shards=}'
+    key_2_sequence_data = dict()
     for split in ['train', 'val', 'test']:
         split_dir = dataset_input_path / split
         split_out_dir = target_dir / split
@@ -1116,62 +2583,134 @@ if __name__ == '__main__':
                 continue
 
             out_seq_path = split_out_dir / dir_name
-            out_labels_path = out_seq_path / 'labels_v2'
-            os.makedirs(out_labels_path, exist_ok=True)
-
-            out_ev_repr_parent_path = out_seq_path / 'event_representations_v2'
-            out_ev_repr_path = out_ev_repr_parent_path / ev_repr_string
-            os.makedirs(out_ev_repr_path, exist_ok=True)
-
             sequence_data = {
                 DataKeys.InNPY: npy_file,
                 DataKeys.InH5: h5f_path,
-                DataKeys.OutLabelDir: out_labels_path,
-                DataKeys.OutEvReprDir: out_ev_repr_path,
+                DataKeys.OutLabelDir: out_seq_path / 'labels_v2',
+                DataKeys.OutEvReprDir: out_seq_path / 'event_representations_v2',
                 DataKeys.SplitType: split_name_2_type[split],
             }
-            seq_data_list.append(sequence_data)
-
-
-
-    ev_repr_num_events = None
-    ev_repr_delta_ts_ms = None
-    """
-    modification : define ts_step_ev_repr_ms from config
-    """
-    if config.event_window_extraction.method == AggregationType.COUNT:
-        ev_repr_num_events = config.event_window_extraction.value
-        ## イベント表現を生成する間隔
-        ts_step_ev_repr_ms = 50  # Could be an argument of the script.
-    else:
-        assert config.event_window_extraction.method == AggregationType.DURATION
-        ## イベント表現を生成する時に使われるイベントの時間 例: 過去100msのイベントを利用してイベントヒストグラムを生成
-        ev_repr_delta_ts_ms = config.event_window_extraction.ev_repr_delta_ts_ms
-        ts_step_ev_repr_ms = config.event_window_extraction.ts_step_ev_repr_ms
-
-    
+            key_2_sequence_data[f'{split}/{dir_name}'] = sequence_data
 
+    # Sequences of the node shard of this run. The output directories are only created for them.
+    key_2_cost = {key: estimate_sequence_cost(sequence_data) for key, sequence_data in key_2_sequence_data.items()}
+    key_2_shard_index = assign_node_shards(key_2_cost, args.num_shards)
+    seq_data_list = list()
+    for key, sequence_data in key_2_sequence_data.items():
+        if key_2_shard_index[key] != args.shard_index:
+            continue
+        os.makedirs(sequence_data[DataKeys.OutLabelDir], exist_ok=True)
+        for target in targets:
+            os.makedirs(sequence_data[DataKeys.OutEvReprDir] / target.name, exist_ok=True)
+        seq_data_list.append(sequence_data)
+
+    manifest_path = shard_manifest_path(target_dir, args.shard_index, args.num_shards)
+    manifest = dict(num_shards=args.num_shards,
+                    shard_index=args.shard_index,
+                    sequences=key_2_cost,
+                    assigned=sorted(key for key, shard_index in key_2_shard_index.items()
+                                    if shard_index == args.shard_index),
+                    targets=[target.name for target in targets],
+                    output_format=args.output_format,
+                    downsample_by_2=downsample_by_2,
+                    downsampling={target.name: ev_repr_downsampling(target.event_representation, downsample_by_2)
+                                  for target in targets},
+                    finished=dict())
+    write_shard_manifest(manifest_path, manifest)
+    out_ev_repr_dir_2_key = {sequence_data[DataKeys.OutEvReprDir]: key
+                             for key, sequence_data in key_2_sequence_data.items()}
+
+    profile_dir = target_dir / 'profiles'
+    # profiling reports of the tasks (shards) of each sequence
+    key_2_reports = {out_ev_repr_dir_2_key[sequence_data[DataKeys.OutEvReprDir]]: list()
+                     for sequence_data in seq_data_list}
+    t_run_start = time.perf_counter()
+
+    def set_finished(sequence_data: Dict[DataKeys, Union[Path, SplitType]]):
+        # Sequences without labels after filtering are deleted by process_sequence.
+        key = out_ev_repr_dir_2_key[sequence_data[DataKeys.OutEvReprDir]]
+        status = 'done' if sequence_data[DataKeys.OutLabelDir].is_dir() else 'no_labels'
+        manifest['finished'][key] = status
+        write_shard_manifest(manifest_path, manifest)
+        if args.profile:
+            write_report(profile_dir / 'sequences' / f"{key.replace('/', '_')}.json",
+                         merge_reports(key_2_reports[key]))
+
+    # Longest job first: a long sequence started last would decide the wall time.
+    # With sharding, long sequences are split into shards (tasks) processed in parallel.
+    tasks = list()
+    for sequence_data in seq_data_list:
+        cost = key_2_cost[out_ev_repr_dir_2_key[sequence_data[DataKeys.OutEvReprDir]]]
+        num_shards = 1
+        if num_processes > 1 and args.shard_num_events is not None:
+            num_shards = min(-(-cost // args.shard_num_events), num_processes)
+        if num_shards > 1:
+            tasks.extend((cost / num_shards, (sequence_data, (shard_idx, num_shards)))
+                         for shard_idx in range(num_shards))
+        else:
+            tasks.append((cost, (sequence_data, None)))
+    tasks = [task for _, task in sorted(tasks, key=lambda cost_task: cost_task[0], reverse=True)]
+
+    process_kwargs = dict(dataset=dataset,
+                          filter_cfg=filter_cfg,
+                          targets=targets,
+                          downsample_by_2=downsample_by_2,
+                          reader_options=reader_options,
+                          writer_options=writer_options,
+                          output_format=args.output_format,
+                          pipeline_depth=args.pipeline_depth,
+                          batch_size=args.batch_size,
+                          incremental=args.incremental,
+                          checkpoint_interval_s=args.checkpoint_interval_s if args.checkpoint_interval_s > 0 else None)
     if num_processes > 1:
+        # chunksize 1 keeps the dispatch order. The shared arguments (representations, configs) are sent once to
+        # each worker instead of with every sequence.
         chunksize = 1
-        func = partial(process_sequence,
-                       dataset,
-                       filter_cfg,
-                       ev_repr,
-                       ev_repr_num_events,
-                       ev_repr_delta_ts_ms,
-                       ts_step_ev_repr_ms,
-                       downsample_by_2)
-        with get_context('spawn').Pool(num_processes) as pool:
-            with tqdm(total=len(seq_data_list), desc='sequences') as pbar:
-                for _ in pool.imap_unordered(func, iterable=seq_data_list, chunksize=chunksize):
+        task_times = list()
+        # Sequences are merged by the main process as soon as all their shards are written.
+        num_shards_left = dict()
+        for sequence_data, shard in tasks:
+            if shard is not None:
+                num_shards_left[sequence_data[DataKeys.OutEvReprDir]] = shard[1]
+        out_ev_repr_dir_2_sequence_data = {entry[DataKeys.OutEvReprDir]: entry for entry in seq_data_list}
+        t_pool_start = time.time()
+        with get_context('spawn').Pool(num_processes, initializer=init_worker,
+                                       initargs=(process_kwargs, args.profile)) as pool:
+            with tqdm(total=len(tasks), desc='sequences' if len(tasks) == len(seq_data_list) else 'shards') as pbar:
+                for out_ev_repr_dir, report, *task_time in pool.imap_unordered(process_sequence_in_worker,
+                                                                               iterable=tasks, chunksize=chunksize):
+                    task_times.append(task_time)
+                    key_2_reports[out_ev_repr_dir_2_key[out_ev_repr_dir]].append(report)
+                    sequence_data = out_ev_repr_dir_2_sequence_data[out_ev_repr_dir]
+                    if out_ev_repr_dir not in num_shards_left:
+                        set_finished(sequence_data)
+                    else:
+                        num_shards_left[out_ev_repr_dir] -= 1
+                        if num_shards_left[out_ev_repr_dir] == 0:
+                            t_merge_start = time.perf_counter()
+                            with profiling(enabled=args.profile) as profiler, profiler.stage('merge'):
+                                is_merged = merge_sequence_parts(sequence_data, targets, downsample_by_2,
+                                                                 args.output_format)
+                            if args.profile:
+                                key_2_reports[out_ev_repr_dir_2_key[out_ev_repr_dir]].append(
+                                    profiler.report(wall_s=time.perf_counter() - t_merge_start))
+                            if is_merged:
+                                set_finished(sequence_data)
                     pbar.update()
+        print_worker_utilization(task_times, t_pool_start, time.time())
     else:
         for entry in tqdm(seq_data_list, desc='sequences'):
-            process_sequence(dataset=dataset,
-                             filter_cfg=filter_cfg,
-                             event_representation=ev_repr,
-                             ev_repr_num_events=ev_repr_num_events,
-                             ev_repr_delta_ts_ms=ev_repr_delta_ts_ms,
-                             ts_step_ev_repr_ms=ts_step_ev_repr_ms,
-                             downsample_by_2=downsample_by_2,
-                             sequence_data=entry)
+            key_2_reports[out_ev_repr_dir_2_key[entry[DataKeys.OutEvReprDir]]].append(
+                process_sequence_profiled(args.profile, sequence_data=entry, **process_kwargs))
+            set_finished(entry)
+
+    if args.profile:
+        run_wall_s = time.perf_counter() - t_run_start
+        run_report = merge_reports(itertools.chain.from_iterable(key_2_reports.values()))
+        run_report.update(run_wall_s=run_wall_s, num_processes=num_processes, num_sequences=len(seq_data_list))
+        run_name = 'run' if args.num_shards == 1 else f'run_shard_{args.shard_index:03d}_of_{args.num_shards:03d}'
+        write_report(profile_dir / f'{run_name}.json', run_report)
+        # Stage times are summed over the workers (and pipeline threads), the rates are per run wall time.
+        summary = format_summary(run_report, wall_s=run_wall_s)
+        (profile_dir / f'{run_name}.txt').write_text(summary + '\n')
+        print(summary)
@@ -0,0 +1,150 @@
+"""
+Optional per-stage timers and counters of the preprocessing (preprocess_rvt.py --profile).
+
+Instrumented code calls get_profiler().stage(name) / get_profiler().count(name, value). Without an active profiler
+these are no-ops (a shared null context), i.e. the overhead of disabled profiling is one function call per stage.
+Stages nest per thread: 'read/h5_read' is the time of h5_read within read. Stages of the pipeline threads
+(--pipeline_depth) start at the root of their thread and overlap in time with the stages of the other threads.
+
+A report is a JSON-serializable dict:
+    wall_s:   wall time of the profiled code (summed over the merged reports)
+    stages:   {path: {calls, seconds, self_seconds}} where self_seconds excludes the nested stages
+    counters: {name: value}, e.g. events_read, windows, bytes_raw, bytes_written
+"""
+
+import contextlib
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+
+class StageProfiler:
+    enabled = True
+
+    def __init__(self):
+        self.stages: Dict[str, list] = dict()
+        self.counters: Dict[str, float] = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = list()
+        stack.append(name)
+        path = '/'.join(stack)
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_s = time.perf_counter() - t_start
+            stack.pop()
+            with self._lock:
+                entry = self.stages.setdefault(path, [0, 0.])
+                entry[0] += 1
+                entry[1] += duration_s
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, wall_s: float) -> Dict[str, Any]:
+        with self._lock:
+            stages = {path: dict(calls=calls, seconds=seconds) for path, (calls, seconds) in self.stages.items()}
+            # numpy scalars -> python numbers (JSON)
+            counters = {name: value.item() if hasattr(value, 'item') else value for name, value in self.counters.items()}
+        return dict(wall_s=wall_s, stages=_with_self_seconds(stages), counters=counters)
+
+
+class _NullProfiler:
+    enabled = False
+    _null_context = contextlib.nullcontext()
+
+    def stage(self, name: str):
+        return self._null_context
+
+    def count(self, name: str, value: float = 1):
+        pass
+
+
+_NULL_PROFILER = _NullProfiler()
+_profiler = _NULL_PROFILER
+
+
+def get_profiler():
+    """The active StageProfiler or a no-op profiler."""
+    return _profiler
+
+
+@contextlib.contextmanager
+def profiling(enabled: bool = True):
+    """Activates a new StageProfiler (process-wide, shared by all threads) for the code within the context."""
+    global _profiler
+    previous = _profiler
+    _profiler = StageProfiler() if enabled else _NULL_PROFILER
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
+
+
+def _with_self_seconds(stages: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    for path, entry in stages.items():
+        children_s = sum(child['seconds'] for child_path, child in stages.items()
+                         if child_path.rsplit('/', 1)[0] == path and child_path != path)
+        entry['self_seconds'] = max(entry['seconds'] - children_s, 0.)
+    return stages
+
+
+def merge_reports(reports: Iterable[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Sums the wall times, stages and counters of reports (e.g. of the shards of a sequence or of all sequences)."""
+    stages, counters, wall_s = dict(), dict(), 0.
+    for report in reports:
+        if report is None:
+            continue
+        wall_s += report['wall_s']
+        for path, entry in report['stages'].items():
+            merged = stages.setdefault(path, dict(calls=0, seconds=0.))
+            merged['calls'] += entry['calls']
+            merged['seconds'] += entry['seconds']
+        for name, value in report['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    return dict(wall_s=wall_s, stages=_with_self_seconds(stages), counters=counters)
+
+
+def format_summary(report: Dict[str, Any], top: int = 10, wall_s: Optional[float] = None) -> str:
+    """
+    Text summary: the top stages by self time and the throughput.
+    :param wall_s: Wall time for the rates (e.g. of the whole run), default: report['wall_s'].
+    """
+    wall_s = wall_s or report['wall_s']
+    stages = sorted(report['stages'].items(), key=lambda item: item[1]['self_seconds'], reverse=True)
+    total_self_s = sum(entry['self_seconds'] for _, entry in stages) or 1.
+    lines = [f"{'stage':<32} {'self s':>9} {'%':>6} {'calls':>9} {'ms/call':>9}"]
+    for path, entry in stages[:top]:
+        lines.append(f"{path:<32} {entry['self_seconds']:>9.2f} {100 * entry['self_seconds'] / total_self_s:>6.1f} "
+                     f"{entry['calls']:>9d} {1000 * entry['seconds'] / max(entry['calls'], 1):>9.3f}")
+    counters = report['counters']
+    rates = [f'wall {wall_s:.1f}s']
+    if 'windows' in counters:
+        rates.append(f"{counters['windows']} windows ({counters['windows'] / wall_s:.1f}/s)")
+    if 'events_read' in counters:
+        events_m = counters['events_read'] / 1e6
+        rates.append(f'{events_m:.1f}M events read ({events_m / wall_s:.2f}M/s)')
+    if 'bytes_written' in counters:
+        written_mb = counters['bytes_written'] / 1024 ** 2
+        written = f'{written_mb:.1f}MB written ({written_mb / wall_s:.1f}MB/s'
+        if counters.get('bytes_raw'):
+            written += f", ratio {counters['bytes_raw'] / max(counters['bytes_written'], 1):.2f}"
+        rates.append(written + ')')
+    lines.append(', '.join(rates))
+    return '\n'.join(lines)
+
+
+def write_report(path: Path, report: Dict[str, Any]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
@@ -0,0 +1,227 @@
+"""
+Decoder for Prophesee EVT 2.0 / EVT 3.0 .raw files.
+
+Only CD (change detection) events are decoded, external triggers and other event types are skipped.
+The file is decoded in slabs of words with the decoder state carried over between slabs,
+such that memory stays constant regardless of the recording length.
+
+Format references:
+  https://docs.prophesee.ai/stable/data/encoding_formats/evt2.html
+  https://docs.prophesee.ai/stable/data/encoding_formats/evt3.html
+"""
+
+import re
+from typing import Dict, Optional, Tuple
+
+from numba import jit
+import numpy as np
+
+DEFAULT_SLAB_WORDS = 2 ** 21
+
+# EVT 2.0 (32 bit words, type in bits [31:28])
+EVT2_CD_OFF = 0x0
+EVT2_CD_ON = 0x1
+EVT2_TIME_HIGH = 0x8
+
+# EVT 3.0 (16 bit words, type in bits [15:12])
+EVT3_ADDR_Y = 0x0
+EVT3_ADDR_X = 0x2
+EVT3_VECT_BASE_X = 0x3
+EVT3_VECT_12 = 0x4
+EVT3_VECT_8 = 0x5
+EVT3_TIME_LOW = 0x6
+EVT3_TIME_HIGH = 0x8
+
+# Indices into the decoder state array.
+_STATE_HAS_TIME_HIGH = 0
+_STATE_TIME_HIGH = 1
+_STATE_TIME_LOOP = 2
+_STATE_TIME_LOW = 3
+_STATE_Y = 4
+_STATE_BASE_X = 5
+_STATE_POL = 6
+_STATE_SIZE = 7
+
+
+def read_header(raw_file: str) -> Tuple[Dict[str, str], int]:
+    """
+    Parses the ASCII header ('% key value' lines) at the beginning of a .raw file.
+    :return: header dictionary and the byte offset of the event data.
+    """
+    header = dict()
+    offset = 0
+    with open(raw_file, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line.startswith(b'%'):
+                break
+            offset += len(line)
+            content = line[1:].decode('ascii', errors='ignore').strip()
+            if content == 'end':
+                break
+            key, _, value = content.partition(' ')
+            header[key] = value.strip()
+    return header, offset
+
+
+def get_format(header: Dict[str, str]) -> str:
+    # Newer files: '% format EVT3;height=720;width=1280', older files: '% evt 3.0'
+    fmt = header.get('format', '').split(';')[0].upper()
+    evt = header.get('evt', '')
+    if fmt == 'EVT21' or evt.startswith('2.1'):
+        raise ValueError('EVT 2.1 is not supported')
+    if fmt in ('EVT2', 'EVT3'):
+        return fmt
+    if evt.startswith('2'):
+        return 'EVT2'
+    if evt.startswith('3'):
+        return 'EVT3'
+    raise ValueError(f'Unknown .raw event format in header: {header}')
+
+
+def get_geometry(header: Dict[str, str]) -> Optional[Tuple[int, int]]:
+    """:return: (width, height) if present in the header."""
+    fmt = header.get('format', '')
+    width = re.search(r'width=(\d+)', fmt)
+    height = re.search(r'height=(\d+)', fmt)
+    if width and height:
+        return int(width.group(1)), int(height.group(1))
+    geometry = re.match(r'(\d+)x(\d+)', header.get('geometry', ''))
+    if geometry:
+        return int(geometry.group(1)), int(geometry.group(2))
+    return None
+
+
+@jit(nopython=True)
+def _decode_evt2(words, state, x_out, y_out, t_out, p_out):
+    has_time_high = state[_STATE_HAS_TIME_HIGH]
+    time_high = state[_STATE_TIME_HIGH]
+    time_loop = state[_STATE_TIME_LOOP]
+    num_events = 0
+    for word in words:
+        ev_type = word >> 28
+        if ev_type == EVT2_TIME_HIGH:
+            new_time_high = np.int64(word & 0x0FFFFFFF) << 6
+            # 34 bit timestamps overflow after ~4.8h
+            if has_time_high and new_time_high + (np.int64(1) << 33) < time_high:
+                time_loop += np.int64(1) << 34
+            time_high = new_time_high
+            has_time_high = 1
+        elif ev_type == EVT2_CD_OFF or ev_type == EVT2_CD_ON:
+            if not has_time_high:
+                continue
+            t_out[num_events] = time_loop + time_high + np.int64((word >> 22) & 0x3F)
+            x_out[num_events] = (word >> 11) & 0x7FF
+            y_out[num_events] = word & 0x7FF
+            p_out[num_events] = ev_type
+            num_events += 1
+    state[_STATE_HAS_TIME_HIGH] = has_time_high
+    state[_STATE_TIME_HIGH] = time_high
+    state[_STATE_TIME_LOOP] = time_loop
+    return num_events
+
+
+@jit(nopython=True)
+def _count_evt3(words):
+    # Upper bound for the number of CD events contained in the words.
+    num_events = 0
+    for word in words:
+        ev_type = word >> 12
+        if ev_type == EVT3_ADDR_X:
+            num_events += 1
+        elif ev_type == EVT3_VECT_12 or ev_type == EVT3_VECT_8:
+            valid = word & 0xFFF
+            while valid:
+                valid &= valid - 1
+                num_events += 1
+    return num_events
+
+
+@jit(nopython=True)
+def _decode_evt3(words, state, x_out, y_out, t_out, p_out):
+    has_time_high = state[_STATE_HAS_TIME_HIGH]
+    time_high = state[_STATE_TIME_HIGH]
+    time_loop = state[_STATE_TIME_LOOP]
+    time_low = state[_STATE_TIME_LOW]
+    y = state[_STATE_Y]
+    base_x = state[_STATE_BASE_X]
+    pol = state[_STATE_POL]
+    num_events = 0
+    for word in words:
+        ev_type = word >> 12
+        if ev_type == EVT3_TIME_HIGH:
+            new_time_high = np.int64(word & 0xFFF) << 12
+            # 24 bit timestamps overflow after ~16.7s
+            if has_time_high and new_time_high + (np.int64(1) << 23) < time_high:
+                time_loop += np.int64(1) << 24
+            time_high = new_time_high
+            has_time_high = 1
+        elif ev_type == EVT3_TIME_LOW:
+            time_low = np.int64(word & 0xFFF)
+        elif ev_type == EVT3_ADDR_Y:
+            y = word & 0x7FF
+        elif ev_type == EVT3_ADDR_X:
+            if has_time_high:
+                t_out[num_events] = time_loop + time_high + time_low
+                x_out[num_events] = word & 0x7FF
+                y_out[num_events] = y
+                p_out[num_events] = (word >> 11) & 0x1
+                num_events += 1
+        elif ev_type == EVT3_VECT_BASE_X:
+            base_x = word & 0x7FF
+            pol = (word >> 11) & 0x1
+        elif ev_type == EVT3_VECT_12 or ev_type == EVT3_VECT_8:
+            num_bits = 12 if ev_type == EVT3_VECT_12 else 8
+            if has_time_high:
+                valid = word & 0xFFF
+                for bit in range(num_bits):
+                    if (valid >> bit) & 0x1:
+                        t_out[num_events] = time_loop + time_high + time_low
+                        x_out[num_events] = base_x + bit
+                        y_out[num_events] = y
+                        p_out[num_events] = pol
+                        num_events += 1
+            base_x += num_bits
+    state[_STATE_HAS_TIME_HIGH] = has_time_high
+    state[_STATE_TIME_HIGH] = time_high
+    state[_STATE_TIME_LOOP] = time_loop
+    state[_STATE_TIME_LOW] = time_low
+    state[_STATE_Y] = y
+    state[_STATE_BASE_X] = base_x
+    state[_STATE_POL] = pol
+    return num_events
+
+
+def decode_words(words: np.ndarray, evt_format: str, state: np.ndarray):
+    """
+    Decodes a slab of words. The state array (see new_decoder_state) is updated in-place.
+    :return: x, y, t, p arrays with the DSEC dtypes (uint16, uint16, uint64, uint8).
+    """
+    assert evt_format in ('EVT2', 'EVT3')
+    max_events = len(words) if evt_format == 'EVT2' else _count_evt3(words)
+    x = np.empty(max_events, dtype=np.uint16)
+    y = np.empty(max_events, dtype=np.uint16)
+    t = np.empty(max_events, dtype=np.int64)
+    p = np.empty(max_events, dtype=np.uint8)
+    decode = _decode_evt2 if evt_format == 'EVT2' else _decode_evt3
+    num_events = decode(words, state, x, y, t, p)
+    return x[:num_events], y[:num_events], t[:num_events].view(np.uint64), p[:num_events]
+
+
+def new_decoder_state() -> np.ndarray:
+    return np.zeros(_STATE_SIZE, dtype=np.int64)
+
+
+def iter_raw_slabs(raw_file: str, slab_words: int = DEFAULT_SLAB_WORDS):
+    """Yields (x, y, t, p) slabs of CD events decoded from a .raw file."""
+    header, offset = read_header(raw_file)
+    evt_format = get_format(header)
+    word_dtype = np.dtype('<u4') if evt_format == 'EVT2' else np.dtype('<u2')
+    state = new_decoder_state()
+    with open(raw_file, 'rb') as f:
+        f.seek(offset)
+        while True:
+            words = np.fromfile(f, dtype=word_dtype, count=slab_words)
+            if len(words) == 0:
+                break
+            yield decode_words(words, evt_format, state)
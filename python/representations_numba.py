@@ -0,0 +1,319 @@
+"""
+NumPy/numba backend of the event representations of preprocess_rvt.py (EventFrame, StackedHistogram and
+MixedDensityEventStack). The representations are written straight into NumPy buffers, torch is not required.
+
+The arithmetic mirrors the torch implementations (int64 time differences, float32 normalization), such that both
+backends produce the same representations (see bench_representations.py).
+"""
+
+from abc import ABC, abstractmethod
+import math
+from typing import Optional, Tuple
+
+from numba import jit
+import numpy as np
+
+from event_frame_codec import EVENT_FRAME_BACKGROUND, EVENT_FRAME_ENCODINGS, FRAME_STATE_BACKGROUND, FRAME_STATE_OFF, \
+    FRAME_STATE_ON, event_frame_colors
+
+
+# EventFrame: how the color of a pixel with both ON and OFF events is decided.
+#   off_priority: OFF (blue) if the pixel has any OFF event, otherwise ON (red). Original behavior.
+#   last: polarity of the last event at the pixel.
+#   majority: polarity with more events at the pixel, ties are decided by the last event.
+#   count: like majority, but pixels with less than min_count events keep the background color.
+EVENT_FRAME_POLICIES = ('off_priority', 'last', 'majority', 'count')
+
+
+@jit(nopython=True, cache=True)
+def _event_frame(x, y, pol, offsets, height, width, shift, policy, min_count, colors, num_on, num_off, last_pol, out):
+    # out: (N, C, height >> shift, width >> shift) uint8, already filled with the background value.
+    # colors: (C, 3 states) values written per channel and state (event_frame_colors).
+    # num_on, num_off (int32) and last_pol (uint8): per pixel scratch of the output resolution, zeroed.
+    # Events are accumulated in one pass, then every pixel with events is written exactly once.
+    # Coordinates are clipped to the frame (the last row/column of odd sizes falls into the previous block).
+    height_out = height >> shift
+    width_out = width >> shift
+    num_channels = colors.shape[0]
+    for win in range(len(offsets) - 1):
+        frame = out[win].reshape(num_channels, -1)
+        idx_start = offsets[win]
+        idx_end = offsets[win + 1]
+        for idx in range(idx_start, idx_end):
+            p_ev = pol[idx]
+            if p_ev != 0 and p_ev != 1:
+                continue
+            x_ev = min(max(np.int64(x[idx]), 0) >> shift, width_out - 1)
+            y_ev = min(max(np.int64(y[idx]), 0) >> shift, height_out - 1)
+            pixel = x_ev + width_out * y_ev
+            if p_ev == 1:
+                num_on[pixel] += 1
+            else:
+                num_off[pixel] += 1
+            last_pol[pixel] = p_ev
+        for idx in range(idx_start, idx_end):
+            p_ev = pol[idx]
+            if p_ev != 0 and p_ev != 1:
+                continue
+            x_ev = min(max(np.int64(x[idx]), 0) >> shift, width_out - 1)
+            y_ev = min(max(np.int64(y[idx]), 0) >> shift, height_out - 1)
+            pixel = x_ev + width_out * y_ev
+            on = num_on[pixel]
+            off = num_off[pixel]
+            if on == 0 and off == 0:
+                # already written
+                continue
+            last_state = FRAME_STATE_ON if last_pol[pixel] == 1 else FRAME_STATE_OFF
+            if policy == 0:
+                state = FRAME_STATE_OFF if off > 0 else FRAME_STATE_ON
+            elif policy == 1:
+                state = last_state
+            else:
+                state = FRAME_STATE_ON if on > off else FRAME_STATE_OFF if off > on else last_state
+                if policy == 3 and on + off < min_count:
+                    state = FRAME_STATE_BACKGROUND
+            for ch in range(num_channels):
+                frame[ch, pixel] = colors[ch, state]
+            num_on[pixel] = 0
+            num_off[pixel] = 0
+
+
+@jit(nopython=True, cache=True)
+def _stacked_histogram(x, y, pol, time, offsets, bins, height, width, count_cutoff, saturate, out):
+    # out: (N, 2 * bins * height * width) uint8, zeroed.
+    bn = np.float32(bins)
+    for win in range(len(offsets) - 1):
+        idx_start = offsets[win]
+        idx_end = offsets[win + 1]
+        if idx_end == idx_start:
+            continue
+        hist = out[win]
+        t0 = np.int64(time[idx_start])
+        t_range = np.float32(max(np.int64(time[idx_end - 1]) - t0, 1))
+        for idx in range(idx_start, idx_end):
+            t_norm = np.float32(np.int64(time[idx]) - t0) / t_range * bn
+            t_idx = min(np.int64(np.floor(t_norm)), bins - 1)
+            pixel = np.int64(x[idx]) + width * np.int64(y[idx]) + height * width * (t_idx + bins * np.int64(pol[idx]))
+            if saturate:
+                if hist[pixel] < count_cutoff:
+                    hist[pixel] += 1
+            else:
+                # uint8 accumulation wraps around (like fastmode of the torch implementation)
+                hist[pixel] += 1
+        if not saturate:
+            for idx in range(idx_start, idx_end):
+                t_norm = np.float32(np.int64(time[idx]) - t0) / t_range * bn
+                t_idx = min(np.int64(np.floor(t_norm)), bins - 1)
+                pixel = np.int64(x[idx]) + width * np.int64(y[idx]) + \
+                    height * width * (t_idx + bins * np.int64(pol[idx]))
+                hist[pixel] = min(hist[pixel], count_cutoff)
+
+
+@jit(nopython=True, cache=True)
+def _mixed_density_stack(x, y, pol, time, offsets, bins, height, width, count_cutoff, visited, out):
+    # out: (N, bins, height * width) int8, zeroed. visited: (height * width,) uint8 scratch, zeroed.
+    t_min = np.float32(1e-6)
+    t_max = np.float32(1 - 1e-6)
+    log_half = np.float32(math.log(1 / 2))
+    bn = np.float32(bins)
+    for win in range(len(offsets) - 1):
+        idx_start = offsets[win]
+        idx_end = offsets[win + 1]
+        if idx_end == idx_start:
+            continue
+        stack = out[win]
+        t0 = np.int64(time[idx_start])
+        t_range = np.float32(max(np.int64(time[idx_end - 1]) - t0, 1))
+        for idx in range(idx_start, idx_end):
+            t_norm = np.float32(np.int64(time[idx]) - t0) / t_range
+            t_norm = min(max(t_norm, t_min), t_max)
+            bin_float = max(bn - np.log(t_norm) / log_half, np.float32(0))
+            t_idx = np.int64(np.floor(bin_float))
+            pixel = np.int64(x[idx]) + width * np.int64(y[idx])
+            # int8 accumulation wraps around like put_ of the torch implementation
+            stack[t_idx, pixel] += np.int8(2 * np.int64(pol[idx]) - 1)
+        # cumsum over the bins and clipping, only for the pixels with events
+        for idx in range(idx_start, idx_end):
+            pixel = np.int64(x[idx]) + width * np.int64(y[idx])
+            if visited[pixel]:
+                continue
+            visited[pixel] = 1
+            for t_idx in range(1, bins):
+                stack[t_idx, pixel] += stack[t_idx - 1, pixel]
+            if count_cutoff >= 0:
+                for t_idx in range(bins):
+                    stack[t_idx, pixel] = min(max(stack[t_idx, pixel], -count_cutoff), count_cutoff)
+        for idx in range(idx_start, idx_end):
+            visited[np.int64(x[idx]) + width * np.int64(y[idx])] = 0
+
+
+def _single_window_offsets(num_events: int) -> np.ndarray:
+    return np.array([0, num_events], dtype=np.int64)
+
+
+class _NumbaRepresentation(ABC):
+    backend = 'numba'
+
+    @abstractmethod
+    def get_shape(self) -> Tuple[int, int, int]:
+        ...
+
+    @staticmethod
+    @abstractmethod
+    def get_numpy_dtype() -> np.dtype:
+        ...
+
+    def _batch_output(self, num_windows: int, out: Optional[np.ndarray], fill_value: int = 0) -> np.ndarray:
+        """(num_windows,) + get_shape() array filled with fill_value, a view of out if given (reused across batches)."""
+        shape = (num_windows,) + tuple(self.get_shape())
+        if out is None:
+            return np.full(shape, fill_value, dtype=self.get_numpy_dtype())
+        assert out.dtype == self.get_numpy_dtype() and out.flags.c_contiguous
+        assert len(out) >= num_windows and out.shape[1:] == shape[1:]
+        out = out[:num_windows]
+        out.fill(fill_value)
+        return out
+
+    def _check_inputs(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray, time: np.ndarray, offsets: np.ndarray):
+        # numba does not check the array bounds: events outside of the frame would write outside of the output.
+        assert len(x) == len(y) == len(pol) == len(time) == offsets[-1]
+        if len(x) == 0:
+            return
+        if pol.min() < 0 or pol.max() > 1:
+            raise ValueError(f'polarity out of range [0, 1]: min {pol.min()}, max {pol.max()}')
+        if x.min() < 0 or x.max() >= self.width:
+            raise ValueError(f'x out of range [0, {self.width}): min {x.min()}, max {x.max()}')
+        if y.min() < 0 or y.max() >= self.height:
+            raise ValueError(f'y out of range [0, {self.height}): min {y.min()}, max {y.max()}')
+
+    def construct(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray, time: np.ndarray) -> np.ndarray:
+        return self.construct_batch(x, y, pol, time, offsets=_single_window_offsets(len(x)))[0]
+
+    @abstractmethod
+    def construct_batch(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray, time: np.ndarray,
+                        offsets: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        ...
+
+
+class EventFrameNumba(_NumbaRepresentation):
+    def __init__(self, height: int, width: int, downsample: bool = False, policy: str = 'off_priority',
+                 min_count: int = 2, background_color: int = EVENT_FRAME_BACKGROUND, encoding: str = 'rgb'):
+        """
+        NumPy/numba implementation of preprocess_rvt.EventFrame.
+        :param downsample: Whether to build the frame at half resolution (events of 2x2 pixels are combined).
+        :param policy: one of EVENT_FRAME_POLICIES.
+        :param min_count: minimum number of events of a colored pixel (policy 'count').
+        :param encoding: one of EVENT_FRAME_ENCODINGS. The state encodings construct (1, H, W) state maps.
+        """
+        assert policy in EVENT_FRAME_POLICIES, f'{policy=}'
+        assert encoding in EVENT_FRAME_ENCODINGS, f'{encoding=}'
+        assert 0 <= background_color <= 255
+        self.height = height
+        self.width = width
+        self.downsample = downsample
+        self.policy = policy
+        self.min_count = min_count
+        self.background_color = background_color
+        self.encoding = encoding
+        self.colors = event_frame_colors(background_color, encoding)
+        _, height_out, width_out = self.get_shape()
+        self.num_on = np.zeros(height_out * width_out, dtype=np.int32)
+        self.num_off = np.zeros(height_out * width_out, dtype=np.int32)
+        self.last_pol = np.zeros(height_out * width_out, dtype=np.uint8)
+
+    def get_shape(self) -> Tuple[int, int, int]:
+        num_channels = len(self.colors)
+        if self.downsample:
+            return num_channels, self.height // 2, self.width // 2
+        return num_channels, self.height, self.width
+
+    @staticmethod
+    def get_numpy_dtype() -> np.dtype:
+        return np.dtype('uint8')
+
+    def construct_batch(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray, time: np.ndarray,
+                        offsets: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        assert len(x) == len(y) == len(pol) == len(time) == offsets[-1]
+        num_windows = len(offsets) - 1
+        frames = self._batch_output(num_windows, out, fill_value=self.colors[0, FRAME_STATE_BACKGROUND])
+        _event_frame(x, y, pol, offsets, self.height, self.width, int(self.downsample),
+                     EVENT_FRAME_POLICIES.index(self.policy), self.min_count, self.colors,
+                     self.num_on, self.num_off, self.last_pol, frames)
+        return frames
+
+
+class StackedHistogramNumba(_NumbaRepresentation):
+    def __init__(self, bins: int, height: int, width: int, count_cutoff: Optional[int] = None, fastmode: bool = True):
+        """
+        NumPy/numba implementation of preprocess_rvt.StackedHistogram.
+        In case of fastmode == True: counts are accumulated in uint8 and may wrap around (same as the torch backend).
+        In case of fastmode == False: counts saturate at count_cutoff.
+        """
+        assert bins >= 1
+        self.bins = bins
+        assert height >= 1
+        self.height = height
+        assert width >= 1
+        self.width = width
+        self.count_cutoff = count_cutoff
+        if self.count_cutoff is None:
+            self.count_cutoff = 255
+        else:
+            assert count_cutoff >= 1
+            self.count_cutoff = min(count_cutoff, 255)
+        self.fastmode = fastmode
+        self.channels = 2
+
+    @staticmethod
+    def get_numpy_dtype() -> np.dtype:
+        return np.dtype('uint8')
+
+    def get_shape(self) -> Tuple[int, int, int]:
+        return 2 * self.bins, self.height, self.width
+
+    def construct_batch(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray, time: np.ndarray,
+                        offsets: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        self._check_inputs(x, y, pol, time, offsets)
+        num_windows = len(offsets) - 1
+        output = self._batch_output(num_windows, out)
+        _stacked_histogram(x, y, pol, time, offsets, self.bins, self.height, self.width, self.count_cutoff,
+                           not self.fastmode, output.reshape(num_windows, -1))
+        return output
+
+
+class MixedDensityEventStackNumba(_NumbaRepresentation):
+    def __init__(self, bins: int, height: int, width: int, count_cutoff: Optional[int] = None):
+        """NumPy/numba implementation of preprocess_rvt.MixedDensityEventStack."""
+        assert bins >= 1
+        self.bins = bins
+        assert height >= 1
+        self.height = height
+        assert width >= 1
+        self.width = width
+        self.count_cutoff = count_cutoff
+        if self.count_cutoff is not None:
+            assert isinstance(count_cutoff, int)
+            assert 0 <= self.count_cutoff <= 2 ** 7 - 1
+        self.visited = np.zeros(height * width, dtype=np.uint8)
+
+    @staticmethod
+    def get_numpy_dtype() -> np.dtype:
+        return np.dtype('int8')
+
+    def get_shape(self) -> Tuple[int, int, int]:
+        return self.bins, self.height, self.width
+
+    def construct_batch(self, x: np.ndarray, y: np.ndarray, pol: np.ndarray, time: np.ndarray,
+                        offsets: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        self._check_inputs(x, y, pol, time, offsets)
+        num_windows = len(offsets) - 1
+        output = self._batch_output(num_windows, out)
+        count_cutoff = -1 if self.count_cutoff is None else self.count_cutoff
+        _mixed_density_stack(x, y, pol, time, offsets, self.bins, self.height, self.width, count_cutoff,
+                             self.visited, output.reshape(num_windows, self.bins, -1))
+        return output
+
+
+def downsample_ev_repr_numpy(x: np.ndarray) -> np.ndarray:
+    """Same as preprocess_rvt.downsample_ev_repr(scale_factor=0.5) ('nearest-exact' picks the odd rows/columns)."""
+    return np.ascontiguousarray(x[..., 1::2, 1::2])
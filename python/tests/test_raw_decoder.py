@@ -0,0 +1,137 @@
+"""Decoding of synthetic EVT 2.0 / EVT 3.0 .raw byte streams."""
+
+import numpy as np
+import pytest
+
+from raw_decoder import EVT2_CD_OFF, EVT2_CD_ON, EVT2_TIME_HIGH, EVT3_ADDR_X, EVT3_ADDR_Y, EVT3_TIME_HIGH, \
+    EVT3_TIME_LOW, EVT3_VECT_12, EVT3_VECT_8, EVT3_VECT_BASE_X, get_format, get_geometry, iter_raw_slabs, \
+    read_header
+
+
+def evt2_time_high(t):
+    return (EVT2_TIME_HIGH << 28) | ((t >> 6) & 0x0FFFFFFF)
+
+
+def evt2_cd(x, y, t, p):
+    return ((EVT2_CD_ON if p else EVT2_CD_OFF) << 28) | ((t & 0x3F) << 22) | (x << 11) | y
+
+
+def evt3(ev_type, payload):
+    return (ev_type << 12) | payload
+
+
+def write_raw(path, header_lines, words, dtype):
+    header = ''.join(f'% {line}\n' for line in header_lines + ['end'])
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(np.asarray(words, dtype=dtype).tobytes())
+    return str(path)
+
+
+def decode(raw_file, slab_words):
+    slabs = list(iter_raw_slabs(raw_file, slab_words=slab_words))
+    return tuple(np.concatenate([slab[idx] for slab in slabs]) for idx in range(4))
+
+
+def assert_events(decoded, expected):
+    x, y, t, p = decoded
+    assert x.dtype == np.uint16 and y.dtype == np.uint16 and t.dtype == np.uint64 and p.dtype == np.uint8
+    assert list(zip(x.tolist(), y.tolist(), t.tolist(), p.tolist())) == expected
+
+
+@pytest.fixture
+def evt2_file(tmp_path):
+    t_wrap = (1 << 34) - 64
+    words = [
+        evt2_cd(1, 1, 5, 1),  # before the first time high: skipped
+        evt2_time_high(1024),
+        evt2_cd(10, 20, 1024 + 3, 1),
+        evt2_cd(639, 479, 1024 + 63, 0),
+        evt2_time_high(t_wrap),
+        evt2_cd(5, 6, t_wrap + 1, 0),
+        # 34 bit time high overflow
+        evt2_time_high(64),
+        evt2_cd(7, 8, 64 + 2, 1),
+    ]
+    expected = [(10, 20, 1027, 1), (639, 479, 1087, 0), (5, 6, t_wrap + 1, 0), (7, 8, (1 << 34) + 66, 1)]
+    raw_file = write_raw(tmp_path / 'evt2.raw', ['format EVT2;height=480;width=640'], words, '<u4')
+    return raw_file, expected
+
+
+@pytest.fixture
+def evt3_file(tmp_path):
+    words = [
+        evt3(EVT3_ADDR_X, (1 << 11) | 3),  # before the first time high: skipped
+        evt3(EVT3_TIME_HIGH, 0x001),
+        evt3(EVT3_TIME_LOW, 0x010),
+        evt3(EVT3_ADDR_Y, 100),
+        evt3(EVT3_ADDR_X, (1 << 11) | 50),
+        evt3(EVT3_ADDR_X, 51),
+        evt3(EVT3_TIME_LOW, 0x020),
+        evt3(EVT3_VECT_BASE_X, (1 << 11) | 200),
+        evt3(EVT3_VECT_12, 0b100000000101),
+        evt3(EVT3_VECT_8, 0b10000001),
+        evt3(EVT3_ADDR_Y, 7),
+        evt3(EVT3_VECT_BASE_X, 300),
+        evt3(EVT3_VECT_12, 0b10),
+        evt3(EVT3_TIME_HIGH, 0xFFF),
+        evt3(EVT3_ADDR_X, 9),
+        # 24 bit time high overflow
+        evt3(EVT3_TIME_HIGH, 0x000),
+        evt3(EVT3_TIME_LOW, 0x005),
+        evt3(EVT3_ADDR_X, (1 << 11) | 10),
+    ]
+    t_vec = (1 << 12) + 0x020
+    expected = [(50, 100, (1 << 12) + 0x010, 1), (51, 100, (1 << 12) + 0x010, 0),
+                (200, 100, t_vec, 1), (202, 100, t_vec, 1), (211, 100, t_vec, 1),
+                (212, 100, t_vec, 1), (219, 100, t_vec, 1),
+                (301, 7, t_vec, 0),
+                (9, 7, (0xFFF << 12) + 0x020, 0),
+                (10, 7, (1 << 24) + 0x005, 1)]
+    raw_file = write_raw(tmp_path / 'evt3.raw', ['format EVT3;height=720;width=1280'], words, '<u2')
+    return raw_file, expected
+
+
+def test_evt2_events_and_time_high_wraparound(evt2_file):
+    raw_file, expected = evt2_file
+    assert_events(decode(raw_file, slab_words=2 ** 10), expected)
+
+
+def test_evt3_addr_and_vector_events_and_time_high_wraparound(evt3_file):
+    raw_file, expected = evt3_file
+    assert_events(decode(raw_file, slab_words=2 ** 10), expected)
+
+
+@pytest.mark.parametrize('slab_words', [1, 2, 3, 5])
+def test_evt2_slab_boundaries(evt2_file, slab_words):
+    raw_file, expected = evt2_file
+    assert_events(decode(raw_file, slab_words=slab_words), expected)
+
+
+@pytest.mark.parametrize('slab_words', [1, 2, 3, 5, 8, 9])
+def test_evt3_slab_boundaries_split_vector_events(evt3_file, slab_words):
+    # Slabs of 8 and 9 words split the vector event between its base x and the 12 / 8 bit validity masks.
+    raw_file, expected = evt3_file
+    assert_events(decode(raw_file, slab_words=slab_words), expected)
+
+
+def test_header(evt3_file):
+    raw_file, _ = evt3_file
+    header, offset = read_header(raw_file)
+    assert get_format(header) == 'EVT3'
+    assert get_geometry(header) == (1280, 720)
+    with open(raw_file, 'rb') as f:
+        f.seek(offset)
+        assert np.frombuffer(f.read(2), dtype='<u2')[0] == evt3(EVT3_ADDR_X, (1 << 11) | 3)
+
+
+@pytest.mark.parametrize('header_line', ['format EVT21;height=720;width=1280', 'evt 2.1'])
+def test_evt21_is_rejected(tmp_path, header_line):
+    raw_file = write_raw(tmp_path / 'evt21.raw', [header_line], [0, 0], '<u4')
+    with pytest.raises(ValueError, match='EVT 2.1'):
+        next(iter_raw_slabs(raw_file))
+
+
+@pytest.mark.parametrize('header_line, evt_format', [('evt 2.0', 'EVT2'), ('evt 3.0', 'EVT3')])
+def test_legacy_header(header_line, evt_format):
+    assert get_format(dict([header_line.split(' ')])) == evt_format
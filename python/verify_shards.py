@@ -0,0 +1,122 @@
+"""
+Verifies a preprocess_rvt.py run split into node shards (--num_shards, --shard_index), e.g. one shard per machine on
+a shared storage, and merges the manifests of the shards.
+
+Every shard writes <target_dir>/manifests/shard_<index>_of_<num_shards>.json. The run is complete if
+- the manifests of all shards exist and agree on the sequences of the dataset, the shards and the outputs,
+- every sequence is assigned to exactly one shard (as by assign_node_shards) and finished by it,
+- the labels and event representations of every finished sequence exist, are complete (not in progress) and hold
+  one event representation per timestamp.
+Then the merged manifest is written to <target_dir>/manifest.json.
+
+Local test: run the shards as separate processes, e.g.
+    for i in 0 1 2; do python preprocess_rvt.py ... --num_shards 3 --shard_index $i & done; wait
+    python verify_shards.py <target_dir>
+"""
+import argparse
+import json
+from pathlib import Path
+import sys
+from typing import Any, Dict, List
+
+import numpy as np
+
+from ev_repr_store import open_ev_repr
+from preprocess_rvt import assign_node_shards, ev_repr_outfile, find_ev_repr_parts, in_progress_path
+
+
+def load_manifests(target_dir: Path) -> List[Dict[str, Any]]:
+    manifests = list()
+    for path in sorted((target_dir / 'manifests').glob('shard_*_of_*.json')):
+        with open(path) as f:
+            manifests.append(json.load(f))
+    return manifests
+
+
+def verify_sequence_outputs(target_dir: Path, key: str, manifest: Dict[str, Any]) -> List[str]:
+    errors = list()
+    out_seq_path = target_dir / key
+    for name in ('labels.npz', 'timestamps_us.npy'):
+        if not (out_seq_path / 'labels_v2' / name).exists():
+            errors.append(f'{key}: missing labels_v2/{name}')
+    for target_name in manifest['targets']:
+        ev_out_dir = out_seq_path / 'event_representations_v2' / target_name
+        ev_outfile = ev_repr_outfile(ev_out_dir, manifest['downsampling'][target_name], manifest['output_format'])
+        if not ev_outfile.exists():
+            errors.append(f'{key}: missing {ev_outfile.relative_to(target_dir)}')
+            continue
+        if in_progress_path(ev_outfile).exists() or len(find_ev_repr_parts(ev_outfile)) > 0:
+            errors.append(f'{key}: {target_name} has outputs in progress')
+        num_windows = len(np.load(str(ev_out_dir / 'timestamps_us.npy')))
+        num_ev_repr = len(open_ev_repr(ev_outfile))
+        if num_ev_repr != num_windows:
+            errors.append(f'{key}: {target_name} has {num_ev_repr} event representations for {num_windows} windows')
+    return errors
+
+
+def verify_shards(target_dir: Path) -> List[str]:
+    """:return: errors, empty if the run is complete."""
+    manifests = load_manifests(target_dir)
+    if len(manifests) == 0:
+        return [f'no manifests in {target_dir / "manifests"}']
+    reference = manifests[0]
+    num_shards = reference['num_shards']
+    errors = list()
+    for manifest in manifests[1:]:
+        for key in ('num_shards', 'sequences', 'targets', 'output_format', 'downsample_by_2', 'downsampling'):
+            if manifest[key] != reference[key]:
+                errors.append(f'shard {manifest["shard_index"]}: {key} differs from shard {reference["shard_index"]}')
+    if len(errors) > 0:
+        return errors
+    shard_2_manifest = {manifest['shard_index']: manifest for manifest in manifests}
+    missing_shards = sorted(set(range(num_shards)) - set(shard_2_manifest))
+    if len(missing_shards) > 0:
+        errors.append(f'missing manifests of shards {missing_shards}')
+
+    sequences = reference['sequences']
+    assignment = assign_node_shards(sequences, num_shards)
+    key_2_shards = {key: list() for key in sequences}
+    for shard_index, manifest in sorted(shard_2_manifest.items()):
+        for key in manifest['assigned']:
+            key_2_shards[key].append(shard_index)
+        for key in sorted(set(manifest['assigned']) - set(manifest['finished'])):
+            errors.append(f'{key}: not finished by shard {shard_index}')
+    for key, shard_indices in sorted(key_2_shards.items()):
+        if shard_indices != [assignment[key]] and assignment[key] in shard_2_manifest:
+            errors.append(f'{key}: assigned to shards {shard_indices} instead of {assignment[key]}')
+        for shard_index in shard_indices:
+            if shard_2_manifest[shard_index]['finished'].get(key) == 'done':
+                errors.extend(verify_sequence_outputs(target_dir, key, reference))
+    return errors
+
+
+def merge_manifests(target_dir: Path) -> Dict[str, Any]:
+    manifests = load_manifests(target_dir)
+    merged = {key: manifests[0][key] for key in ('num_shards', 'sequences', 'targets', 'output_format',
+                                                  'downsample_by_2', 'downsampling')}
+    merged['finished'] = dict()
+    for manifest in manifests:
+        merged['finished'].update(manifest['finished'])
+    merged['finished'] = dict(sorted(merged['finished'].items()))
+    return merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify and merge the node shards of a preprocess_rvt.py run')
+    parser.add_argument('target_dir', help='Output directory of preprocess_rvt.py')
+    args = parser.parse_args()
+
+    target_dir = Path(args.target_dir)
+    errors = verify_shards(target_dir)
+    for error in errors:
+        print(error)
+    if len(errors) > 0:
+        print(f'{len(errors)} errors, the run is incomplete')
+        sys.exit(1)
+    merged = merge_manifests(target_dir)
+    with open(target_dir / 'manifest.json', 'w') as f:
+        json.dump(merged, f, indent=1)
+    num_done = sum(status == 'done' for status in merged['finished'].values())
+    print(f'{len(merged["sequences"])} sequences of {merged["num_shards"]} shards complete '
+          f'({num_done} with outputs, {len(merged["finished"]) - num_done} without labels). '
+          f'Wrote {target_dir / "manifest.json"}')